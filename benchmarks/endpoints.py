@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+Measures the latency of every route over a seeded dataset, reporting the p50,
+p95 and p99 latency, requests per second and Mongo operations per request of
+each endpoint. Results can be saved as JSON and compared against a saved
+baseline to catch regressions before deploying. Run with
+'python -m benchmarks.endpoints'.
+"""
+
+import argparse
+import json
+import random
+import sys
+from time import perf_counter
+
+from passlib.hash import sha256_crypt
+
+from benchmarks.fixtures import (clear_db,
+                                 get_mock_comment,
+                                 get_mock_post,
+                                 get_mock_user,
+                                 random_email,
+                                 random_string,
+                                 random_url,
+                                 record_queries,
+                                 sign_in)
+from tiny import create_app
+from tiny.models import Post
+
+password = 'password'
+
+def seed(users, posts, comments):
+    """
+    Seeds users (who all share the same password), posts and comments spread
+    randomly across them. Returns the users and posts.
+    """
+
+    password_hash = sha256_crypt.hash(password)
+
+    seeded_users = []
+    for i in range(users):
+        user = get_mock_user()
+        user.password = password_hash
+        seeded_users.append(user.save())
+
+    seeded_posts = [get_mock_post(author=random.choice(seeded_users)).save() for i in range(posts)]
+
+    comment_counts = {}
+    for i in range(comments):
+        post = random.choice(seeded_posts)
+        get_mock_comment(author=random.choice(seeded_users), post=post).save()
+        comment_counts[post.id] = comment_counts.get(post.id, 0) + 1
+    for post_id, count in comment_counts.items():
+        Post.objects(id=post_id).update_one(set__comment_count=count)
+
+    return seeded_users, seeded_posts
+
+def get_scenarios(author, users, posts):
+    """
+    Returns the requests to make for each endpoint. Each scenario is a dict
+    with the endpoint name, whether it needs a signed in client ('fresh' for a
+    new user each request), and a function returning the request (method, url
+    and any form data or headers). Signed in requests are made by author, and
+    requests that change or delete things are given fresh objects each time.
+    """
+
+    json_headers = {'accept': 'application/json'}
+
+    def any_user():
+        return random.choice(users)
+
+    def any_post():
+        return random.choice(posts)
+
+    def own_post():
+        return get_mock_post(author=author).save()
+
+    def post_data():
+        return {'title': random_string(20),
+                'lead_paragraph': random_string(80),
+                'image_url': random_url(),
+                'content': random_string(400)}
+
+    def terms():
+        # search for words that will match (the mock titles are a single word)
+        return random.choice(posts).title
+
+    def prefix():
+        return random.choice(posts).title[:random.randint(2, 5)]
+
+    return [
+        {'name': 'home.index', 'request': lambda: ('GET', '/', None, None)},
+        {'name': 'post.latest', 'request': lambda: ('GET', '/post/latest', None, json_headers)},
+        {'name': 'post.show', 'request': lambda: ('GET', '/post/{}/show'.format(any_post().id), None, None)},
+        {'name': 'post.show (signed in)',
+         'signed_in': True,
+         'request': lambda: ('GET', '/post/{}/show'.format(any_post().id), None, None)},
+        {'name': 'post.comments',
+         'request': lambda: ('GET', '/post/{}/comments'.format(any_post().id), None, json_headers)},
+        {'name': 'post.comment',
+         'signed_in': True,
+         'request': lambda: ('POST', '/post/{}/comment'.format(any_post().id), {'text': random_string(40)}, None)},
+        {'name': 'post.create (GET)', 'signed_in': True, 'request': lambda: ('GET', '/post/create', None, None)},
+        {'name': 'post.create', 'signed_in': True, 'request': lambda: ('POST', '/post/create', post_data(), None)},
+        {'name': 'post.settings',
+         'signed_in': True,
+         'request': lambda: ('GET', '/post/{}/settings'.format(own_post().id), None, None)},
+        {'name': 'post.update (GET)',
+         'signed_in': True,
+         'request': lambda: ('GET', '/post/{}/update'.format(own_post().id), None, None)},
+        {'name': 'post.update',
+         'signed_in': True,
+         'request': lambda: ('POST', '/post/{}/update'.format(own_post().id), post_data(), None)},
+        {'name': 'post.delete (GET)',
+         'signed_in': True,
+         'request': lambda: ('GET', '/post/{}/delete'.format(own_post().id), None, None)},
+        {'name': 'post.delete',
+         'signed_in': True,
+         'request': lambda: ('POST', '/post/{}/delete'.format(own_post().id), None, None)},
+        {'name': 'post.preview', 'request': lambda: ('POST', '/post/preview', {'content': random_string(200)}, None)},
+        {'name': 'search.index (GET)', 'request': lambda: ('GET', '/search', None, None)},
+        {'name': 'search.index',
+         'request': lambda: ('GET', '/search?terms={}'.format(terms()), None, json_headers)},
+        {'name': 'search.suggest',
+         'request': lambda: ('GET', '/search/suggest?prefix={}'.format(prefix()), None, None)},
+        {'name': 'user.show', 'request': lambda: ('GET', '/user/{}/show'.format(any_user().id), None, None)},
+        {'name': 'user.posts',
+         'request': lambda: ('GET', '/user/{}/posts'.format(any_user().id), None, json_headers)},
+        {'name': 'user.sign_up (GET)', 'request': lambda: ('GET', '/user/sign-up', None, None)},
+        {'name': 'user.sign_up',
+         'request': lambda: ('POST', '/user/sign-up', {'email': random_email(),
+                                                       'display_name': random_string(10),
+                                                       'password': password,
+                                                       'confirmation': password}, None)},
+        {'name': 'user.sign_in (GET)', 'request': lambda: ('GET', '/user/sign-in', None, None)},
+        {'name': 'user.sign_in',
+         'request': lambda: ('POST', '/user/sign-in', {'email': any_user().email, 'password': password}, None)},
+        {'name': 'user.sign_out (GET)', 'request': lambda: ('GET', '/user/sign-out', None, None)},
+        {'name': 'user.sign_out', 'request': lambda: ('POST', '/user/sign-out', None, None)},
+        {'name': 'user.settings', 'signed_in': True, 'request': lambda: ('GET', '/user/settings', None, None)},
+        {'name': 'user.update_profile (GET)',
+         'signed_in': True,
+         'request': lambda: ('GET', '/user/update-profile', None, None)},
+        {'name': 'user.update_profile',
+         'signed_in': True,
+         'request': lambda: ('POST', '/user/update-profile', {'display_name': random_string(10),
+                                                              'avatar_url': random_url(),
+                                                              'bio': random_string(40)}, None)},
+        {'name': 'user.update_password (GET)',
+         'signed_in': True,
+         'request': lambda: ('GET', '/user/update-password', None, None)},
+        {'name': 'user.update_password',
+         'signed_in': True,
+         'request': lambda: ('POST', '/user/update-password', {'current_password': password,
+                                                               'new_password': password,
+                                                               'confirmation': password}, None)},
+        {'name': 'user.delete (GET)', 'signed_in': True, 'request': lambda: ('GET', '/user/delete', None, None)},
+        {'name': 'user.delete', 'signed_in': 'fresh', 'request': lambda: ('POST', '/user/delete', None, None)},
+        {'name': 'static', 'request': lambda: ('GET', '/static/favicon.ico', None, None)}
+    ]
+
+def percentile(timings, percent):
+    """
+    Returns a percentile of some sorted timings (using the nearest rank).
+    """
+
+    return timings[max(0, -(-len(timings) * percent // 100) - 1)]
+
+def run_scenario(app, scenario, author, requests, warmup):
+    """
+    Makes a scenario's requests, returning its latency percentiles (in
+    milliseconds), requests per second, mean Mongo operations per request and
+    the number of requests that failed.
+    """
+
+    client = app.test_client()
+    if scenario.get('signed_in') is True:
+        sign_in(client, author.email, password)
+
+    timings = []
+    operation_count = 0
+    errors = 0
+
+    for i in range(warmup + requests):
+        # anonymous visitors start without a session each time (e.g. so signing in isn't redirected)
+        if not scenario.get('signed_in'):
+            client = app.test_client()
+
+        # signs in a new user each time (for requests that delete their user)
+        if scenario.get('signed_in') == 'fresh':
+            user = get_mock_user()
+            user.password = author.password
+            user.save()
+            sign_in(client, user.email, password)
+
+        method, url, data, headers = scenario['request']()
+
+        with record_queries() as queries:
+            start = perf_counter()
+            response = client.open(url, method=method, data=data, headers=headers)
+            elapsed = perf_counter() - start
+        response.close()
+
+        if i < warmup:
+            continue
+
+        timings.append(elapsed)
+        operation_count += len(queries)
+        if response.status_code >= 400:
+            errors += 1
+
+    timings.sort()
+    return {
+        'requests': requests,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'requests_per_second': len(timings) / sum(timings),
+        'mongo_operations': operation_count / requests,
+        'errors': errors
+    }
+
+def compare(results, baseline, threshold):
+    """
+    Prints each endpoint's change against a baseline. Returns the names of
+    endpoints whose p95 latency got more than threshold percent slower or that
+    now make more Mongo operations per request.
+    """
+
+    regressions = []
+
+    print('{:<30}{:>12}{:>12}{:>10}{:>10}{:>10}'.format('endpoint', 'p95 (ms)', 'baseline', 'change', 'ops',
+                                                        'baseline'))
+    for name, result in results['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if not base:
+            print('{:<30}{:>12.2f}{:>12}'.format(name, result['p95_ms'], 'new'))
+            continue
+
+        change = (result['p95_ms'] - base['p95_ms']) / base['p95_ms'] * 100 if base['p95_ms'] else 0
+        regressed = change > threshold or result['mongo_operations'] > base['mongo_operations']
+        if regressed:
+            regressions.append(name)
+
+        print('{:<30}{:>12.2f}{:>12.2f}{:>9.1f}%{:>10.1f}{:>10.1f}{}'.format(name,
+                                                                             result['p95_ms'],
+                                                                             base['p95_ms'],
+                                                                             change,
+                                                                             result['mongo_operations'],
+                                                                             base['mongo_operations'],
+                                                                             '  <- regressed' if regressed else ''))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50, help='Number of users to seed.')
+    parser.add_argument('--posts', type=int, default=500, help='Number of posts to seed.')
+    parser.add_argument('--comments', type=int, default=2000, help='Number of comments to seed.')
+    parser.add_argument('--requests', type=int, default=50, help='Requests to time per endpoint.')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed requests to make first per endpoint.')
+    parser.add_argument('--endpoint', action='append', help='Only run endpoints starting with this (repeatable).')
+    parser.add_argument('--output', help='File to write the results to (as JSON).')
+    parser.add_argument('--baseline', help='Results file (from --output) to compare against.')
+    parser.add_argument('--threshold', type=float, default=20, help='Percent p95 slowdown counted as a regression.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random data and requests.')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    app = create_app(testing=True)
+
+    # mongomock doesn't support the text index
+    app.config['SEARCH_BACKEND'] = 'bm25'
+
+    with app.app_context():
+        clear_db()
+        users, posts = seed(args.users, args.posts, args.comments)
+
+        results = {'config': vars(args), 'endpoints': {}}
+
+        print('{:<30}{:>10}{:>10}{:>10}{:>10}{:>10}{:>8}'.format('endpoint', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+                                                                 'req/s', 'ops', 'errors'))
+        for scenario in get_scenarios(users[0], users, posts):
+            if args.endpoint and not any(scenario['name'].startswith(name) for name in args.endpoint):
+                continue
+
+            result = run_scenario(app, scenario, users[0], args.requests, args.warmup)
+            results['endpoints'][scenario['name']] = result
+            print('{:<30}{p50_ms:>10.2f}{p95_ms:>10.2f}{p99_ms:>10.2f}{requests_per_second:>10.1f}'
+                  '{mongo_operations:>10.1f}{errors:>8}'.format(scenario['name'], **result))
+
+        clear_db()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n{} endpoint(s) regressed: {}'.format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Exports helpers for seeding mock data, signing test clients in and out and
+recording the queries sent to Mongo, shared by the benchmarks and the tests.
+They are kept out of the tiny package as they aren't fit for production use
+(e.g. clear_db deletes everything in the database).
+"""
+
+import random
+import string
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from threading import local
+from unittest import mock
+
+from tiny.models import Comment, Deletion, Job, Post, SlowQuery, User
+
+# collection methods that each send (at least) one query to Mongo
+query_methods = ('aggregate',
+                 'bulk_write',
+                 'count_documents',
+                 'delete_many',
+                 'delete_one',
+                 'estimated_document_count',
+                 'find',
+                 'find_one',
+                 'find_one_and_update',
+                 'insert_many',
+                 'insert_one',
+                 'replace_one',
+                 'update_many',
+                 'update_one')
+
+#
+# Private helper functions.
+#
+
+# lists of queries being recorded (see record_queries)
+__query_recorders__ = []
+
+__query_state__ = local()
+
+def __record_query__(method):
+    @wraps(method)
+    def recorded(collection, *args, **kwargs):
+        # only record the outermost call (e.g. mongomock implements find_one with find)
+        depth = getattr(__query_state__, 'depth', 0)
+        if not depth:
+            arguments = ', '.join(repr(arg)[:200] for arg in args)
+            for queries in __query_recorders__:
+                queries.append('{}.{}({})'.format(collection.name, method.__name__, arguments))
+
+        __query_state__.depth = depth + 1
+        try:
+            return method(collection, *args, **kwargs)
+        finally:
+            __query_state__.depth = depth
+
+    recorded.records_queries = True
+    return recorded
+
+#
+# Data functions.
+#
+
+def clear_db():
+    """
+    Deletes everything in the database (so only use it on a test database).
+    """
+
+    Comment.objects.delete()
+    Deletion.objects.delete()
+    Job.objects.delete()
+    Post.objects.delete()
+    SlowQuery.objects.delete()
+    User.objects.delete()
+
+def random_string(size):
+    """
+    Returns a random string of lowercase letters.
+    """
+
+    return ''.join(random.choice(string.ascii_lowercase) for i in range(size))
+
+def random_email():
+    """
+    Returns a random email address.
+    """
+
+    return '{}@{}.com'.format(random_string(7), random_string(7))
+
+def random_url():
+    """
+    Returns a random URL.
+    """
+
+    return 'http://www.{}.com'.format(random_string(7))
+
+def get_mock_user():
+    """
+    Returns a new (unsaved) user with random details.
+    """
+
+    return User(email=random_email(),
+                password=random_string(10),
+                display_name=random_string(10),
+                bio=random_string(10),
+                avatar_url=random_url())
+
+def get_mock_post(author=None):
+    """
+    Returns a new (unsaved) post with random details, by a new user if no
+    author is given.
+    """
+
+    if not author:
+        author = get_mock_user().save()
+
+    return Post(author=author,
+                title=random_string(10),
+                lead_paragraph=random_string(10),
+                image_url=random_url(),
+                content=random_string(10))
+
+def get_mock_comment(author=None, post=None):
+    """
+    Returns a new (unsaved) comment with random text, by a new user and on a
+    new post if they aren't given.
+    """
+
+    if not author:
+        author = get_mock_user().save()
+    if not post:
+        post = get_mock_post().save()
+
+    return Comment(author=author,
+                   post=post,
+                   text=random_string(10))
+
+#
+# Client functions.
+#
+
+def sign_in(client, email, password):
+    """
+    Signs a test client in.
+    """
+
+    return client.post('/user/sign-in', data={'email': email, 'password': password})
+
+def sign_out(client):
+    """
+    Signs a test client out.
+    """
+
+    return client.post('/user/sign-out')
+
+#
+# Query functions.
+#
+
+@contextmanager
+def record_queries():
+    """
+    Records the queries sent to Mongo inside the block (as a list of
+    descriptions like "post.find({...})"). Works by wrapping the methods of the
+    collection class in use for the length of the block, as mongomock doesn't
+    publish pymongo's command monitoring events.
+    """
+
+    collection_class = type(Post._get_collection())  # pylint: disable=protected-access
+    queries = []
+    with ExitStack() as patches:
+        # blocks inside another record_queries block leave its wrappers in place
+        for name in query_methods:
+            method = getattr(collection_class, name, None)
+            if method and not getattr(method, 'records_queries', False):
+                patches.enter_context(mock.patch.object(collection_class, name, __record_query__(method)))
+
+        __query_recorders__.append(queries)
+        try:
+            yield queries
+        finally:
+            # by identity (as the lists of nested blocks can be equal)
+            __query_recorders__[:] = [recorder for recorder in __query_recorders__ if recorder is not queries]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Compares the time and memory it takes to query and serialize a page of posts
+(and comments) as full documents against the read only summaries. Run with
+'python -m benchmarks.read_models'.
+"""
+
+import argparse
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.fixtures import clear_db, get_mock_comment, get_mock_post, get_mock_user
+from tiny import create_app
+from tiny.helpers import get_comment_summaries, get_comments, get_post_summaries, get_posts, serialize
+
+def seed(rows, authors):
+    """
+    Seeds a page worth of posts and comments (on a single post) spread across
+    a number of authors.
+    """
+
+    users = [get_mock_user().save() for i in range(authors)]
+    post = get_mock_post(author=users[0]).save()
+    for i in range(rows):
+        get_mock_post(author=users[i % authors]).save()
+        get_mock_comment(author=users[i % authors], post=post).save()
+    return post
+
+def measure(page, repeat):
+    """
+    Returns the mean time (in milliseconds) and peak memory (in KiB) it takes
+    to build a page.
+    """
+
+    start = perf_counter()
+    for i in range(repeat):
+        page()
+    elapsed = (perf_counter() - start) / repeat * 1000
+
+    tracemalloc.start()
+    page()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100, help='Rows per page.')
+    parser.add_argument('--authors', type=int, default=10, help='Number of distinct authors.')
+    parser.add_argument('--repeat', type=int, default=20, help='Times to build each page.')
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+    with app.test_request_context():
+        post = seed(args.rows, args.authors)
+
+        pages = {
+            'posts (documents)': lambda: serialize(get_posts(exclude=['content', 'content_html'],
+                                                             order_by=['-created'],
+                                                             limit=args.rows)),
+            'posts (summaries)': lambda: serialize(get_post_summaries(limit=args.rows)),
+            'comments (documents)': lambda: serialize(get_comments(post_id=str(post.id),
+                                                                   exclude=['post'],
+                                                                   order_by=['created'],
+                                                                   limit=args.rows)),
+            'comments (summaries)': lambda: serialize(get_comment_summaries(post_id=str(post.id), limit=args.rows))
+        }
+
+        print('{:<22}{:>12}{:>16}'.format('page', 'time (ms)', 'peak (KiB)'))
+        for name, page in pages.items():
+            elapsed, peak = measure(page, args.repeat)
+            print('{:<22}{:>12.2f}{:>16.1f}'.format(name, elapsed, peak))
+
+        clear_db()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Compares the time it takes to search posts with the Mongo text index against
+the in-process BM25 index (and how long the BM25 index takes to build), and
+times search suggestions (which are completed from an index in memory). The
+text index needs a real MongoDB, so by default only the BM25 backend is run
+(against mongomock). Pass --mongo to seed a separate database on the
+configured MongoDB and run both. Run with 'python -m benchmarks.search'.
+"""
+
+import argparse
+import os
+import random
+from time import perf_counter
+
+from benchmarks.fixtures import clear_db, get_mock_post, get_mock_user, random_string
+from tiny import create_app
+from tiny.search_backends import BM25Backend, MongoTextBackend
+from tiny.suggestions import SuggestionIndex
+
+def seed(posts, vocabulary):
+    """
+    Seeds posts made of words drawn (with a long tail, like real text) from a
+    vocabulary. Returns the vocabulary.
+    """
+
+    words = [random_string(random.randint(4, 10)) for i in range(vocabulary)]
+    weights = [1 / (i + 1) for i in range(vocabulary)]
+
+    def text(length):
+        return ' '.join(random.choices(words, weights=weights, k=length))
+
+    author = get_mock_user().save()
+    for i in range(posts):
+        post = get_mock_post(author=author)
+        post.title = text(6)
+        post.lead_paragraph = text(30)
+        post.content = text(300)
+        post.save()
+
+    return words
+
+def measure(backend, queries, limit):
+    """
+    Returns the mean time (in milliseconds) it takes to search for a page of
+    posts.
+    """
+
+    start = perf_counter()
+    for query in queries:
+        backend.search_post_summaries(query, limit=limit)
+    return (perf_counter() - start) / len(queries) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=2000, help='Number of posts to search.')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Number of distinct words.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of searches to run.')
+    parser.add_argument('--limit', type=int, default=12, help='Posts per page.')
+    parser.add_argument('--mongo', action='store_true', help='Run against MongoDB (including the text index).')
+    parser.add_argument('--db', default='tiny_benchmark', help='MongoDB database to seed (and clear) with --mongo.')
+    args = parser.parse_args()
+
+    if args.mongo:
+        os.environ['MONGODB_DB'] = args.db
+
+    app = create_app(testing=not args.mongo)
+    with app.test_request_context():
+        words = seed(args.posts, args.vocabulary)
+
+        # mix one and two word queries across common and rare words
+        queries = [' '.join(random.sample(words, random.randint(1, 2))) for i in range(args.queries)]
+
+        bm25 = BM25Backend(ttl=float('inf'))
+        start = perf_counter()
+        bm25.build()
+        print('bm25 index built in {:.2f} ms'.format((perf_counter() - start) * 1000))
+
+        backends = {'bm25': bm25}
+        if args.mongo:
+            backends['mongo ($text)'] = MongoTextBackend()
+
+        print('{:<16}{:>12}'.format('backend', 'time (ms)'))
+        for name, backend in backends.items():
+            print('{:<16}{:>12.2f}'.format(name, measure(backend, queries, args.limit)))
+
+        suggestions = SuggestionIndex()
+        suggestions.build()
+        prefixes = [word[:random.randint(1, 4)] for word in random.sample(words, min(args.queries, len(words)))]
+        start = perf_counter()
+        for prefix in prefixes:
+            suggestions.suggest(prefix)
+        print('{:<16}{:>12.3f}'.format('suggest', (perf_counter() - start) / len(prefixes) * 1000))
+
+        clear_db()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long a new worker takes to start and serve its first pages, with
+an empty template bytecode cache, a full one, and a full one with every
+template warmed up when the app is created. Each run is a new process (so
+nothing is compiled in memory yet). Reports the median time to create the app,
+to serve the first request to each page, and the two added up. Run with
+'python -m benchmarks.startup'.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+# config of each mode (the cache directory is filled in per mode)
+modes = {
+    'cold cache': {'TEMPLATE_WARMUP': 'false'},
+    'warm cache': {'TEMPLATE_WARMUP': 'false'},
+    'warm cache + warmup': {'TEMPLATE_WARMUP': 'true'}
+}
+
+def run_worker():
+    """
+    Creates the app, seeds a user and post, and times the first request to
+    each page. Prints the timings (in milliseconds) as JSON.
+    """
+
+    from benchmarks.fixtures import clear_db, get_mock_post
+    from tiny import create_app
+
+    start = perf_counter()
+    app = create_app(testing=True)
+    create_ms = (perf_counter() - start) * 1000
+
+    with app.app_context():
+        post = get_mock_post().save()
+        urls = ['/',
+                '/post/{}/show'.format(post.id),
+                '/user/{}/show'.format(post.author.id),
+                '/search',
+                '/user/sign-in',
+                '/user/sign-up']
+
+        client = app.test_client()
+        requests_ms = {}
+        for url in urls:
+            start = perf_counter()
+            client.get(url).close()
+            requests_ms[url] = (perf_counter() - start) * 1000
+
+        clear_db()
+
+    print(json.dumps({'create_ms': create_ms, 'requests_ms': requests_ms}))
+
+def run_mode(config, runs):
+    """
+    Starts workers with some config, returning the median time to create the
+    app and to serve the first requests (in milliseconds).
+    """
+
+    results = []
+    for i in range(runs):
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--worker'],
+                                env=dict(os.environ, **config),
+                                stdout=subprocess.PIPE,
+                                check=True).stdout
+        results.append(json.loads(output.decode().splitlines()[-1]))
+
+    create_ms = median(result['create_ms'] for result in results)
+    requests_ms = median(sum(result['requests_ms'].values()) for result in results)
+    return {'create_ms': create_ms, 'requests_ms': requests_ms, 'total_ms': create_ms + requests_ms}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='Workers to start per mode.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker()
+        return
+
+    print('{:<24}{:>14}{:>18}{:>12}'.format('mode', 'create (ms)', 'first pages (ms)', 'total (ms)'))
+
+    with tempfile.TemporaryDirectory() as warm_directory:
+        # fill the cache shared by the warm modes
+        run_mode({'TEMPLATE_CACHE_DIR': warm_directory, 'TEMPLATE_WARMUP': 'true'}, 1)
+
+        results = {}
+        for name, config in modes.items():
+            if name == 'cold cache':
+                # a new (empty) cache for every worker
+                runs = []
+                for i in range(args.runs):
+                    with tempfile.TemporaryDirectory() as cold_directory:
+                        runs.append(run_mode(dict(config, TEMPLATE_CACHE_DIR=cold_directory), 1))
+                results[name] = {key: median(run[key] for run in runs) for key in runs[0]}
+            else:
+                results[name] = run_mode(dict(config, TEMPLATE_CACHE_DIR=warm_directory), args.runs)
+
+            print('{:<24}{create_ms:>14.1f}{requests_ms:>18.1f}{total_ms:>12.1f}'.format(name, **results[name]))
+
+    cold = results['cold cache']
+    for name in ('warm cache', 'warm cache + warmup'):
+        print('{}: first pages {:.1f}x faster ({:.1f}x including creating the app) than a cold cache'.format(
+            name,
+            cold['requests_ms'] / results[name]['requests_ms'],
+            cold['total_ms'] / results[name]['total_ms']))
+
+if __name__ == '__main__':
+    main()
@@ -10,16 +10,42 @@ class Default:
     Default config properties.
     """
 
+    ASSETS_AUTO_BUILD = False
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_MIN_SIZE = 500
     DEBUG = False
+    DELETION_BATCH_SIZE = 500
     ENV = 'production'
+    EXPLAIN_INTERVAL = 600
+    JOB_LEASE_TIMEOUT = 600
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_DELAY = 10
+    JOB_THREADS = 1
+    METRICS_DIR = None
+    METRICS_ENABLED = False
+    METRICS_INTERVAL = 5
+    METRICS_TOKEN = None
     MONGODB_DB = 'tiny'
     MONGODB_HOST = '127.0.0.1'
     MONGODB_PASSWORD = None
     MONGODB_PORT = 27017
     MONGODB_USERNAME = None
+    PASSWORD_LOCK_DIR = None
+    PASSWORD_POOL_SIZE = 1
+    PASSWORD_QUEUE_SIZE = 1
+    PASSWORD_TIMEOUT = 2
+    PREVIEW_BUDGET = 100_000
+    PREVIEW_MAX_LENGTH = 10_000
+    PROXY_COUNT = 0
+    SEARCH_BACKEND = 'mongo'
+    SEARCH_INDEX_TTL = 300
     SECRET_KEY = 'default secret key'
     SERVER_NAME = '127.0.0.1:5000'
     SESSION_COOKIE_DOMAIN = '127.0.0.1:5000'
+    SLOW_QUERY_THRESHOLD = 100
+    SNAPSHOT_BATCH_SIZE = 500
+    TEMPLATE_CACHE_DIR = None
+    TEMPLATE_WARMUP = True
     WTF_CSRF_ENABLED = True
 
 class Test:
@@ -27,7 +53,9 @@ class Test:
     Test config properties.
     """
 
+    ASSETS_AUTO_BUILD = True
     DEBUG = True
     ENV = 'test'
+    METRICS_ENABLED = True
     MONGODB_HOST = 'mongomock://localhost'
     WTF_CSRF_ENABLED = False
@@ -0,0 +1,120 @@
+import pytest
+
+from benchmarks.fixtures import (get_mock_comment,
+                                 get_mock_post,
+                                 get_mock_user,
+                                 random_email,
+                                 random_string,
+                                 random_url,
+                                 record_queries,
+                                 sign_out)
+from tests.test_utils import TestBase
+from tiny.helpers import response_cache, user_cache
+from tiny.search_backends import backends, get_search_backend, search_cache
+from tiny.suggestions import suggestion_index
+
+json_headers = {'accept': 'application/json'}
+
+def get_post_data():
+    return {'title': random_string(10),
+            'lead_paragraph': random_string(10),
+            'image_url': random_url(),
+            'content': random_string(10)}
+
+# the most queries each route may make with nothing cached, by request (method, url, if signed in and any form data
+# or headers); urls are filled in with the ids of a post by another user (post_id) and its author (user_id), and of
+# a post by the signed in user (own_post_id)
+budgets = [
+    ('GET', '/', False, None, None, 0),
+    ('GET', '/post/latest?limit=50', False, None, json_headers, 1),
+    ('GET', '/post/latest?limit=50', True, None, json_headers, 1),
+    ('GET', '/post/{post_id}/show', False, None, None, 1),
+    ('GET', '/post/{post_id}/show', True, None, None, 1),
+    ('GET', '/post/{post_id}/comments?limit=50', False, None, json_headers, 2),
+    ('POST', '/post/{post_id}/comment', True, {'text': random_string(10)}, None, 4),
+    ('GET', '/post/create', True, None, None, 1),
+    ('POST', '/post/create', True, get_post_data(), None, 2),
+    ('GET', '/post/{own_post_id}/settings', True, None, None, 2),
+    ('GET', '/post/{own_post_id}/update', True, None, None, 2),
+    ('POST', '/post/{own_post_id}/update', True, get_post_data(), None, 3),
+    ('GET', '/post/{own_post_id}/delete', True, None, None, 2),
+    ('POST', '/post/{own_post_id}/delete', True, None, None, 5),
+    ('GET', '/search?terms=python', False, None, json_headers, 1),
+    ('GET', '/search/suggest?prefix=py', False, None, None, 0),
+    ('GET', '/user/{user_id}/show', False, None, None, 1),
+    ('GET', '/user/{user_id}/posts?limit=50', False, None, json_headers, 2),
+    ('GET', '/user/settings', True, None, None, 1),
+    ('POST', '/user/update-profile', True, {'display_name': random_string(10), 'avatar_url': random_url()}, None, 4),
+    ('POST', '/user/update-password', True, {'current_password': 'password',
+                                             'new_password': 'password',
+                                             'confirmation': 'password'}, None, 2),
+    ('POST', '/user/sign-up', False, {'email': random_email(),
+                                      'display_name': random_string(10),
+                                      'password': 'password',
+                                      'confirmation': 'password'}, None, 2),
+    ('POST', '/user/sign-in', False, {'email': 'me@example.com', 'password': 'password'}, None, 1),
+    ('POST', '/user/delete', True, None, None, 8)
+]
+
+class TestBudgets(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+
+        # seed enough posts and comments (by different authors) for N+1 queries to show up
+        authors = [get_mock_user().save() for i in range(5)]
+        self.post = get_mock_post(author=authors[0]).save()
+        for i in range(10):
+            post = get_mock_post(author=authors[i % 5])
+            post.title = 'python'
+            post.save()
+            get_mock_comment(author=authors[i % 5], post=self.post).save()
+        self.own_post = get_mock_post(author=self.user).save()
+
+        # build the in-process indexes up front (they're only rebuilt every SEARCH_INDEX_TTL seconds)
+        self.app.config['SEARCH_BACKEND'] = 'bm25'
+        backends.clear()
+        get_search_backend().build()
+        suggestion_index.build()
+
+    def teardown_method(self):
+        super().teardown_method()
+        backends.clear()
+        suggestion_index.clear()
+
+    @pytest.mark.parametrize('method, url, signed_in, data, headers, budget',
+                             budgets,
+                             ids=['{} {}'.format(*budget[:2]) for budget in budgets])
+    def test_query_budget(self, method, url, signed_in, data, headers, budget):
+        url = url.format(post_id=self.post.id, user_id=self.post.author.id, own_post_id=self.own_post.id)
+
+        if not signed_in:
+            sign_out(self.client)
+
+        # measure the worst case (i.e. nothing cached)
+        response_cache.clear()
+        search_cache.clear()
+        user_cache.clear()
+
+        with record_queries() as queries:
+            response = self.client.open(url, method=method, data=data, headers=headers)
+
+        assert response.status_code < 400
+        assert len(queries) <= budget, '{} {} made {} queries (budget {}):\n{}'.format(method,
+                                                                                     url,
+                                                                                     len(queries),
+                                                                                     budget,
+                                                                                     '\n'.join(queries))
+
+    def test_recording_stops_after_block(self):
+        with record_queries() as queries:
+            with record_queries() as inner_queries:
+                get_mock_post().save()
+            self.client.get('/post/latest', headers=json_headers)
+        assert queries[:len(inner_queries)] == inner_queries
+        assert len(queries) > len(inner_queries)
+
+        # the collection's methods are put back as they were
+        collection_class = type(self.post._get_collection())  # pylint: disable=protected-access
+        assert not getattr(collection_class.find, 'records_queries', False)
+        assert not getattr(collection_class.aggregate, 'records_queries', False)
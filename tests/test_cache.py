@@ -0,0 +1,65 @@
+from unittest import mock
+
+from tiny.cache import LRUCache
+
+class TestCache:
+
+    def test_get_and_set(self):
+        cache = LRUCache()
+        cache.set('key', 'value')
+        assert cache.get('key') == 'value'
+        assert cache.get('missing', 'default') == 'default'
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert len(cache) == 2
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        assert 'a' not in cache
+        cache.clear()
+        assert len(cache) == 0
+
+    @mock.patch('tiny.cache.monotonic')
+    def test_entries_expire(self, mock_monotonic):
+        cache = LRUCache(ttl=10)
+        mock_monotonic.return_value = 100
+        cache.set('key', 'value')
+        mock_monotonic.return_value = 109
+        assert cache.get('key') == 'value'
+        mock_monotonic.return_value = 110
+        assert cache.get('key') is None
+        assert 'key' not in cache
+
+    def test_bounded_by_size(self):
+        cache = LRUCache(max_size=10, size_of=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 4)
+        assert 'a' not in cache
+        assert cache.size == 8
+        cache.delete('b')
+        assert cache.size == 4
+
+    @mock.patch('tiny.cache.monotonic')
+    def test_items(self, mock_monotonic):
+        cache = LRUCache(ttl=10)
+        mock_monotonic.return_value = 100
+        cache.set('a', 1)
+        mock_monotonic.return_value = 105
+        cache.set('b', 2)
+        mock_monotonic.return_value = 110
+        assert cache.items() == [('b', 2)]
+        assert cache.hits == 0
@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+from benchmarks.fixtures import get_mock_comment, get_mock_post, random_string
+from tests.test_utils import TestBase
+from tiny.commands import (build_assets,
+                           check_indexes,
+                           job_stats,
+                           reconcile_authors,
+                           recount_comments,
+                           render_posts,
+                           resume_deletions,
+                           run_worker,
+                           slow_queries)
+from tiny.deletions import delete_post
+from tiny.helpers import markdown_to_html, markdown_version
+from tiny.models import AuthorSnapshot, Comment, Post, SlowQuery
+
+def get_mock_plan(*stages):
+    plan = {'stage': stages[-1]}
+    for stage in reversed(stages[:-1]):
+        plan = {'stage': stage, 'inputStage': plan}
+    return {'queryPlanner': {'winningPlan': plan}}
+
+class TestCommands(TestBase):
+
+    #
+    # Check indexes tests.
+    #
+
+    @mock.patch('tiny.commands.__explain__')
+    def test_check_indexes_covered(self, mock_explain):
+        mock_explain.return_value = get_mock_plan('LIMIT', 'FETCH', 'IXSCAN')
+        result = self.app.test_cli_runner().invoke(check_indexes)
+        assert 'not index covered' not in result.output
+        assert result.exit_code == 0
+
+        # ensure the pipelines the routes run are explained (not just query sets)
+        pipeline = mock_explain.call_args_list[0][0][0]
+        assert {'$limit': 12} in pipeline
+
+    @mock.patch('tiny.commands.__explain__')
+    def test_check_indexes_collection_scan(self, mock_explain):
+        mock_explain.return_value = get_mock_plan('LIMIT', 'SORT', 'COLLSCAN')
+        result = self.app.test_cli_runner().invoke(check_indexes)
+        assert 'get_post_summaries(): not index covered (COLLSCAN, SORT)' in result.output
+        assert result.exit_code != 0
+
+    @mock.patch('tiny.commands.__explain__')
+    def test_check_indexes_text_score_sort(self, mock_explain):
+        mock_explain.return_value = get_mock_plan('LIMIT', 'SORT', 'TEXT', 'IXSCAN')
+        result = self.app.test_cli_runner().invoke(check_indexes)
+        assert 'MongoTextBackend.search_post_summaries(search_text): ok' in result.output
+
+    #
+    # Build assets tests.
+    #
+
+    def test_build_assets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # build a copy of the static files so the real build directory isn't touched
+            static_folder = os.path.join(directory, 'static')
+            shutil.copytree(self.app.static_folder,
+                            static_folder,
+                            ignore=shutil.ignore_patterns('.webassets-cache', 'build', '*.gz'))
+            self.app.jinja_env.assets_environment.directory = static_folder
+
+            os.makedirs(os.path.join(static_folder, 'build'))
+            stale_path = os.path.join(static_folder, 'build', 'bundle.0123abcd.min.js')
+            with open(stale_path, 'w') as f:
+                f.write('stale')
+
+            result = self.app.test_cli_runner().invoke(build_assets)
+            assert 'Removed build/bundle.0123abcd.min.js' in result.output
+            assert not os.path.exists(stale_path)
+            assert result.exit_code == 0
+
+            with open(os.path.join(static_folder, 'build', 'manifest.json')) as f:
+                for output, version in json.load(f).items():
+                    assert 'Built {}'.format(output % {'version': version}) in result.output
+                    assert os.path.exists(os.path.join(static_folder, output % {'version': version}))
+                    assert os.path.exists(os.path.join(static_folder, output % {'version': version} + '.gz'))
+
+    #
+    # Recount comments tests.
+    #
+
+    def test_recount_comments(self):
+        posts = [get_mock_post().save() for i in range(5)]
+        for i, post in enumerate(posts):
+            for j in range(i):
+                get_mock_comment(post=post).save()
+            Post.objects(id=post.id).update_one(set__comment_count=i)
+
+        # make some counts drift (including one missing completely)
+        Post.objects(id=posts[1].id).update_one(set__comment_count=7)
+        Post.objects(id=posts[3].id).update_one(unset__comment_count=True)
+
+        result = self.app.test_cli_runner().invoke(recount_comments, ['--batch-size', '2'])
+        assert 'Finished recounting 5 posts (2 fixed)' in result.output
+        assert result.exit_code == 0
+
+        for post in Post.objects:
+            assert post.comment_count == Comment.objects(post=post.id).count()
+
+    #
+    # Render posts tests.
+    #
+
+    def test_render_posts(self):
+        # create posts without content HTML
+        for i in range(5):
+            post = get_mock_post()
+            post.content = '# Hello'
+            post.save()
+
+        # create post with stale content HTML
+        stale_post = get_mock_post()
+        stale_post.content = '# Stale'
+        stale_post.content_html = 'stale'
+        stale_post.content_html_version = 'stale'
+        stale_post.save()
+
+        result = self.app.test_cli_runner().invoke(render_posts, ['--batch-size', '2'])
+        assert 'Finished rendering 6 posts' in result.output
+        assert result.exit_code == 0
+
+        for post in Post.objects:
+            assert post.content_html == markdown_to_html(post.content)
+            assert post.content_html_version == markdown_version
+
+    #
+    # Reconcile authors tests.
+    #
+
+    def test_reconcile_authors(self):
+        # create posts and comments without snapshots
+        for i in range(3):
+            post = get_mock_post().save()
+            get_mock_comment(post=post).save()
+        for model in (Post, Comment):
+            collection = model._get_collection()  # pylint: disable=protected-access
+            collection.update_many({}, {'$unset': {'author_snapshot': 1}})
+
+        # create post with a snapshot that has drifted from its author
+        drifted_post = get_mock_post().save()
+        drifted_post.author.display_name = random_string(10)
+        drifted_post.author.save()
+
+        result = self.app.test_cli_runner().invoke(reconcile_authors, ['--batch-size', '2'])
+        assert 'Finished reconciling 7 posts and comments' in result.output
+        assert result.exit_code == 0
+
+        for model in (Post, Comment):
+            for document in model.objects:
+                assert document.author_snapshot == AuthorSnapshot.from_user(document.author)
+
+        # ensure nothing is left to reconcile
+        result = self.app.test_cli_runner().invoke(reconcile_authors)
+        assert 'Finished reconciling 0 posts and comments' in result.output
+
+    #
+    # Resume deletions tests.
+    #
+
+    def test_resume_deletions(self):
+        post = get_mock_post().save()
+        get_mock_comment(post=post).save()
+        delete_post(post)
+
+        result = self.app.test_cli_runner().invoke(resume_deletions)
+        assert 'Resuming deletion of post {} (0 posts and 0 comments deleted so far)'.format(post.id) in result.output
+        assert 'Finished 1 deletions' in result.output
+        assert result.exit_code == 0
+        assert Post.objects(id=post.id).count() == 0
+        assert Comment.objects(post=post.id).count() == 0
+
+    #
+    # Job tests.
+    #
+
+    def test_run_worker_burst(self):
+        delete_post(get_mock_post().save())
+
+        result = self.app.test_cli_runner().invoke(run_worker, ['--burst'])
+        assert 'Finished running 1 jobs' in result.output
+        assert result.exit_code == 0
+
+    def test_job_stats(self):
+        delete_post(get_mock_post().save())
+        result = self.app.test_cli_runner().invoke(job_stats)
+        assert 'Queued: 1, running: 0, done: 0, failed: 0' in result.output
+        assert result.exit_code == 0
+
+    #
+    # Slow query tests.
+    #
+
+    def test_slow_queries(self):
+        post_shape = 'post.find {"filter": {"author": "?"}}'
+        for duration in (100, 200, 300):
+            SlowQuery(shape=post_shape, command_name='find', endpoint='user.posts', duration=duration).save()
+        SlowQuery(shape=post_shape, command_name='find', endpoint='home.index', duration=150, plan='COLLSCAN').save()
+        SlowQuery(shape='user.find {"filter": {"email": "?"}}',
+                  command_name='find',
+                  endpoint='user.sign_in',
+                  duration=120).save()
+
+        # too old to report
+        SlowQuery(shape='comment.find {}',
+                  command_name='find',
+                  endpoint='post.comments',
+                  duration=500,
+                  created=datetime(2000, 1, 1)).save()
+
+        result = self.app.test_cli_runner().invoke(slow_queries)
+        lines = result.output.splitlines()
+        assert lines[0] == post_shape
+        assert lines[1] == '  4 times, 187.5 ms mean, 300.0 ms max, 750.0 ms total'
+        assert lines[2] == '  From: home.index, user.posts'
+        assert lines[3] == '  Plan: COLLSCAN'
+        assert lines[4] == 'user.find {"filter": {"email": "?"}}'
+        assert lines[7] == '  Plan: not explained'
+        assert 'comment.find' not in result.output
+        assert result.exit_code == 0
+
+    def test_no_slow_queries(self):
+        result = self.app.test_cli_runner().invoke(slow_queries, ['--hours', '1'])
+        assert 'No slow queries in the last 1 hours' in result.output
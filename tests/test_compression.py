@@ -0,0 +1,159 @@
+import gzip
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from benchmarks.fixtures import get_mock_post
+from tests.test_utils import TestBase
+from tiny.compression import precompress_static_files
+
+gzip_headers = {'accept-encoding': 'gzip, deflate'}
+
+class TestCompression(TestBase):
+
+    #
+    # Response tests.
+    #
+
+    def test_page_compressed(self):
+        post = get_mock_post().save()
+        response = self.client.get('/post/{}/show'.format(post.id), headers=gzip_headers)
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert int(response.headers['Content-Length']) == len(response.get_data())
+        assert post.title in gzip.decompress(response.get_data()).decode()
+
+    def test_json_compressed(self):
+        for i in range(10):
+            get_mock_post().save()
+        response = self.client.get('/post/latest', headers={'accept': 'application/json', **gzip_headers})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()).startswith(b'[')
+
+    def test_not_compressed_unless_accepted(self):
+        response = self.client.get('/')
+        assert 'Content-Encoding' not in response.headers
+        assert 'Accept-Encoding' in response.headers['Vary']
+
+        response = self.client.get('/', headers={'accept-encoding': 'gzip;q=0, deflate'})
+        assert 'Content-Encoding' not in response.headers
+
+    def test_small_responses_not_compressed(self):
+        self.app.config['COMPRESSION_MIN_SIZE'] = 1_000_000
+        response = self.client.get('/', headers=gzip_headers)
+        assert 'Content-Encoding' not in response.headers
+
+    def test_compression_disabled(self):
+        self.app.config['COMPRESSION_LEVEL'] = 0
+        response = self.client.get('/', headers=gzip_headers)
+        assert 'Content-Encoding' not in response.headers
+
+    def test_streamed_response_compressed(self):
+        chunks = [b'<p>chunk</p>' * 100 for i in range(5)]
+        with self.app.test_request_context('/', headers=gzip_headers):
+            response = self.app.response_class(iter(chunks), mimetype='text/html')
+            response = self.app.process_response(response)
+
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert 'Content-Length' not in response.headers
+            assert gzip.decompress(b''.join(response.response)) == b''.join(chunks)
+
+    def test_conditional_response_still_not_modified(self):
+        post = get_mock_post().save()
+        client = self.app.test_client()
+        response = client.get('/post/{}/show'.format(post.id), headers=gzip_headers)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        response = client.get('/post/{}/show'.format(post.id),
+                                   headers={'if-none-match': response.headers['ETag'], **gzip_headers})
+        assert response.status_code == 304
+
+    #
+    # Static file tests.
+    #
+
+    @contextmanager
+    def precompressed_static_folder(self):
+        # precompressed copies aren't committed so serve a compressed copy of a static file
+        static_folder = self.app.static_folder
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'scripts'))
+            shutil.copy(os.path.join(static_folder, 'scripts', 'index.js'), os.path.join(directory, 'scripts'))
+            precompress_static_files(directory)
+            self.app.static_folder = directory
+            try:
+                yield directory
+            finally:
+                self.app.static_folder = static_folder
+
+    def test_precompressed_static_file(self):
+        with self.precompressed_static_folder() as directory:
+            with open(os.path.join(directory, 'scripts', 'index.js'), 'rb') as f:
+                data = f.read()
+
+            plain = self.client.get('/static/scripts/index.js')
+            assert 'Content-Encoding' not in plain.headers
+            assert plain.get_data() == data
+            plain.close()
+
+            response = self.client.get('/static/scripts/index.js', headers=gzip_headers)
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert response.mimetype == plain.mimetype
+            assert 'Accept-Encoding' in response.headers['Vary']
+            assert gzip.decompress(response.get_data()) == data
+            response.close()
+
+    def test_stale_precompressed_static_file(self):
+        with self.precompressed_static_folder() as directory:
+            # the file changes without being compressed again
+            path = os.path.join(directory, 'scripts', 'index.js')
+            with open(path, 'w') as f:
+                f.write('changed();\n' * 100)
+            modified = os.stat(path).st_mtime_ns + 1_000_000_000
+            os.utime(path, ns=(modified, modified))
+
+            response = self.client.get('/static/scripts/index.js', headers=gzip_headers)
+            assert response.get_data() == b'changed();\n' * 100
+            assert response.headers.get('Content-Encoding') != 'gzip'
+            response.close()
+
+            # and is sent compressed once it has been
+            precompress_static_files(directory)
+            response = self.client.get('/static/scripts/index.js', headers=gzip_headers)
+            assert response.headers['Content-Encoding'] == 'gzip'
+            response.close()
+
+    def test_static_file_without_precompressed_copy(self):
+        response = self.client.get('/static/apple-touch-icon.png', headers=gzip_headers)
+        assert response.status_code == 200
+        assert 'Content-Encoding' not in response.headers
+        response.close()
+
+    def test_missing_static_file(self):
+        response = self.client.get('/static/missing.js', headers=gzip_headers)
+        assert response.status_code == 404
+
+    def test_precompress_static_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'site.css'), 'w') as f:
+                f.write('body { margin: 0; }\n' * 50)
+            with open(os.path.join(directory, 'tiny.js'), 'w') as f:
+                f.write('1')
+            with open(os.path.join(directory, 'image.png'), 'wb') as f:
+                f.write(b'\0' * 1000)
+            with open(os.path.join(directory, 'removed.css.gz'), 'wb') as f:
+                f.write(b'')
+
+            written, removed = precompress_static_files(directory)
+            assert written == ['site.css.gz']
+            assert removed == ['removed.css.gz']
+            with open(os.path.join(directory, 'site.css.gz'), 'rb') as f:
+                assert gzip.decompress(f.read()) == b'body { margin: 0; }\n' * 50
+
+            # copies have their file's modified time (so they are sent in its place)
+            assert os.stat(os.path.join(directory, 'site.css.gz')).st_mtime_ns == \
+                os.stat(os.path.join(directory, 'site.css')).st_mtime_ns
+
+            # up to date copies are left alone
+            assert precompress_static_files(directory) == ([], [])
@@ -0,0 +1,77 @@
+from datetime import datetime
+from unittest import mock
+
+from benchmarks.fixtures import get_mock_comment, get_mock_post
+from tests.test_utils import TestBase
+from tiny.deletions import delete_post, delete_user, finish_deletions
+from tiny.jobs import run_jobs
+from tiny.models import Comment, Deletion, Job, Post, User
+
+class TestDeletions(TestBase):
+
+    def create_mock_content(self):
+        posts = [get_mock_post(author=self.user).save() for i in range(3)]
+        for post in posts:
+            for i in range(2):
+                get_mock_comment(post=post).save()
+        for i in range(3):
+            get_mock_comment(author=self.user).save()
+        return posts
+
+    def test_delete_user(self):
+        self.create_mock_content()
+        self.app.config['DELETION_BATCH_SIZE'] = 2
+        delete_user(self.user)
+        assert run_jobs() == 1
+
+        assert User.objects(id=self.user.id).count() == 0
+        assert Post.objects(author=self.user.id).count() == 0
+        assert Comment.objects(author=self.user.id).count() == 0
+
+        # ensure progress was recorded (the user's own comments and the comments on their posts)
+        deletion = Deletion.objects.first()
+        assert deletion.posts_deleted == 3
+        assert deletion.comments_deleted == 9
+        assert deletion.finished is not None
+
+    def test_delete_post(self):
+        posts = self.create_mock_content()
+        delete_post(posts[0])
+        assert run_jobs() == 1
+
+        assert Post.objects(id=posts[0].id).count() == 0
+        assert Comment.objects(post=posts[0].id).count() == 0
+        assert Post.objects.count() == 5
+
+        deletion = Deletion.objects.first()
+        assert deletion.posts_deleted == 1
+        assert deletion.comments_deleted == 2
+
+    def test_finish_interrupted_deletion(self):
+        self.create_mock_content()
+
+        # simulate a crash after the user's comments are deleted
+        delete_user(self.user)
+        with mock.patch('tiny.deletions.__purge_posts__', side_effect=RuntimeError):
+            run_jobs()
+
+        deletion = Deletion.objects.first()
+        assert deletion.finished is None
+        assert deletion.comments_deleted == 3
+        assert User.objects(id=self.user.id).count() == 1
+
+        assert finish_deletions(batch_size=2) == 1
+        assert User.objects(id=self.user.id).count() == 0
+        assert Post.objects(author=self.user.id).count() == 0
+
+        deletion.reload()
+        assert deletion.posts_deleted == 3
+        assert deletion.comments_deleted == 9
+        assert deletion.finished is not None
+
+        # ensure finished deletions aren't run again (e.g. when the job is retried)
+        assert finish_deletions() == 0
+        with mock.patch('tiny.deletions.purge') as mock_purge:
+            Job.objects.update(set__run_after=datetime.now())
+            run_jobs()
+            assert not mock_purge.called
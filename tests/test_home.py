@@ -1,3 +1,6 @@
+import json
+import os
+
 from tests.test_utils import TestBase
 
 class TestHome(TestBase):
@@ -9,3 +12,23 @@ class TestHome(TestBase):
     def test_index(self):
         response = self.client.get('/')
         assert response.status_code == 200
+
+    def test_built_assets(self):
+        # bundles are built (and added to the manifest) on first use when testing
+        html = self.client.get('/').get_data(as_text=True)
+        with open(os.path.join(self.app.static_folder, 'build', 'manifest.json')) as f:
+            versions = json.load(f)
+
+        for output, version in versions.items():
+            url = '/static/{}'.format(output % {'version': version})
+            assert url in html
+
+            response = self.client.get(url)
+            assert response.status_code == 200
+            assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+            response.close()
+
+    def test_other_static_files_not_immutable(self):
+        response = self.client.get('/static/favicon.ico')
+        assert 'immutable' not in response.headers['Cache-Control']
+        response.close()
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+from time import sleep
+from unittest import mock
+
+import pytest
+
+from tests.test_utils import TestBase
+from tiny.jobs import enqueue, get_queue_stats, lease_job, run_job, run_jobs, task, Worker
+from tiny.models import Job
+
+calls = []
+
+@task
+def record(value):
+    calls.append(value)
+
+@task
+def explode():
+    raise RuntimeError('boom')
+
+def not_a_task():
+    pass
+
+class TestJobs(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        calls.clear()
+
+    def make_ready(self, job):
+        Job.objects(id=job.id).update_one(set__run_after=datetime.now())
+
+    def test_enqueue_and_run(self):
+        enqueue(record, value=1)
+        enqueue(record, value=2)
+        assert run_jobs() == 2
+        assert calls == [1, 2]
+
+        for job in Job.objects:
+            assert job.status == 'done'
+            assert job.attempts == 1
+            assert job.started is not None
+            assert job.finished is not None
+            assert job.lease is None
+
+    def test_enqueue_unregistered(self):
+        with pytest.raises(ValueError):
+            enqueue(not_a_task)
+
+    def test_lease_hides_job(self):
+        enqueue(record, value=1)
+        job = lease_job()
+        assert job.status == 'running'
+        assert job.lease is not None
+
+        # ensure other workers can't lease the job while it is running
+        assert lease_job() is None
+
+    def test_expired_lease_released(self):
+        enqueue(record, value=1)
+        job = lease_job()
+
+        # simulate the worker dying and the lease timing out
+        self.make_ready(job)
+        released_job = lease_job()
+        assert released_job.id == job.id
+        assert released_job.attempts == 2
+        assert run_job(released_job)
+
+        # ensure the original worker can't finish the job once it has lost its lease
+        Job.objects(id=job.id).update_one(set__status='running')
+        run_job(job)
+        assert Job.objects(id=job.id).first().status == 'running'
+
+    def test_failed_job_retried_with_backoff(self):
+        self.app.config['JOB_RETRY_DELAY'] = 10
+        job = enqueue(explode)
+
+        before = datetime.now()
+        assert run_jobs() == 1
+        job.reload()
+        assert job.status == 'queued'
+        assert 'boom' in job.error
+        assert job.run_after >= before + timedelta(seconds=10)
+
+        # ensure the delay doubles each attempt
+        self.make_ready(job)
+        before = datetime.now()
+        run_jobs()
+        job.reload()
+        assert job.run_after >= before + timedelta(seconds=20)
+
+        # ensure the job isn't run again until it is ready
+        assert run_jobs() == 0
+
+    def test_failed_job_gives_up(self):
+        self.app.config['JOB_MAX_ATTEMPTS'] = 2
+        job = enqueue(explode)
+        for i in range(2):
+            self.make_ready(job)
+            run_jobs()
+
+        job.reload()
+        assert job.status == 'failed'
+        assert job.attempts == 2
+        self.make_ready(job)
+        assert run_jobs() == 0
+
+    def test_crashing_job_gives_up(self):
+        self.app.config['JOB_MAX_ATTEMPTS'] = 2
+        job = enqueue(record, value=1)
+
+        # simulate the job's worker dying on every attempt
+        for i in range(2):
+            lease_job()
+            self.make_ready(job)
+
+        assert not run_job(lease_job())
+        assert Job.objects(id=job.id).first().status == 'failed'
+        assert calls == []
+
+    def test_queue_stats(self):
+        enqueue(record, value=1)
+        enqueue(explode)
+        enqueue(record, value=2)
+        run_jobs(limit=2)
+
+        stats = get_queue_stats()
+        assert stats['done'] == 1
+        assert stats['queued'] == 2
+        assert stats['recently_done'] == 1
+        assert stats['mean_queue_seconds'] >= 0
+
+    def test_worker(self):
+        enqueue(record, value=1)
+        worker = Worker(self.app, threads=2, poll_interval=0.01)
+        worker.start()
+        for i in range(100):
+            if calls:
+                break
+            sleep(0.01)
+        worker.stop()
+        assert calls == [1]
+        assert Job.objects.first().status == 'done'
@@ -0,0 +1,143 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from types import SimpleNamespace
+
+from tests.test_utils import TestBase
+from config import Default
+from tiny import create_app
+from tiny.helpers import response_cache, user_cache
+from tiny.metrics import CommandMetrics, render_metrics, reset_metrics
+
+class TestMetrics(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        reset_metrics()
+
+    def write_metrics(self, directory, pid, rows, started=1):
+        with open(os.path.join(directory, 'metrics-{}-{}.json'.format(pid, started)), 'w') as f:
+            json.dump(rows, f)
+
+    def get_metrics(self):
+        response = self.client.get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        return response.get_data(as_text=True)
+
+    def test_request_metrics(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/post/latest', headers={'accept': 'application/json'})
+
+        metrics = self.get_metrics()
+        assert '# TYPE tiny_request_duration_seconds histogram' in metrics
+        assert 'tiny_request_duration_seconds_bucket{endpoint="home.index",le="+Inf"} 2' in metrics
+        assert 'tiny_request_duration_seconds_count{endpoint="home.index"} 2' in metrics
+        assert 'tiny_request_duration_seconds_count{endpoint="post.latest"} 1' in metrics
+        assert 'tiny_responses_total{endpoint="home.index",method="GET",status="200"} 2' in metrics
+
+    def test_not_found_metrics(self):
+        self.client.get('/missing')
+        assert 'tiny_responses_total{endpoint="none",method="GET",status="404"} 1' in self.get_metrics()
+
+    def test_mongo_command_metrics(self):
+        listener = CommandMetrics()
+        event = SimpleNamespace(command_name='find', duration_micros=1500)
+
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            listener.succeeded(event)
+            listener.failed(event)
+        listener.succeeded(event)
+
+        metrics = render_metrics()
+        assert 'tiny_mongo_commands_total{command="find",endpoint="home.index"} 2' in metrics
+        assert 'tiny_mongo_command_failures_total{command="find",endpoint="home.index"} 1' in metrics
+        assert 'tiny_mongo_command_duration_seconds_total{command="find",endpoint="home.index"} 0.003' in metrics
+        assert 'tiny_mongo_commands_total{command="find",endpoint="background"} 1' in metrics
+
+    def test_other_counters(self):
+        metrics = self.get_metrics()
+        assert 'tiny_jobs_total{status="completed"}' in metrics
+        assert 'tiny_password_requests_total{status="completed"}' in metrics
+        assert 'tiny_search_cache_requests_total{result="hit"}' in metrics
+
+    def test_cache_counters(self):
+        user_cache.clear()
+        response_cache.clear()
+        user_cache.get('missing')
+        user_cache.set('user', 'value')
+        user_cache.get('user')
+        response_cache.get('missing')
+
+        metrics = self.get_metrics()
+        assert 'tiny_user_cache_requests_total{result="hit"} 1' in metrics
+        assert 'tiny_user_cache_requests_total{result="miss"} 1' in metrics
+        assert 'tiny_user_cache_entries 1' in metrics
+        assert 'tiny_response_cache_requests_total{result="miss"} 1' in metrics
+
+    def test_metrics_added_up_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['METRICS_DIR'] = directory
+
+            # metrics written by another worker (that is still running)
+            labels = [['endpoint', 'home.index'], ['method', 'GET'], ['status', '200']]
+            self.write_metrics(directory, os.getppid(), [
+                ['tiny_responses_total', labels, 3],
+                ['tiny_request_duration_seconds', [['endpoint', 'home.index']], [1] * 11 + [0.5, 3]],
+                ['tiny_search_cache_entries', [], 7]
+            ])
+
+            self.client.get('/')
+
+            metrics = self.get_metrics()
+            assert 'tiny_responses_total{endpoint="home.index",method="GET",status="200"} 4' in metrics
+            assert 'tiny_request_duration_seconds_count{endpoint="home.index"} 4' in metrics
+            assert [filename for filename in os.listdir(directory)
+                    if filename.startswith('metrics-{}-'.format(os.getpid()))]
+
+            # gauges aren't added up but reported for each worker
+            assert 'tiny_search_cache_entries{{pid="{}"}} 7'.format(os.getppid()) in metrics
+            assert 'tiny_search_cache_entries{{pid="{}"}} 0'.format(os.getpid()) in metrics
+
+    def test_exited_workers_counters_kept(self):
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], stdout=subprocess.PIPE)
+        exited_pid = int(exited.stdout)
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['METRICS_DIR'] = directory
+            labels = [['endpoint', 'home.index'], ['method', 'GET'], ['status', '200']]
+            self.write_metrics(directory, exited_pid, [['tiny_responses_total', labels, 3],
+                                                       ['tiny_search_cache_entries', [], 7]])
+
+            self.client.get('/')
+
+            # the exited worker's counters are kept (once) but its file and gauges are gone
+            for i in range(2):
+                metrics = self.get_metrics()
+                assert 'tiny_responses_total{endpoint="home.index",method="GET",status="200"} 4' in metrics
+                assert 'pid="{}"'.format(exited_pid) not in metrics
+            assert not [filename for filename in os.listdir(directory)
+                        if filename.startswith('metrics-{}-'.format(exited_pid))]
+
+            # a new worker reusing the pid doesn't overwrite them
+            self.write_metrics(directory, exited_pid, [['tiny_responses_total', labels, 1]], started=2)
+            assert 'tiny_responses_total{endpoint="home.index",method="GET",status="200"} 5' in self.get_metrics()
+
+    def test_metrics_disabled(self, monkeypatch):
+        assert not Default.METRICS_ENABLED
+        monkeypatch.setenv('METRICS_ENABLED', 'false')
+        client = create_app(testing=True).test_client()
+        assert client.get('/metrics').status_code == 404
+
+    def test_metrics_token(self):
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        assert self.client.get('/metrics').status_code == 401
+        assert self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        assert response.status_code == 200
+        assert 'tiny_responses_total' in response.get_data(as_text=True)
@@ -0,0 +1,115 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from passlib.hash import sha256_crypt
+
+from benchmarks.fixtures import sign_out
+from config import Default
+from tests.test_utils import TestBase
+from tiny.passwords import get_stats, hash_password, PasswordPoolSaturated, verify_password
+
+# holds locks (as another worker would while hashing) for a number of seconds
+hold_script = '''
+import fcntl, sys, time
+lock_files = [open(path, 'a') for path in sys.argv[2:]]
+for lock_file in lock_files:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+print('locked', flush=True)
+time.sleep(float(sys.argv[1]))
+'''
+
+class TestPasswords(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.lock_dir = tempfile.TemporaryDirectory()
+        self.app.config['PASSWORD_LOCK_DIR'] = self.lock_dir.name
+        self.app.config['PASSWORD_POOL_SIZE'] = 1
+        self.app.config['PASSWORD_QUEUE_SIZE'] = 0
+
+    def teardown_method(self):
+        super().teardown_method()
+        self.lock_dir.cleanup()
+
+    @contextmanager
+    def hold_locks(self, *names, seconds=60):
+        paths = [os.path.join(self.lock_dir.name, '{}.lock'.format(name)) for name in names]
+        process = subprocess.Popen([sys.executable, '-c', hold_script, str(seconds)] + paths, stdout=subprocess.PIPE)
+        try:
+            assert process.stdout.readline() == b'locked\n'
+            yield process
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+
+    def test_hash_and_verify(self):
+        password_hash = hash_password('password')
+        assert sha256_crypt.verify('password', password_hash)
+        assert verify_password('password', password_hash)
+        assert not verify_password('wrong', password_hash)
+
+    def test_stats(self):
+        completed = get_stats()['completed']
+        verify_password('password', self.user.password)
+        stats = get_stats()
+        assert stats['completed'] == completed + 1
+        assert stats['in_flight'] == 0
+        assert stats['run_seconds'] > 0
+
+    def test_saturated(self):
+        rejected = get_stats()['rejected']
+
+        # another worker is hashing and nothing more can queue
+        with self.hold_locks('ticket-0', 'slot-0'):
+            try:
+                verify_password('password', self.user.password)
+                assert False
+            except PasswordPoolSaturated:
+                assert get_stats()['rejected'] == rejected + 1
+
+    def test_sign_in_saturated(self):
+        sign_out(self.client)
+        with self.hold_locks('ticket-0', 'slot-0'):
+            response = self.client.post('/user/sign-in', data={'email': self.email, 'password': self.password})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '5'
+
+    def test_timed_out(self):
+        self.app.config['PASSWORD_QUEUE_SIZE'] = 1
+        self.app.config['PASSWORD_TIMEOUT'] = 1
+        timed_out = get_stats()['timed_out']
+
+        # queued behind another worker that doesn't finish in time
+        with self.hold_locks('ticket-0', 'slot-0'):
+            try:
+                verify_password('password', self.user.password)
+                assert False
+            except PasswordPoolSaturated:
+                assert get_stats()['timed_out'] == timed_out + 1
+
+    def test_queued(self):
+        self.app.config['PASSWORD_QUEUE_SIZE'] = 1
+        queue_seconds = get_stats()['queue_seconds']
+
+        # queued behind another worker that finishes shortly
+        with self.hold_locks('ticket-0', 'slot-0', seconds=0.5):
+            assert verify_password('password', self.user.password)
+        assert get_stats()['queue_seconds'] > queue_seconds
+
+    def test_locks_released_when_worker_dies(self):
+        with self.hold_locks('ticket-0', 'slot-0') as process:
+            process.kill()
+            process.wait()
+            assert verify_password('password', self.user.password)
+
+    def test_defaults_leave_workers_free(self):
+        # waiting and hashing hold a web worker each, so some must be left over for other pages
+        with open(os.path.join(os.path.dirname(__file__), os.pardir, 'Procfile')) as f:
+            workers = int(re.search(r'--workers=(\d+)', f.read()).group(1))
+        assert Default.PASSWORD_POOL_SIZE + Default.PASSWORD_QUEUE_SIZE < workers
+        assert Default.PASSWORD_TIMEOUT < 10
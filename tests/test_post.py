@@ -1,7 +1,27 @@
 import json
-
-from tests.test_utils import get_mock_comment, get_mock_post, random_string, random_url, sign_out, TestBase
-from tiny.models import Comment, Post
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask import jsonify
+
+from benchmarks.fixtures import (get_mock_comment,
+                                 get_mock_post,
+                                 random_string,
+                                 random_url,
+                                 record_queries,
+                                 sign_in,
+                                 sign_out)
+from tests.test_utils import TestBase
+from tiny import create_app
+from tiny.blueprints.post import preview_budget
+from tiny.helpers import (get_comments,
+                          get_post,
+                          get_post_summaries_pipeline,
+                          markdown_to_html,
+                          markdown_version,
+                          serialize)
+from tiny.jobs import run_jobs
+from tiny.models import AuthorSnapshot, Comment, Job, Post, User
 
 class TestPost(TestBase):
 
@@ -19,10 +39,13 @@ class TestPost(TestBase):
         response = self.client.post('/post/create', data=data)
         post = Post.objects.first()
         assert post.author.id == self.user.id
+        assert post.author_snapshot == AuthorSnapshot.from_user(self.user)
         assert post.title == data['title']
         assert post.lead_paragraph == data['lead_paragraph']
         assert post.image_url == data['image_url']
         assert post.content == data['content']
+        assert post.content_html == markdown_to_html(data['content'])
+        assert post.content_html_version == markdown_version
         assert post.created is not None
         assert post.last_updated is None
 
@@ -121,6 +144,108 @@ class TestPost(TestBase):
         response = self.client.get('/post/{}/show'.format(str(post.id)))
         assert response.status_code == 200
 
+    def test_show_cached_for_anonymous_visitors(self):
+        sign_out(self.client)
+        post = get_mock_post().save()
+        self.client.get('/post/{}/show'.format(str(post.id)))
+        with mock.patch('tiny.helpers.get_post', wraps=get_post) as mock_get_post:
+            response = self.client.get('/post/{}/show'.format(str(post.id)))
+            assert not mock_get_post.called
+        assert post.title in response.get_data(as_text=True)
+        assert response.status_code == 200
+
+    def test_show_not_cached_when_signed_in(self):
+        post = get_mock_post().save()
+        self.client.get('/post/{}/show'.format(str(post.id)))
+        with mock.patch('tiny.helpers.get_post', wraps=get_post) as mock_get_post:
+            response = self.client.get('/post/{}/show'.format(str(post.id)))
+            assert mock_get_post.called
+        assert response.status_code == 200
+
+    def test_show_cache_invalidated_by_update(self):
+        post = get_mock_post(author=self.user).save()
+
+        # cache the post page for anonymous visitors
+        sign_out(self.client)
+        self.client.get('/post/{}/show'.format(str(post.id)))
+
+        # update the post
+        sign_in(self.client, self.email, self.password)
+        data = self.get_mock_post_data()
+        self.client.post('/post/{}/update'.format(str(post.id)), data=data)
+
+        # ensure anonymous visitors see the updated post
+        sign_out(self.client)
+        response = self.client.get('/post/{}/show'.format(str(post.id)))
+        assert data['title'] in response.get_data(as_text=True)
+
+    def test_show_not_modified(self):
+        post = get_mock_post().save()
+
+        # ensure pages showing flashed messages can't be reused
+        response = self.client.get('/post/{}/show'.format(str(post.id)))
+        assert 'ETag' not in response.headers
+
+        response = self.client.get('/post/{}/show'.format(str(post.id)))
+        etag = response.headers['ETag']
+        assert response.last_modified is not None
+
+        # ensure the page isn't sent again if nothing has changed
+        response = self.client.get('/post/{}/show'.format(str(post.id)), headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert not response.get_data()
+
+        # ensure the page is sent again once the post changes
+        post.last_updated = datetime.now() + timedelta(seconds=1)
+        post.save()
+        response = self.client.get('/post/{}/show'.format(str(post.id)), headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    def test_show_not_modified_for_anonymous_visitors(self):
+        sign_out(self.client)
+        post = get_mock_post().save()
+        etag = self.client.get('/post/{}/show'.format(str(post.id))).headers['ETag']
+
+        # ensure cached pages are conditional too
+        response = self.client.get('/post/{}/show'.format(str(post.id)), headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_conditional_responses_revalidated(self, monkeypatch):
+        # debug mode disables caching altogether
+        monkeypatch.setenv('DEBUG', 'false')
+        client = create_app(testing=True).test_client()
+        post = get_mock_post().save()
+
+        response = client.get('/post/latest')
+        assert response.cache_control.no_cache
+        assert not response.cache_control.private
+
+        # ensure pages that depend on the session aren't kept by shared caches (even once cached)
+        for i in range(2):
+            response = client.get('/post/{}/show'.format(str(post.id)))
+            assert response.cache_control.no_cache
+            assert response.cache_control.private
+            assert 'Cookie' in response.headers['Vary']
+
+    def test_show_stored_content_html(self):
+        post = get_mock_post()
+        post.content_html = '<p>stored</p>'
+        post.content_html_version = markdown_version
+        post.save()
+        response = self.client.get('/post/{}/show'.format(str(post.id)))
+        assert '<p>stored</p>' in response.get_data(as_text=True)
+
+    def test_show_stale_content_html(self):
+        post = get_mock_post()
+        post.content = '# Fresh'
+        post.content_html = '<p>stale</p>'
+        post.content_html_version = 'stale'
+        post.save()
+        response = self.client.get('/post/{}/show'.format(str(post.id)))
+        html = response.get_data(as_text=True)
+        assert '<h1>Fresh</h1>' in html
+        assert '<p>stale</p>' not in html
+
     #
     # Settings tests.
     #
@@ -160,6 +285,8 @@ class TestPost(TestBase):
         assert post.lead_paragraph == data['lead_paragraph']
         assert post.image_url == data['image_url']
         assert post.content == data['content']
+        assert post.content_html == markdown_to_html(data['content'])
+        assert post.content_html_version == markdown_version
         assert post.created is not None
         assert post.last_updated is not None
         assert response.status_code == 302
@@ -299,10 +426,24 @@ class TestPost(TestBase):
 
     def test_delete_success(self):
         post = get_mock_post(author=self.user).save()
+        get_mock_comment(post=post).save()
         response = self.client.post('/post/{}/delete'.format(str(post.id)))
+        assert run_jobs() == 1
         assert Post.objects(id=post.id).first() is None
+        assert Comment.objects(post=post.id).count() == 0
         assert response.status_code == 302
 
+    def test_delete_hides_post_straight_away(self):
+        post = get_mock_post(author=self.user).save()
+        self.client.post('/post/{}/delete'.format(str(post.id)))
+        assert Job.objects(status='queued').count() == 1
+
+        # ensure the post is hidden before it is deleted in the background
+        assert get_post(post_id=str(post.id)) is None
+        assert Post.objects(id=post.id).count() == 1
+        response = self.client.get('/post/latest')
+        assert json.loads(response.get_data(as_text=True)) == []
+
     #
     # Latest tests.
     #
@@ -328,6 +469,192 @@ class TestPost(TestBase):
 
         assert response.status_code == 200
 
+    def test_latest_cursor_success(self):
+        # create posts (some sharing a created date to check ties are paged correctly)
+        created = datetime(2019, 1, 1)
+        for i in range(16):
+            post = get_mock_post()
+            post.created = created - timedelta(days=i // 4)
+            post.save()
+
+        # page through all results by following the cursor
+        seen = []
+        cursor = ''
+        for expected in [6, 6, 4, 0]:
+            response = self.client.get('/post/latest?limit=6&cursor={}'.format(cursor))
+            assert response.status_code == 200
+
+            page = json.loads(response.get_data(as_text=True))
+            assert len(page['results']) == expected
+            seen.extend(post['id'] for post in page['results'])
+            cursor = page['cursor']
+
+        # ensure every post is returned exactly once and newest first
+        assert cursor is None
+        assert seen == [str(post.id) for post in Post.objects.order_by('-created', '-id')]
+
+    def test_latest_out_of_range(self):
+        for i in range(4):
+            get_mock_post().save()
+
+        # ensure out of range paging is kept in range rather than sent to mongo as is
+        response = self.client.get('/post/latest?limit=0&skip=-5')
+        assert response.status_code == 200
+        assert len(json.loads(response.get_data(as_text=True))) == 1
+
+        response = self.client.get('/post/latest?limit=-1')
+        assert response.status_code == 200
+        assert len(json.loads(response.get_data(as_text=True))) == 1
+
+        pipeline = get_post_summaries_pipeline({}, {'created': -1}, skip=-5, limit=1000)
+        assert not [stage for stage in pipeline if '$skip' in stage]
+        assert {'$limit': 100} in pipeline
+
+    def test_latest_summaries(self):
+        post = get_mock_post().save()
+        response = self.client.get('/post/latest')
+
+        # ensure posts are summarised with their author's public profile
+        summary = json.loads(response.get_data(as_text=True))[0]
+        assert summary['id'] == str(post.id)
+        assert summary['title'] == post.title
+        assert 'content' not in summary
+        assert summary['author'] == json.loads(jsonify(post.author.serialize()).get_data())
+
+    def test_latest_not_modified(self):
+        for i in range(4):
+            get_mock_post().save()
+
+        response = self.client.get('/post/latest')
+        etag = response.headers['ETag']
+
+        # ensure results aren't sent again if nothing has changed (or fetched with more than the one aggregation)
+        with record_queries() as queries:
+            response = self.client.get('/post/latest', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert len(queries) == 1
+        assert queries[0].startswith('post.aggregate(')
+
+        # ensure a different page of results isn't treated as the same
+        response = self.client.get('/post/latest?cursor=', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+        # ensure results are sent again once there is a new post
+        post = get_mock_post()
+        post.created = datetime.now() + timedelta(seconds=1)
+        post.save()
+        response = self.client.get('/post/latest', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    def test_latest_not_modified_after_author_update(self):
+        get_mock_post(author=self.user).save()
+        etag = self.client.get('/post/latest').headers['ETag']
+
+        # ensure results are sent again once their author's snapshot changes
+        self.client.post('/user/update-profile', data={'display_name': random_string(10),
+                                                       'avatar_url': random_url(),
+                                                       'bio': random_string(10)})
+        run_jobs()
+        response = self.client.get('/post/latest', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    def test_latest_without_last_modified(self):
+        posts = [get_mock_post().save() for i in range(3)]
+        response = self.client.get('/post/latest?limit=2')
+        etag = response.headers['ETag']
+
+        # the newest date of a page doesn't change when a post is removed from it so isn't used as a validator
+        assert 'Last-Modified' not in response.headers
+        response = self.client.get('/post/latest?limit=2',
+                                   headers={'If-Modified-Since': 'Wed, 01 Jan 2200 00:00:00 GMT'})
+        assert response.status_code == 200
+
+        # ensure results are sent again once a post drops off the page (and another slides in)
+        Post.objects(id=posts[1].id).update_one(set__deleted=True)
+        response = self.client.get('/post/latest?limit=2', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    @mock.patch('mongomock.database.Database.dereference')
+    def test_latest_authors_fetched_in_batch(self, mock_dereference):
+        # create posts by different authors
+        authors = {}
+        for i in range(4):
+            post = get_mock_post().save()
+            authors[str(post.id)] = post.author
+
+        response = self.client.get('/post/latest')
+        assert response.status_code == 200
+
+        # ensure authors weren't dereferenced one by one and private fields aren't exposed
+        posts = json.loads(response.get_data(as_text=True))
+        for post in posts:
+            assert post['author']['display_name'] == authors[post['id']].display_name
+            assert 'email' not in post['author']
+        assert not mock_dereference.called
+
+    def test_latest_authors_read_from_snapshots(self):
+        posts = [get_mock_post().save() for i in range(4)]
+
+        # remove the authors without cascading so they can only come from the snapshots
+        User._get_collection().delete_many({})  # pylint: disable=protected-access
+
+        response = self.client.get('/post/latest')
+        results = json.loads(response.get_data(as_text=True))
+        assert len(results) == 4
+        for post in posts:
+            snapshot = json.loads(jsonify(post.author_snapshot.serialize()).get_data())
+            assert snapshot in [result['author'] for result in results]
+
+    def test_latest_authors_without_snapshots(self):
+        posts = [get_mock_post().save() for i in range(4)]
+        Post._get_collection().update_many({}, {'$unset': {'author_snapshot': 1}})  # pylint: disable=protected-access
+
+        response = self.client.get('/post/latest')
+        results = {result['id']: result for result in json.loads(response.get_data(as_text=True))}
+        for post in posts:
+            assert results[str(post.id)]['author']['display_name'] == post.author.display_name
+
+    def test_latest_author_shape(self):
+        snapshotted_post = get_mock_post().save()
+        legacy_post = get_mock_post(author=snapshotted_post.author).save()
+        Post.objects(id=legacy_post.id).update_one(unset__author_snapshot=True)
+
+        # ensure authors look the same whether they come from a snapshot or not
+        response = self.client.get('/post/latest')
+        results = {result['id']: result for result in json.loads(response.get_data(as_text=True))}
+        assert results[str(snapshotted_post.id)]['author'] == results[str(legacy_post.id)]['author']
+        assert 'created' in results[str(snapshotted_post.id)]['author']
+
+    def test_latest_comment_counts(self):
+        post = get_mock_post().save()
+        for i in range(3):
+            self.client.post('/post/{}/comment'.format(str(post.id)), data={'text': random_string(10)})
+
+        response = self.client.get('/post/latest')
+        results = json.loads(response.get_data(as_text=True))
+        assert results[0]['comment_count'] == 3
+
+        # ensure clients can't reuse a response with stale comment counts
+        etag = response.headers['ETag']
+        self.client.post('/post/{}/comment'.format(str(post.id)), data={'text': random_string(10)})
+        response = self.client.get('/post/latest', headers={'If-None-Match': etag})
+        assert json.loads(response.get_data(as_text=True))[0]['comment_count'] == 4
+        assert response.status_code == 200
+
+    def test_latest_invalid_cursor(self):
+        for i in range(4):
+            get_mock_post().save()
+
+        # ensure a bad cursor isn't treated as the first page (so results aren't sent twice)
+        for cursor in ('invalid', 'bm90OmFuOmlk', '%ZZ'):
+            response = self.client.get('/post/latest?cursor={}'.format(cursor))
+            assert response.status_code == 400
+            assert not json.loads(response.get_data(as_text=True))['success']
+
+        response = self.client.get('/post/latest?cursor=')
+        assert len(json.loads(response.get_data(as_text=True))['results']) == 4
+        assert response.status_code == 200
+
     #
     # Get comments tests.
     #
@@ -359,6 +686,58 @@ class TestPost(TestBase):
 
         assert response.status_code == 200
 
+    @mock.patch('mongomock.database.Database.dereference')
+    def test_get_comments_authors_fetched_in_batch(self, mock_dereference):
+        # create post and comments
+        post = get_mock_post().save()
+        for i in range(4):
+            get_mock_comment(post=post).save()
+
+        response = self.client.get('/post/{}/comments'.format(str(post.id)))
+        assert response.status_code == 200
+
+        # ensure authors weren't dereferenced one by one
+        comments = json.loads(response.get_data(as_text=True))
+        assert all(comment['author']['display_name'] for comment in comments)
+        assert not mock_dereference.called
+
+    def test_get_comments_summaries_match_documents(self):
+        post = get_mock_post().save()
+        for i in range(3):
+            get_mock_comment(post=post).save()
+
+        response = self.client.get('/post/{}/comments'.format(str(post.id)))
+
+        # ensure summaries serialize the same as full documents
+        documents = get_comments(post_id=str(post.id), exclude=['post'], order_by=['created'])
+        assert json.loads(response.get_data(as_text=True)) == json.loads(jsonify(serialize(documents)).get_data())
+
+    def test_get_comments_cursor_success(self):
+        # create post and comments
+        post = get_mock_post().save()
+        for i in range(5):
+            get_mock_comment(post=post).save()
+
+        # get first page
+        response = self.client.get('/post/{}/comments?limit=3&cursor='.format(str(post.id)))
+        first_page = json.loads(response.get_data(as_text=True))
+        assert len(first_page['results']) == 3
+
+        # get second page
+        response = self.client.get('/post/{}/comments?limit=3&cursor={}'.format(str(post.id), first_page['cursor']))
+        second_page = json.loads(response.get_data(as_text=True))
+        assert len(second_page['results']) == 2
+
+        # ensure comments are returned oldest first
+        ids = [comment['id'] for comment in first_page['results'] + second_page['results']]
+        assert ids == [str(comment.id) for comment in Comment.objects(post=post).order_by('created', 'id')]
+
+    def test_get_comments_invalid_cursor(self):
+        post = get_mock_post().save()
+        get_mock_comment(post=post).save()
+        response = self.client.get('/post/{}/comments?cursor=invalid'.format(str(post.id)))
+        assert response.status_code == 400
+
     #
     # Create comment tests.
     #
@@ -370,6 +749,7 @@ class TestPost(TestBase):
         assert comment.post == post
         assert comment.text == data['text']
         assert comment.created is not None
+        assert Post.objects(id=post.id).first().comment_count == post.comment_count + 1
         assert response.status_code == 200
 
     def assert_create_comment_unsuccessful(self, post, data):
@@ -437,3 +817,58 @@ class TestPost(TestBase):
         html = json.loads(response.get_data(as_text=True))['html']
         assert html == '<h1>Hello</h1>\n'
         assert response.status_code == 200
+
+    def test_preview_matches_full_render(self):
+        content = '# Title\n\n- a\n- b\n\n- c\n\n```\ncode\n\nmore\n```\n\n> one\n\n> two\n\n    code'
+        response = self.client.post('/post/preview', data={'content': content})
+        html = json.loads(response.get_data(as_text=True))['html']
+        assert html == markdown_to_html(content)
+
+    def test_preview_html_matches_full_render(self):
+        for content in ('<div>\n\nhello\n\n</div>', '# Title\n\n<!--\n\nhidden\n\n-->\n\ntext'):
+            response = self.client.post('/post/preview', data={'content': content})
+            html = json.loads(response.get_data(as_text=True))['html']
+            assert html == markdown_to_html(content)
+
+    def test_preview_only_renders_changed_blocks(self):
+        self.client.post('/post/preview', data={'content': '# Hello\n\nfirst'})
+        with mock.patch('tiny.preview.markdown_to_html', wraps=markdown_to_html) as mock_markdown_to_html:
+            response = self.client.post('/post/preview', data={'content': '# Hello\n\nsecond'})
+            mock_markdown_to_html.assert_called_once_with('second')
+        html = json.loads(response.get_data(as_text=True))['html']
+        assert html == '<h1>Hello</h1>\n<p>second</p>\n'
+
+    def test_preview_content_too_long(self):
+        response = self.client.post('/post/preview', data={'content': random_string(10_001)})
+        assert response.status_code == 413
+
+    def test_preview_budget_exceeded(self):
+        preview_budget.clear()
+        self.app.config['PREVIEW_BUDGET'] = 100
+        response = self.client.post('/post/preview', data={'content': random_string(60)})
+        assert response.status_code == 200
+        response = self.client.post('/post/preview', data={'content': random_string(60)})
+        assert response.status_code == 429
+
+        # ensure signed in users have their own budget (rather than sharing their address's)
+        sign_out(self.client)
+        response = self.client.post('/post/preview', data={'content': random_string(60)})
+        assert response.status_code == 200
+
+    def test_preview_budget_per_forwarded_client(self, monkeypatch):
+        monkeypatch.setenv('PROXY_COUNT', '1')
+        app = create_app(testing=True)
+        client = app.test_client()
+        preview_budget.clear()
+        app.config['PREVIEW_BUDGET'] = 100
+
+        # clients behind the same proxy are told apart by the address it forwards
+        for address in ('10.0.0.1', '10.0.0.2'):
+            response = client.post('/post/preview',
+                                   data={'content': random_string(60)},
+                                   headers={'X-Forwarded-For': address})
+            assert response.status_code == 200
+        response = client.post('/post/preview',
+                               data={'content': random_string(60)},
+                               headers={'X-Forwarded-For': '10.0.0.1'})
+        assert response.status_code == 429
@@ -1,7 +1,20 @@
 import json
+from threading import enumerate as enumerate_threads, Event
 from unittest import mock
 
-from tests.test_utils import get_mock_post, TestBase
+from benchmarks.fixtures import get_mock_post, random_url
+from tests.test_utils import TestBase
+from tiny.helpers import get_post_summaries
+from tiny.models import Post
+from tiny.search_backends import (backends,
+                                  BM25Backend,
+                                  get_cache_stats,
+                                  get_search_backend,
+                                  MongoTextBackend,
+                                  normalize_query,
+                                  search_cache,
+                                  tokenize)
+from tiny.suggestions import suggestion_index
 
 class TestSearch(TestBase):
 
@@ -15,19 +28,17 @@ class TestSearch(TestBase):
         assert not posts
         assert response.status_code == 200
 
-    @mock.patch('tiny.blueprints.search.search_posts')
-    def test_search_success(self, mock_search_posts):
+    @mock.patch('tiny.blueprints.search.search_post_summaries')
+    def test_search_success(self, mock_search_post_summaries):
         term = 'python'
 
         # create posts containing search term
-        mocked_posts = []
         for i in range(4):
             post = get_mock_post()
             post.content = term
             post.save()
-            mocked_posts.append(post)
 
-        mock_search_posts.return_value = mocked_posts
+        mock_search_post_summaries.return_value = get_post_summaries()
 
         # create other posts
         for i in range(6):
@@ -40,3 +51,350 @@ class TestSearch(TestBase):
         # ensure only posts containing specified term are returned
         posts = json.loads(response.get_data(as_text=True))
         assert len(posts) == 4
+
+    def test_default_backend(self):
+        assert isinstance(get_search_backend(), MongoTextBackend)
+
+class TestBM25Search(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.app.config['SEARCH_BACKEND'] = 'bm25'
+        backends.clear()
+        search_cache.clear()
+
+    def teardown_method(self):
+        super().teardown_method()
+        backends.clear()
+        search_cache.clear()
+
+    def search(self, terms, skip=0, limit=12):
+        response = self.client.get('/search?terms={}&skip={}&limit={}'.format(terms, skip, limit),
+                                   headers={'accept': 'application/json'})
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def test_tokenize(self):
+        assert tokenize('The Posts of a Python class') == ['post', 'python', 'class']
+        assert tokenize(None) == []
+
+    def test_backend(self):
+        assert isinstance(get_search_backend(), BM25Backend)
+
+    def test_search(self):
+        matches = []
+        for i in range(3):
+            post = get_mock_post()
+            post.content = 'learning python'
+            matches.append(str(post.save().id))
+        for i in range(5):
+            get_mock_post().save()
+
+        posts = self.search('python')
+        assert sorted(post['id'] for post in posts) == sorted(matches)
+
+    def test_search_field_weights(self):
+        in_content = get_mock_post()
+        in_content.content = 'python'
+        in_content.save()
+        in_title = get_mock_post()
+        in_title.title = 'python'
+        in_title.save()
+        in_lead_paragraph = get_mock_post()
+        in_lead_paragraph.lead_paragraph = 'python'
+        in_lead_paragraph.save()
+
+        # matches in the title rank above the lead paragraph, which rank above the content
+        posts = self.search('python')
+        assert [post['id'] for post in posts] == [str(in_title.id), str(in_lead_paragraph.id), str(in_content.id)]
+
+    def test_search_pagination(self):
+        for i in range(5):
+            post = get_mock_post()
+            post.content = 'python'
+            post.save()
+
+        first = self.search('python', limit=3)
+        second = self.search('python', skip=3, limit=3)
+        assert len(first) == 3
+        assert len(second) == 2
+        assert not {post['id'] for post in first} & {post['id'] for post in second}
+
+    def test_index_updated_on_create_update_and_delete(self):
+        # build the index before the post exists
+        assert not self.search('python')
+
+        data = {'title': 'python', 'lead_paragraph': '', 'image_url': random_url(), 'content': 'content'}
+        self.client.post('/post/create', data=data)
+        post = Post.objects.first()
+        assert [result['id'] for result in self.search('python')] == [str(post.id)]
+
+        data['title'] = 'rust'
+        self.client.post('/post/{}/update'.format(str(post.id)), data=data)
+        assert not self.search('python')
+        assert [result['id'] for result in self.search('rust')] == [str(post.id)]
+
+        self.client.post('/post/{}/delete'.format(str(post.id)))
+        assert not self.search('rust')
+
+    def test_remove_post_keeps_shared_terms(self):
+        posts = []
+        for content in ('python rust', 'python'):
+            post = get_mock_post()
+            post.content = content
+            posts.append(post.save())
+
+        backend = get_search_backend()
+        backend.remove_post(posts[0].id)
+        assert backend.rank('python') == [posts[1].id]
+        assert not backend.rank('rust')
+
+        # removing a post that isn't indexed changes nothing
+        backend.remove_post(posts[0].id)
+        assert backend.rank('python') == [posts[1].id]
+
+    def test_search_skips_posts_deleted_elsewhere(self):
+        post = get_mock_post()
+        post.content = 'python'
+        post.save()
+        assert len(self.search('python')) == 1
+
+        # e.g. deleted by another process, so this process's index is stale
+        Post.objects(id=post.id).update_one(set__deleted=True)
+        assert not get_search_backend().search_post_summaries('python')
+        assert not get_search_backend().rank('python')
+
+    def test_stale_index_rebuilt_in_background(self):
+        posts = []
+        for content in ('python', 'python rust'):
+            post = get_mock_post()
+            post.content = content
+            posts.append(post.save())
+        backend = get_search_backend()
+        assert backend.rank('rust') == [posts[1].id]
+
+        # another process creates a post and the index goes stale
+        post = get_mock_post()
+        post.content = 'rust'
+        post.save()
+        backend.ttl = 0
+
+        # hold the rebuild up so the old index is still being searched
+        objects = Post.objects
+        rebuilding = Event()
+        release = Event()
+
+        def held_objects(*args, **kwargs):
+            rebuilding.set()
+            release.wait(5)
+            return objects(*args, **kwargs)
+
+        with mock.patch('tiny.search_backends.Post') as mock_post:
+            mock_post.objects.side_effect = held_objects
+            assert backend.rank('rust') == [posts[1].id]
+            assert rebuilding.wait(5)
+
+            # changes made while rebuilding are kept once the new index is swapped in
+            backend.remove_post(posts[1].id)
+            assert backend.rank('python') == [posts[0].id]
+            release.set()
+            for thread in enumerate_threads():
+                if thread.name == 'tiny-search-index':
+                    thread.join(5)
+
+        backend.ttl = 300
+        assert backend.rank('rust') == [post.id]
+
+class TestSearchCache(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        search_cache.clear()
+
+    def teardown_method(self):
+        super().teardown_method()
+        search_cache.clear()
+
+    def search(self, terms, skip=0, limit=12):
+        response = self.client.get('/search?terms={}&skip={}&limit={}'.format(terms, skip, limit),
+                                   headers={'accept': 'application/json'})
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def test_normalize_query(self):
+        assert normalize_query('Python Posts') == normalize_query('the post  python')
+        assert normalize_query('python -java') == ('-java', 'python')
+        assert normalize_query('"Hello World" python') == ('"hello world"', 'python')
+        assert normalize_query('python java') != normalize_query('python -java')
+
+    @mock.patch.object(MongoTextBackend, 'search_post_summaries')
+    def test_results_cached(self, mock_search_post_summaries):
+        mock_search_post_summaries.return_value = []
+
+        self.search('Python posts')
+        self.search('the post python')
+        assert mock_search_post_summaries.call_count == 1
+
+        # other pages are cached separately
+        self.search('python posts', skip=12)
+        assert mock_search_post_summaries.call_count == 2
+
+        stats = get_cache_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['hit_ratio'] == 1 / 3
+        assert stats['entries'] == 2
+
+    @mock.patch.object(MongoTextBackend, 'search_post_summaries')
+    def test_create_expires_matching_searches(self, mock_search_post_summaries):
+        mock_search_post_summaries.return_value = []
+        self.search('python')
+        self.search('rust')
+
+        data = {'title': 'python', 'lead_paragraph': '', 'image_url': random_url(), 'content': 'content'}
+        self.client.post('/post/create', data=data)
+
+        assert ('mongo', ('python',), 0, 12) not in search_cache
+        assert ('mongo', ('rust',), 0, 12) in search_cache
+
+    @mock.patch.object(MongoTextBackend, 'search_post_summaries')
+    def test_update_expires_old_and_new_searches(self, mock_search_post_summaries):
+        mock_search_post_summaries.return_value = []
+        post = get_mock_post(author=self.user)
+        post.title = 'python'
+        post.save()
+        for terms in ('python', 'rust', 'go'):
+            self.search(terms)
+
+        data = {'title': 'rust', 'lead_paragraph': '', 'image_url': random_url(), 'content': 'content'}
+        self.client.post('/post/{}/update'.format(str(post.id)), data=data)
+
+        assert ('mongo', ('python',), 0, 12) not in search_cache
+        assert ('mongo', ('rust',), 0, 12) not in search_cache
+        assert ('mongo', ('go',), 0, 12) in search_cache
+
+    @mock.patch.object(MongoTextBackend, 'search_post_summaries')
+    def test_delete_expires_searches_that_found_post(self, mock_search_post_summaries):
+        post = get_mock_post(author=self.user).save()
+        mock_search_post_summaries.return_value = get_post_summaries()
+
+        # every page of a search that found the post is expired
+        self.search('something', limit=1)
+        self.search('something', skip=1, limit=1)
+        self.client.post('/post/{}/delete'.format(str(post.id)))
+
+        assert not search_cache.items()
+
+    @mock.patch.object(MongoTextBackend, 'search_post_summaries')
+    def test_delete_user_expires_searches_that_found_their_posts(self, mock_search_post_summaries):
+        get_mock_post(author=self.user).save()
+        mock_search_post_summaries.return_value = get_post_summaries()
+        self.search('something')
+
+        self.client.post('/user/delete')
+
+        assert not search_cache.items()
+
+class TestSuggest(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        suggestion_index.clear()
+
+    def teardown_method(self):
+        super().teardown_method()
+        suggestion_index.clear()
+
+    def suggest(self, prefix, limit=8):
+        response = self.client.get('/search/suggest?prefix={}&limit={}'.format(prefix, limit))
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def create_post(self, title, lead_paragraph=''):
+        post = get_mock_post(author=self.user)
+        post.title = title
+        post.lead_paragraph = lead_paragraph
+        return post.save()
+
+    def test_no_prefix(self):
+        self.create_post('Python')
+        assert self.suggest('') == []
+        assert self.suggest('  ') == []
+
+    def test_suggest_titles_and_terms(self):
+        self.create_post('Learning Python', 'Python for beginners')
+        self.create_post('Pythons of the world', 'About snakes')
+        self.create_post('Pythons')
+        self.create_post('Rust')
+
+        # most common first, then shortest
+        assert self.suggest('pyt') == ['pythons', 'python', 'Pythons of the world']
+        assert self.suggest('PYTHONS OF') == ['Pythons of the world']
+        assert self.suggest('pyt', limit=1) == ['pythons']
+        assert self.suggest('java') == []
+
+    def test_suggest_completes_last_word(self):
+        self.create_post('Learning Python')
+        self.create_post('Pythons')
+        assert self.suggest('learning pyt') == ['Learning Python', 'learning pythons']
+        assert self.suggest('learning pyt', limit=1) == ['Learning Python']
+        assert self.suggest('learn pyt') == ['learn python', 'learn pythons']
+
+    def test_suggest_without_database(self):
+        self.create_post('Python')
+        assert self.suggest('pyt') == ['Python']
+
+        # once built, suggestions are answered from memory
+        with mock.patch.object(Post, 'objects') as mock_objects:
+            assert self.suggest('pyt') == ['Python']
+            assert not mock_objects.called
+
+    def test_index_updated_on_create_update_and_delete(self):
+        # build the index before the post exists
+        assert self.suggest('pyt') == []
+
+        data = {'title': 'Python', 'lead_paragraph': '', 'image_url': random_url(), 'content': 'content'}
+        self.client.post('/post/create', data=data)
+        post = Post.objects.first()
+        assert self.suggest('pyt') == ['Python']
+
+        data['title'] = 'Rust'
+        self.client.post('/post/{}/update'.format(str(post.id)), data=data)
+        assert self.suggest('pyt') == []
+        assert self.suggest('ru') == ['Rust']
+
+        self.client.post('/post/{}/delete'.format(str(post.id)))
+        assert self.suggest('ru') == []
+
+    def test_stale_index_rebuilt_in_background(self):
+        python = self.create_post('Python')
+        assert self.suggest('pyt') == ['Python']
+
+        # another process creates a post and the index goes stale
+        self.create_post('Pytest')
+        self.app.config['SEARCH_INDEX_TTL'] = 0
+
+        # hold the rebuild up so the old index is still being served
+        objects = Post.objects
+        rebuilding = Event()
+        release = Event()
+
+        def held_objects(*args, **kwargs):
+            rebuilding.set()
+            release.wait(5)
+            return objects(*args, **kwargs)
+
+        with mock.patch('tiny.suggestions.Post') as mock_post:
+            mock_post.objects.side_effect = held_objects
+            assert self.suggest('pyt') == ['Python']
+            assert rebuilding.wait(5)
+
+            # changes made while rebuilding are kept once the new index is swapped in
+            suggestion_index.remove_post(python.id)
+            release.set()
+            for thread in enumerate_threads():
+                if thread.name == 'tiny-suggestions':
+                    thread.join(5)
+
+        self.app.config['SEARCH_INDEX_TTL'] = 300
+        assert self.suggest('pyt') == ['Pytest']
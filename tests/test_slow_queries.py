@@ -0,0 +1,142 @@
+from threading import current_thread
+from types import SimpleNamespace
+from unittest import mock
+
+from bson.objectid import ObjectId
+
+from tests.test_utils import TestBase
+from tiny.models import SlowQuery
+from tiny.slow_queries import get_shape, reset_slow_queries, SlowQueryRecorder, wait_for_slow_queries
+
+def get_mock_event(request_id, command, duration=150):
+    command_name = next(iter(command))
+    return SimpleNamespace(request_id=request_id,
+                           command_name=command_name,
+                           command=command,
+                           database_name='tiny',
+                           duration_micros=duration * 1000)
+
+def get_find_command(author_id):
+    return {'find': 'post',
+            'filter': {'author': author_id, 'deleted': {'$ne': True}},
+            'sort': {'created': -1},
+            'limit': 10,
+            'lsid': {'id': 'session'},
+            '$db': 'tiny'}
+
+class TestSlowQueries(TestBase):
+
+    def setup_method(self):
+        super().setup_method()
+        reset_slow_queries()
+        self.listener = SlowQueryRecorder()
+
+    def run_command(self, request_id, command, duration=150, failed=False):
+        event = get_mock_event(request_id, command, duration)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            self.listener.started(event)
+            if failed:
+                self.listener.failed(event)
+            else:
+                self.listener.succeeded(event)
+        wait_for_slow_queries()
+
+    #
+    # Shape tests.
+    #
+
+    def test_shape_redacts_literals(self):
+        shape = get_shape('find', get_find_command(ObjectId()))
+        assert shape == 'post.find {"filter": {"author": "?", "deleted": {"$ne": "?"}}, ' \
+                        '"sort": {"created": -1}, "limit": 10}'
+
+    def test_shape_same_for_different_literals(self):
+        assert get_shape('find', get_find_command(ObjectId())) == get_shape('find', get_find_command(ObjectId()))
+
+    def test_shape_of_aggregate(self):
+        command = {'aggregate': 'comment',
+                   'pipeline': [{'$match': {'post': {'$in': [ObjectId(), ObjectId(), ObjectId()]}}},
+                                {'$group': {'_id': '$post', 'count': {'$sum': 1}}},
+                                {'$limit': 5}],
+                   'cursor': {}}
+        shape = get_shape('aggregate', command)
+        assert shape == 'comment.aggregate {"pipeline": [{"$match": {"post": {"$in": ["?"]}}}, ' \
+                        '{"$group": {"_id": "$post", "count": {"$sum": "?"}}}, {"$limit": 5}]}'
+
+    #
+    # Recorder tests.
+    #
+
+    @mock.patch('tiny.slow_queries.__explain__', return_value='LIMIT > FETCH > IXSCAN (author_1_created_-1)')
+    def test_records_slow_query(self, _):
+        self.run_command(1, get_find_command(ObjectId()))
+
+        slow_query = SlowQuery.objects.get()
+        assert slow_query.shape == get_shape('find', get_find_command(ObjectId()))
+        assert slow_query.command_name == 'find'
+        assert slow_query.collection == 'post'
+        assert slow_query.endpoint == 'home.index'
+        assert slow_query.duration == 150
+        assert slow_query.plan == 'LIMIT > FETCH > IXSCAN (author_1_created_-1)'
+
+    @mock.patch('tiny.slow_queries.__explain__')
+    def test_ignores_fast_queries(self, mock_explain):
+        self.run_command(1, get_find_command(ObjectId()), duration=50)
+        assert SlowQuery.objects.count() == 0
+        mock_explain.assert_not_called()
+
+    @mock.patch('tiny.slow_queries.__explain__')
+    def test_ignores_failed_queries(self, _):
+        self.run_command(1, get_find_command(ObjectId()), failed=True)
+        assert SlowQuery.objects.count() == 0
+
+    @mock.patch('tiny.slow_queries.__explain__')
+    def test_ignores_other_commands(self, _):
+        self.run_command(1, {'insert': 'post', 'documents': [{'title': 'slow'}]})
+        self.run_command(2, {'find': 'slow_query', 'filter': {}})
+        assert SlowQuery.objects.count() == 0
+
+    @mock.patch('tiny.slow_queries.__explain__')
+    def test_disabled(self, _):
+        self.app.config['SLOW_QUERY_THRESHOLD'] = 0
+        self.run_command(1, get_find_command(ObjectId()), duration=5000)
+        assert SlowQuery.objects.count() == 0
+
+    @mock.patch('tiny.slow_queries.__explain__', return_value='COLLSCAN')
+    def test_explain_rate_limited(self, mock_explain):
+        for i in range(3):
+            self.run_command(i, get_find_command(ObjectId()))
+        self.run_command(3, {'find': 'user', 'filter': {'email': 'someone@example.com'}})
+
+        assert mock_explain.call_count == 2
+        assert SlowQuery.objects(collection='post', plan='COLLSCAN').count() == 1
+        assert SlowQuery.objects(collection='post', plan=None).count() == 2
+        assert SlowQuery.objects(collection='user', plan='COLLSCAN').count() == 1
+
+        # explained again once the interval has passed
+        self.app.config['EXPLAIN_INTERVAL'] = 0
+        self.run_command(4, get_find_command(ObjectId()))
+        assert mock_explain.call_count == 3
+
+    @mock.patch('tiny.slow_queries.__explain__', side_effect=Exception('explain failed'))
+    def test_recorded_when_explain_fails(self, _):
+        self.run_command(1, get_find_command(ObjectId()))
+        assert SlowQuery.objects.get().plan is None
+
+    def test_recorded_in_background(self):
+        event = get_mock_event(1, get_find_command(ObjectId()))
+        with mock.patch('tiny.slow_queries.__explain__', return_value=None), self.app.app_context():
+            self.listener.started(event)
+            self.listener.succeeded(event)
+            wait_for_slow_queries()
+        assert SlowQuery.objects.get().endpoint == 'background'
+
+    def test_recorded_off_request_thread(self):
+        # the request only queues the query, leaving it to be explained and saved on the recording thread
+        threads = []
+        def record(*args):
+            threads.append(current_thread().name)
+        with mock.patch('tiny.slow_queries.__record__', side_effect=record):
+            self.run_command(1, get_find_command(ObjectId()))
+        assert threads == ['tiny-slow-queries']
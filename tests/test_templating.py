@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+from benchmarks.fixtures import get_mock_post
+from tests.test_utils import TestBase
+from tiny import create_app
+from tiny.templating import warm_templates
+
+def count_templates(app):
+    return len([name for name in app.jinja_env.list_templates() if name.endswith('.html')])
+
+class TestTemplating(TestBase):
+
+    def test_warm_templates(self):
+        assert warm_templates(self.app) == count_templates(self.app)
+        assert 'post/show.html' in self.app.jinja_env.list_templates()
+
+    def test_templates_cached_on_warmup(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as directory:
+            monkeypatch.setenv('TEMPLATE_CACHE_DIR', directory)
+            app = create_app(testing=True)
+            assert len(os.listdir(directory)) == count_templates(app)
+
+    def test_templates_cached_on_first_use(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as directory:
+            monkeypatch.setenv('TEMPLATE_CACHE_DIR', directory)
+            monkeypatch.setenv('TEMPLATE_WARMUP', 'false')
+            app = create_app(testing=True)
+            assert not os.listdir(directory)
+
+            post = get_mock_post().save()
+            assert app.test_client().get('/post/{}/show'.format(post.id)).status_code == 200
+            assert os.listdir(directory)
+
+            # another process's app renders from the cache
+            other_app = create_app(testing=True)
+            assert other_app.test_client().get('/post/{}/show'.format(post.id)).status_code == 200
@@ -1,9 +1,21 @@
 import json
+from unittest import mock
 
+from flask import jsonify
 from passlib.hash import sha256_crypt
 
-from tests.test_utils import get_mock_post, random_email, random_string, random_url, sign_out, TestBase
-from tiny.models import User
+from benchmarks.fixtures import (get_mock_comment,
+                                 get_mock_post,
+                                 random_email,
+                                 random_string,
+                                 random_url,
+                                 sign_in,
+                                 sign_out)
+from tests.test_utils import TestBase
+from tiny.helpers import get_comments, get_posts, get_user, response_cache, serialize, user_cache
+from tiny.jobs import run_jobs
+from tiny.models import AuthorSnapshot, Comment, Job, Post, User
+from tiny.snapshots import fan_out_author_snapshot
 
 class TestUser(TestBase):
 
@@ -205,6 +217,13 @@ class TestUser(TestBase):
         response = self.client.get('/user/{}/show'.format(str(self.user.id)))
         assert response.status_code == 200
 
+    def test_show_cached(self):
+        sign_out(self.client)
+        first = self.client.get('/user/{}/show'.format(str(self.user.id)))
+        second = self.client.get('/user/{}/show'.format(str(self.user.id)))
+        assert second.status_code == 200
+        assert second.get_data() == first.get_data()
+
     #
     # Settings tests.
     #
@@ -229,6 +248,7 @@ class TestUser(TestBase):
 
     def assert_update_profile_successful(self, data):
         response = self.client.post('/user/update-profile', data=data)
+        assert str(self.user.id) not in user_cache
         user = User.objects(email=self.email).first()
         assert user.display_name == data['display_name']
         assert user.avatar_url == data['avatar_url']
@@ -292,6 +312,60 @@ class TestUser(TestBase):
         data = self.get_mock_update_profile_data()
         self.assert_update_profile_successful(data=data)
 
+    def test_update_profile_invalidates_cached_responses(self):
+        post = get_mock_post(author=self.user).save()
+
+        # cache the profile and post pages for anonymous visitors
+        sign_out(self.client)
+        self.client.get('/user/{}/show'.format(str(self.user.id)))
+        self.client.get('/post/{}/show'.format(str(post.id)))
+        assert ('user.show', str(self.user.id)) in response_cache
+        assert ('post.show', str(post.id)) in response_cache
+
+        # update the profile
+        sign_in(self.client, self.email, self.password)
+        data = self.get_mock_update_profile_data()
+        self.client.post('/user/update-profile', data=data)
+        run_jobs()
+
+        # ensure anonymous visitors see the updated profile
+        sign_out(self.client)
+        for url in ['/user/{}/show'.format(str(self.user.id)), '/post/{}/show'.format(str(post.id))]:
+            response = self.client.get(url)
+            assert data['display_name'] in response.get_data(as_text=True)
+
+    @mock.patch('tiny.blueprints.user.fan_out_author_snapshot')
+    def test_update_profile_fans_out_snapshot(self, mock_fan_out):
+        data = self.get_mock_update_profile_data()
+        self.client.post('/user/update-profile', data=data)
+        mock_fan_out.assert_called_once()
+
+    @mock.patch('tiny.blueprints.user.fan_out_author_snapshot')
+    def test_update_profile_unchanged_skips_fan_out(self, mock_fan_out):
+        data = {'display_name': self.user.display_name, 'avatar_url': self.user.avatar_url, 'bio': self.user.bio}
+        self.client.post('/user/update-profile', data=data)
+        mock_fan_out.assert_not_called()
+
+    def test_fan_out_author_snapshot(self):
+        posts = [get_mock_post(author=self.user).save() for i in range(3)]
+        comments = [get_mock_comment(author=self.user, post=posts[0]).save() for i in range(3)]
+        other_post = get_mock_post().save()
+
+        self.user.display_name = random_string(10)
+        self.user.avatar_url = random_url()
+        self.user.save()
+
+        self.app.config['SNAPSHOT_BATCH_SIZE'] = 2
+        fan_out_author_snapshot(self.user)
+        assert run_jobs() == 1
+
+        # ensure every post and comment by the user has the new snapshot (and no others were touched)
+        snapshot = AuthorSnapshot.from_user(self.user)
+        for document in [Post.objects(id=post.id).first() for post in posts] + \
+                        [Comment.objects(id=comment.id).first() for comment in comments]:
+            assert document.author_snapshot == snapshot
+        assert Post.objects(id=other_post.id).first().author_snapshot == other_post.author_snapshot
+
     #
     # Update password tests.
     #
@@ -304,6 +378,7 @@ class TestUser(TestBase):
 
     def assert_update_password_successful(self, data):
         response = self.client.post('/user/update-password', data=data)
+        assert str(self.user.id) not in user_cache
         user = User.objects(email=self.email).first()
         assert not sha256_crypt.verify(data['current_password'], user.password)
         assert sha256_crypt.verify(data['new_password'], user.password)
@@ -383,10 +458,70 @@ class TestUser(TestBase):
         assert response.status_code == 200
 
     def test_delete_success(self):
+        post = get_mock_post(author=self.user).save()
+        get_mock_comment(author=self.user).save()
+        get_mock_comment(post=post).save()
+
         response = self.client.post('/user/delete')
-        assert User.objects.count() == 0
+        assert run_jobs() == 1
+        assert User.objects(id=self.user.id).count() == 0
+        assert Post.objects(author=self.user.id).count() == 0
+        assert Comment.objects(author=self.user.id).count() == 0
+        assert Comment.objects(post=post.id).count() == 0
+        assert str(self.user.id) not in user_cache
         assert response.status_code == 302
 
+    def test_delete_hides_user_straight_away(self):
+        post = get_mock_post(author=self.user).save()
+        comment = get_mock_comment(author=self.user).save()
+
+        self.client.post('/user/delete')
+        assert Job.objects(status='queued').count() == 1
+
+        # ensure everything is hidden before it is deleted in the background
+        assert get_user(user_id=str(self.user.id)) is None
+        assert get_posts(user_id=str(self.user.id)).count() == 0
+        assert get_comments(post_id=str(comment.post.id)).count() == 0
+        assert User.objects(id=self.user.id).count() == 1
+        assert Post.objects(id=post.id).count() == 1
+
+        # ensure the email can't be reused until the user is gone
+        sign_out(self.client)
+        data = {'email': self.email,
+                'display_name': random_string(10),
+                'password': self.password,
+                'confirmation': self.password}
+        response = self.client.post('/user/sign-up', data=data)
+        assert response.status_code == 400
+
+    def test_delete_decrements_comment_counts(self):
+        post = get_mock_post().save()
+        for i in range(3):
+            get_mock_comment(author=self.user if i < 2 else None, post=post).save()
+        Post.objects(id=post.id).update_one(set__comment_count=3)
+
+        self.client.post('/user/delete')
+        assert Post.objects(id=post.id).first().comment_count == 1
+        assert get_comments(post_id=str(post.id)).count() == 1
+
+    #
+    # Current user tests.
+    #
+
+    def test_current_user_cached(self):
+        self.client.get('/user/settings')
+        with mock.patch('tiny.helpers.get_user', wraps=get_user) as mock_get_user:
+            response = self.client.get('/user/settings')
+            assert not mock_get_user.called
+        assert response.status_code == 200
+
+    def test_current_user_not_looked_up_when_signed_out(self):
+        sign_out(self.client)
+        with mock.patch('tiny.helpers.get_user', wraps=get_user) as mock_get_user:
+            response = self.client.get('/user/sign-in')
+            assert not mock_get_user.called
+        assert response.status_code == 200
+
     #
     # Posts tests.
     #
@@ -414,3 +549,36 @@ class TestUser(TestBase):
         # ensure only posts for specified user are returned
         posts = json.loads(response.get_data(as_text=True))
         assert len(posts) == 4
+
+    def test_posts_summaries_match_documents(self):
+        for i in range(3):
+            get_mock_post(author=self.user).save()
+
+        response = self.client.get('/user/{}/posts'.format(str(self.user.id)))
+
+        # ensure summaries serialize the same as full documents
+        documents = get_posts(user_id=str(self.user.id), exclude=['content', 'content_html'], order_by=['-created'])
+        assert json.loads(response.get_data(as_text=True)) == json.loads(jsonify(serialize(documents)).get_data())
+
+    def test_posts_cursor_success(self):
+        # create user posts
+        for i in range(4):
+            get_mock_post(author=self.user).save()
+
+        # create other posts
+        for i in range(6):
+            get_mock_post().save()
+
+        response = self.client.get('/user/{}/posts?limit=3&cursor='.format(str(self.user.id)))
+        first_page = json.loads(response.get_data(as_text=True))
+        assert len(first_page['results']) == 3
+
+        response = self.client.get('/user/{}/posts?limit=3&cursor={}'.format(str(self.user.id), first_page['cursor']))
+        second_page = json.loads(response.get_data(as_text=True))
+        assert len(second_page['results']) == 1
+        assert second_page['results'][0]['author']['id'] == str(self.user.id)
+
+    def test_posts_invalid_cursor(self):
+        get_mock_post(author=self.user).save()
+        response = self.client.get('/user/{}/posts?cursor=invalid'.format(str(self.user.id)))
+        assert response.status_code == 400
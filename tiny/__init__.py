@@ -4,12 +4,19 @@ Exports a function to create an instance of the Tiny app.
 
 import os
 
-from flask import abort, Flask, render_template
+from flask import abort, Flask, render_template, request
 from flask_assets import Environment
 from flask_mongoengine import MongoEngine
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from tiny.assets import bundles
-from tiny.helpers import markdown_to_html
+from tiny.assets import asset_config, built_pattern, bundles
+from tiny.compression import init_app as init_compression
+from tiny.helpers import content_to_html, markdown_to_html
+from tiny.jobs import start_worker
+from tiny.metrics import init_app as init_metrics
+from tiny.passwords import PasswordPoolSaturated
+from tiny.slow_queries import init_slow_queries
+from tiny.templating import init_app as init_templating, warm_templates
 
 version = 'v1.4.1'
 
@@ -38,27 +45,73 @@ def create_app(testing=False):
 
     # load environment variables (if present)
     app.config.update({
+        'ASSETS_AUTO_BUILD':
+            os.environ.get('ASSETS_AUTO_BUILD', str(app.config.get('ASSETS_AUTO_BUILD'))).lower() == 'true',
+        'COMPRESSION_LEVEL': int(os.environ.get('COMPRESSION_LEVEL', app.config.get('COMPRESSION_LEVEL'))),
+        'COMPRESSION_MIN_SIZE': int(os.environ.get('COMPRESSION_MIN_SIZE', app.config.get('COMPRESSION_MIN_SIZE'))),
         'DEBUG': os.environ.get('DEBUG', str(app.config.get('DEBUG'))).lower() == 'true',
+        'DELETION_BATCH_SIZE': int(os.environ.get('DELETION_BATCH_SIZE', app.config.get('DELETION_BATCH_SIZE'))),
         'ENV': os.environ.get('ENV', app.config.get('ENV')),
+        'EXPLAIN_INTERVAL': int(os.environ.get('EXPLAIN_INTERVAL', app.config.get('EXPLAIN_INTERVAL'))),
+        'JOB_LEASE_TIMEOUT': int(os.environ.get('JOB_LEASE_TIMEOUT', app.config.get('JOB_LEASE_TIMEOUT'))),
+        'JOB_MAX_ATTEMPTS': int(os.environ.get('JOB_MAX_ATTEMPTS', app.config.get('JOB_MAX_ATTEMPTS'))),
+        'JOB_RETRY_DELAY': int(os.environ.get('JOB_RETRY_DELAY', app.config.get('JOB_RETRY_DELAY'))),
+        'JOB_THREADS': int(os.environ.get('JOB_THREADS', app.config.get('JOB_THREADS'))),
+        'METRICS_DIR': os.environ.get('METRICS_DIR', app.config.get('METRICS_DIR')),
+        'METRICS_ENABLED':
+            os.environ.get('METRICS_ENABLED', str(app.config.get('METRICS_ENABLED'))).lower() == 'true',
+        'METRICS_INTERVAL': int(os.environ.get('METRICS_INTERVAL', app.config.get('METRICS_INTERVAL'))),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN', app.config.get('METRICS_TOKEN')),
         'MONGODB_DB': os.environ.get('MONGODB_DB', app.config.get('MONGODB_DB')),
         'MONGODB_HOST': os.environ.get('MONGODB_HOST', app.config.get('MONGODB_HOST')),
         'MONGODB_PASSWORD': os.environ.get('MONGODB_PASSWORD', app.config.get('MONGODB_PASSWORD')),
         'MONGODB_PORT': int(os.environ.get('MONGODB_PORT', app.config.get('MONGODB_PORT'))),
         'MONGODB_USERNAME': os.environ.get('MONGODB_USERNAME', app.config.get('MONGODB_USERNAME')),
+        'PASSWORD_LOCK_DIR': os.environ.get('PASSWORD_LOCK_DIR', app.config.get('PASSWORD_LOCK_DIR')),
+        'PASSWORD_POOL_SIZE': int(os.environ.get('PASSWORD_POOL_SIZE', app.config.get('PASSWORD_POOL_SIZE'))),
+        'PASSWORD_QUEUE_SIZE': int(os.environ.get('PASSWORD_QUEUE_SIZE', app.config.get('PASSWORD_QUEUE_SIZE'))),
+        'PASSWORD_TIMEOUT': int(os.environ.get('PASSWORD_TIMEOUT', app.config.get('PASSWORD_TIMEOUT'))),
+        'PREVIEW_BUDGET': int(os.environ.get('PREVIEW_BUDGET', app.config.get('PREVIEW_BUDGET'))),
+        'PREVIEW_MAX_LENGTH': int(os.environ.get('PREVIEW_MAX_LENGTH', app.config.get('PREVIEW_MAX_LENGTH'))),
+        'PROXY_COUNT': int(os.environ.get('PROXY_COUNT', app.config.get('PROXY_COUNT'))),
+        'SEARCH_BACKEND': os.environ.get('SEARCH_BACKEND', app.config.get('SEARCH_BACKEND')),
+        'SEARCH_INDEX_TTL': int(os.environ.get('SEARCH_INDEX_TTL', app.config.get('SEARCH_INDEX_TTL'))),
         'SECRET_KEY': os.environ.get('SECRET_KEY', app.config.get('SECRET_KEY')),
         'SERVER_NAME': os.environ.get('SERVER_NAME', app.config.get('SERVER_NAME')),
         'SESSION_COOKIE_DOMAIN':
             os.environ.get('SESSION_COOKIE_DOMAIN', app.config.get('SESSION_COOKIE_DOMAIN')),
+        'SLOW_QUERY_THRESHOLD':
+            int(os.environ.get('SLOW_QUERY_THRESHOLD', app.config.get('SLOW_QUERY_THRESHOLD'))),
+        'SNAPSHOT_BATCH_SIZE': int(os.environ.get('SNAPSHOT_BATCH_SIZE', app.config.get('SNAPSHOT_BATCH_SIZE'))),
+        'TEMPLATE_CACHE_DIR': os.environ.get('TEMPLATE_CACHE_DIR', app.config.get('TEMPLATE_CACHE_DIR')),
+        'TEMPLATE_WARMUP':
+            os.environ.get('TEMPLATE_WARMUP', str(app.config.get('TEMPLATE_WARMUP'))).lower() == 'true',
         'WTF_CSRF_ENABLED':
             os.environ.get('WTF_CSRF_ENABLED', str(app.config.get('WTF_CSRF_ENABLED'))).lower() == 'true'
     })
 
+    # trust the client address and scheme set by proxies in front of the app (e.g. the Heroku router)
+    if app.config['PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'], x_proto=app.config['PROXY_COUNT'])
+
     # inject version
     @app.context_processor
     def inject_version():
         return {'version': version}
 
+    # record metrics (before connecting to the database so its commands are recorded too)
+    if app.config['METRICS_ENABLED']:
+        init_metrics(app)
+
+    # record slow queries (also before connecting to the database)
+    if app.config['SLOW_QUERY_THRESHOLD'] > 0:
+        init_slow_queries()
+
+    # compress responses (registered first so it runs after any other handlers that change responses)
+    init_compression(app)
+
     # init extensions
+    app.config.update(asset_config)
     assets.init_app(app)
     mongoengine.init_app(app)
 
@@ -67,14 +120,43 @@ def create_app(testing=False):
 
     # register blueprints
     from tiny.blueprints.home import home
+    from tiny.blueprints.metrics import metrics
     from tiny.blueprints.post import post
     from tiny.blueprints.search import search
     from tiny.blueprints.user import user
     app.register_blueprint(home)
+    if app.config['METRICS_ENABLED']:
+        app.register_blueprint(metrics)
     app.register_blueprint(post)
     app.register_blueprint(search)
     app.register_blueprint(user)
 
+    # register commands
+    from tiny.commands import (build_assets,
+                               check_indexes,
+                               job_stats,
+                               reconcile_authors,
+                               recount_comments,
+                               render_posts,
+                               resume_deletions,
+                               run_worker,
+                               slow_queries)
+    app.cli.add_command(build_assets)
+    app.cli.add_command(check_indexes)
+    app.cli.add_command(job_stats)
+    app.cli.add_command(reconcile_authors)
+    app.cli.add_command(recount_comments)
+    app.cli.add_command(render_posts)
+    app.cli.add_command(resume_deletions)
+    app.cli.add_command(run_worker)
+    app.cli.add_command(slow_queries)
+
+    # run background jobs on threads in each web process (tests run jobs explicitly)
+    if app.config['JOB_THREADS'] and not testing:
+        @app.before_request
+        def ensure_worker():
+            start_worker(app)
+
     # register asset bundles
     assets.register(bundles)
 
@@ -87,6 +169,15 @@ def create_app(testing=False):
     def markdown_to_html_filter(s):
         return markdown_to_html(s)
 
+    @app.template_filter('content_to_html')
+    def content_to_html_filter(post):
+        return content_to_html(post)
+
+    # cache compiled templates on disk (and compile them all up front rather than on first use if warming up)
+    init_templating(app)
+    if app.config['TEMPLATE_WARMUP']:
+        warm_templates(app)
+
     # attach catch all error handler
     @app.errorhandler(Exception)
     def handle_exception(_):
@@ -97,12 +188,24 @@ def create_app(testing=False):
     def handle_404(error):
         return render_template('404.html', error=error), 404
 
+    # attach 503 error handler (for when passwords can't be hashed/verified fast enough)
+    @app.errorhandler(PasswordPoolSaturated)
+    def handle_password_pool_saturated(error):
+        return render_template('503.html', error=error), 503, {'Retry-After': 5}
+
     # attach 500 error handler
     @app.errorhandler(500)
     def handle_500(error):
         return render_template('500.html', error=error), 500
 
-    # disable caching when debugging
+    # cache built bundles forever (their filenames change whenever their contents do)
+    @app.after_request
+    def cache_built_assets(response):
+        if request.endpoint == 'static' and built_pattern.match(request.view_args['filename']):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+    # disable caching when debugging (except for built bundles)
     if app.debug:
         @app.after_request
         def after_request(response):
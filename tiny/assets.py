@@ -1,18 +1,34 @@
 """
-Exports asset bundles to be used in the UI.
+Exports asset bundles to be used in the UI, along with the config to build
+them with. Bundles are built with a hash of their contents in their filename
+(recorded in a manifest) so they can be cached by browsers forever. Bundles
+are built ahead of time with the build-assets command and, unless
+ASSETS_AUTO_BUILD is set, are not checked or rebuilt while the app runs.
 """
 
+import re
+
 from flask_assets import Bundle
 
 bundles = {
     'all_js': Bundle(
-        '**/*.js',
+        'scripts/*.js',
         filters='jsmin',
-        output='build/bundle.min.js'
+        output='build/bundle.%(version)s.min.js'
     ),
     'all_css': Bundle(
-        '**/*.css',
+        'styles/*.css',
         filters='cssmin',
-        output='build/bundle.min.css'
+        output='build/bundle.%(version)s.min.css'
     )
 }
+
+# flask-assets config (built bundle urls are looked up in the manifest rather than the files checked for changes)
+asset_config = {
+    'ASSETS_MANIFEST': 'json:build/manifest.json',
+    'ASSETS_URL_EXPIRE': False,
+    'ASSETS_VERSIONS': 'hash'
+}
+
+# filenames of built bundles (relative to the static folder)
+built_pattern = re.compile(r'^build/bundle\.[0-9a-f]+\.min\.(css|js)$')
@@ -0,0 +1,28 @@
+"""
+Exports metrics routes.
+"""
+
+from hmac import compare_digest
+
+from flask import Blueprint, current_app, request
+
+from tiny.metrics import render_metrics
+
+metrics = Blueprint('metrics', __name__, url_prefix='/metrics')
+
+@metrics.route('/', methods=['GET'])
+def index():
+    """
+    Metrics route (in the Prometheus text format).
+    """
+
+    # only scrapers that know the token can read the metrics (if there is one)
+    token = current_app.config['METRICS_TOKEN']
+    if token and not compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token)):
+        return current_app.response_class('Unauthorized\n',
+                                          status=401,
+                                          mimetype='text/plain',
+                                          headers={'WWW-Authenticate': 'Bearer'})
+
+    return current_app.response_class(render_metrics(current_app.config['METRICS_DIR']),
+                                      mimetype='text/plain; version=0.0.4')
@@ -5,6 +5,7 @@ Exports post routes.
 from datetime import datetime
 
 from flask import (Blueprint,
+                   current_app,
                    flash,
                    jsonify,
                    redirect,
@@ -13,18 +14,34 @@ from flask import (Blueprint,
                    session,
                    url_for)
 
+from tiny import version
+from tiny.deletions import delete_post
 from tiny.forms import CommentForm, PostForm
-from tiny.helpers import (author_required,
-                          get_comments,
-                          get_posts,
-                          markdown_to_html,
+from tiny.helpers import (anonymous_response_cached,
+                          author_required,
+                          conditional_jsonify,
+                          conditional_response,
+                          get_comment_summaries,
+                          get_etag,
+                          get_post_summaries,
+                          increment_comment_count,
+                          invalidate_response,
+                          is_valid_cursor,
+                          markdown_version,
                           post_required,
+                          render_content,
                           serialize,
+                          serialize_page,
                           sign_in_required)
 from tiny.models import Comment, Post
+from tiny.preview import ClientBudget, get_render_cost, render_blocks, split_blocks
+from tiny.search_backends import get_search_terms, index_post, remove_post
+from tiny.suggestions import suggestion_index
 
 post = Blueprint('post', __name__, url_prefix='/post')
 
+preview_budget = ClientBudget()
+
 @post.route('/create', methods=['GET', 'POST'])
 @sign_in_required
 def create(current_user):
@@ -43,12 +60,14 @@ def create(current_user):
     if not form.validate_on_submit():
         return render_template('post/create.html', form=form), 400
 
-    # create new post
-    new_post = Post(author=current_user,
-                    title=form.title.data,
-                    lead_paragraph=form.lead_paragraph.data,
-                    image_url=form.image_url.data,
-                    content=form.content.data).save()
+    # create new post (rendering the content up front so it isn't rendered on every view)
+    new_post = render_content(Post(author=current_user,
+                                   title=form.title.data,
+                                   lead_paragraph=form.lead_paragraph.data,
+                                   image_url=form.image_url.data,
+                                   content=form.content.data)).save()
+    index_post(new_post)
+    suggestion_index.index_post(new_post)
 
     # notify user
     flash('Post successfully created.', 'success')
@@ -57,16 +76,39 @@ def create(current_user):
     return redirect(url_for('post.show', post_id=str(new_post.id)))
 
 @post.route('/<post_id>/show', methods=['GET'])
+@anonymous_response_cached('post_id')
 @post_required
 def show(post_id, selected_post):
     """
     Show post route.
     """
 
-    return render_template('post/show.html',
-                           form=CommentForm(),
-                           post=selected_post,
-                           is_author=str(selected_post.author.id) == session.get('user_id'))
+    author = selected_post.get_author()
+
+    def render():
+        return render_template('post/show.html',
+                               form=CommentForm(),
+                               post=selected_post,
+                               is_author=str(author.id) == session.get('user_id'))
+
+    # pages showing flashed messages are one offs so the client shouldn't reuse them
+    if '_flashes' in session:
+        return render()
+
+    # the page changes with the post, its author and who is viewing it (so is private)
+    last_modified = selected_post.last_updated or selected_post.created
+    etag = get_etag(version,
+                    markdown_version,
+                    selected_post.id,
+                    last_modified,
+                    author.id,
+                    author.display_name,
+                    author.avatar_url,
+                    author.bio,
+                    session.get('user_id'),
+                    session.get('avatar_url'))
+
+    return conditional_response(etag, last_modified, render, private=True)
 
 @post.route('/<post_id>/settings', methods=['GET'])
 @sign_in_required
@@ -99,10 +141,14 @@ def update(current_user, post_id, selected_post):
     if not form.validate_on_submit():
         return render_template('post/update.html', form=form, post=selected_post), 400
 
-    # update the post information
+    # update the post information (keeping its old search terms so searches for them can be expired)
+    previous_terms = get_search_terms(selected_post)
     form.populate_obj(selected_post)
     selected_post.last_updated = datetime.now()
-    selected_post.save()
+    render_content(selected_post).save()
+    index_post(selected_post, previous_terms)
+    suggestion_index.index_post(selected_post)
+    invalidate_response('post.show', post_id)
 
     # notify the user
     flash('Post successfully updated.', 'success')
@@ -123,7 +169,11 @@ def delete(current_user, post_id, selected_post):
     if request.method == 'GET':
         return render_template('post/delete.html', post=selected_post)
 
-    selected_post.delete()
+    # hide the post straight away (it and its comments are deleted in the background)
+    delete_post(selected_post)
+    remove_post(selected_post)
+    suggestion_index.remove_post(selected_post.id)
+    invalidate_response('post.show', post_id)
 
     # notify user
     flash('Successfully deleted post.', 'success')
@@ -140,14 +190,20 @@ def latest():
     # get query parameters
     skip = request.args.get('skip', 0, type=int)
     limit = request.args.get('limit', 12, type=int)
+    cursor = request.args.get('cursor', None, type=str)
+
+    # a bad cursor isn't treated as the first page (the client would be sent results it already has)
+    if not is_valid_cursor(cursor):
+        return jsonify({'errors': ['Invalid cursor.'], 'success': False}), 400
 
-    # query for latest posts (making sure to exclude the actual content)
-    results = get_posts(exclude=['content'],
-                        order_by=['-created'],
-                        skip=skip,
-                        limit=limit)
+    # query for latest post summaries (joined with their authors in one aggregation)
+    results = get_post_summaries(skip=skip, limit=limit, cursor=cursor)
 
-    return jsonify(serialize(results))
+    # include the next cursor if paging by cursor
+    if cursor is not None:
+        return conditional_jsonify(results, serialize_page)
+
+    return conditional_jsonify(results, serialize)
 
 @post.route('/<post_id>/comments', methods=['GET'])
 @post_required
@@ -159,15 +215,20 @@ def comments(post_id, selected_post):
     # get query parameters
     skip = request.args.get('skip', 0, type=int)
     limit = request.args.get('limit', 12, type=int)
+    cursor = request.args.get('cursor', None, type=str)
+
+    # a bad cursor isn't treated as the first page (the client would be sent results it already has)
+    if not is_valid_cursor(cursor):
+        return jsonify({'errors': ['Invalid cursor.'], 'success': False}), 400
 
-    # query for post's comments (making sure to exclude the post itself)
-    results = get_comments(post_id=post_id,
-                           exclude=['post'],
-                           order_by=['created'],
-                           skip=skip,
-                           limit=limit)
+    # query for summaries of post's comments (which exclude the post itself)
+    results = get_comment_summaries(post_id=post_id, skip=skip, limit=limit, cursor=cursor)
 
-    return jsonify(serialize(results))
+    # include the next cursor if paging by cursor
+    if cursor is not None:
+        return conditional_jsonify(results, serialize_page)
+
+    return conditional_jsonify(results, serialize)
 
 @post.route('/<post_id>/comment', methods=['POST'])
 @sign_in_required
@@ -192,6 +253,8 @@ def comment(current_user, post_id, selected_post):
     Comment(author=current_user,
             post=selected_post,
             text=form.text.data).save()
+    increment_comment_count(post_id)
+    invalidate_response('post.show', post_id)
 
     return jsonify({'success': True}), 200
 
@@ -201,4 +264,16 @@ def preview():
     Post preview route.
     """
 
-    return jsonify({'html': markdown_to_html(request.form.get('content', ''))}), 200
+    content = request.form.get('content', '')
+
+    # make sure preview can't be used to render unbounded content
+    if len(content) > current_app.config['PREVIEW_MAX_LENGTH']:
+        return jsonify({'errors': ['Content is too long to preview.'], 'success': False}), 413
+
+    # only render blocks that have changed since the last preview (as long as the client can afford it)
+    blocks = split_blocks(content)
+    client = session.get('user_id') or request.remote_addr
+    if not preview_budget.spend(client, get_render_cost(blocks), current_app.config['PREVIEW_BUDGET']):
+        return jsonify({'errors': ['Too many previews, please try again shortly.'], 'success': False}), 429
+
+    return jsonify({'html': render_blocks(blocks)}), 200
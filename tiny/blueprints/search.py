@@ -4,7 +4,9 @@ Exports search routes.
 
 from flask import Blueprint, jsonify, render_template, request
 
-from tiny.helpers import request_wants_json, search_posts, serialize
+from tiny.helpers import request_wants_json
+from tiny.search_backends import search_post_summaries
+from tiny.suggestions import suggestion_index
 
 search = Blueprint('search', __name__, url_prefix='/search')
 
@@ -23,11 +25,23 @@ def index():
     skip = request.args.get('skip', 0, type=int)
     limit = request.args.get('limit', 12, type=int)
 
-    # search for posts (making sure to exclude the actual content)
-    results = search_posts(search_text=terms,
-                           exclude=['content'],
-                           order_by=['$text_score'],
-                           skip=skip,
-                           limit=limit)
+    # search for post summaries with the configured backend
+    results = search_post_summaries(search_text=terms, skip=skip, limit=limit)
 
-    return jsonify(serialize(results))
+    return jsonify(results)
+
+@search.route('/suggest', methods=['GET'])
+def suggest():
+    """
+    Search suggestions route (completes the search being typed from an index
+    held in memory).
+    """
+
+    # get query parameters
+    prefix = request.args.get('prefix', '', type=str)
+    limit = request.args.get('limit', 8, type=int)
+
+    # cap number of suggestions to return
+    limit = 20 if limit > 20 else limit
+
+    return jsonify(suggestion_index.suggest(prefix, limit=limit))
@@ -10,15 +10,24 @@ from flask import (Blueprint,
                    request,
                    session,
                    url_for)
-from passlib.hash import sha256_crypt
 
+from tiny.deletions import delete_user
 from tiny.forms import SignInForm, SignUpForm, UpdatePasswordForm, UpdateProfileForm
-from tiny.helpers import (get_posts,
+from tiny.helpers import (anonymous_response_cached,
+                          conditional_jsonify,
+                          get_post_summaries,
+                          invalidate_user,
+                          invalidate_user_responses,
+                          is_valid_cursor,
                           serialize,
+                          serialize_page,
                           sign_in_required,
                           sign_out_required,
                           user_required)
-from tiny.models import User
+from tiny.models import AuthorSnapshot, User
+from tiny.passwords import hash_password
+from tiny.search_backends import expire_author_search_results
+from tiny.snapshots import fan_out_author_snapshot
 
 user = Blueprint('user', __name__, url_prefix='/user')
 
@@ -46,7 +55,7 @@ def sign_up():
 
     # save new user
     new_user = User(email=form.email.data,
-                    password=sha256_crypt.hash(form.password.data),
+                    password=hash_password(form.password.data),
                     display_name=form.display_name.data).save()
 
     # make sure we store user id and avatar url in session
@@ -101,6 +110,7 @@ def sign_out():
     return render_template('user/sign_out.html')
 
 @user.route('/<user_id>/show', methods=['GET'])
+@anonymous_response_cached('user_id')
 @user_required
 def show(user_id, selected_user):
     """
@@ -137,8 +147,15 @@ def update_profile(current_user):
         return render_template('user/update_profile.html', form=form), 400
 
     # update the user information
+    snapshot = AuthorSnapshot.from_user(current_user)
     form.populate_obj(current_user)
     current_user.save()
+    invalidate_user(current_user.id)
+    invalidate_user_responses(current_user.id)
+
+    # update the snapshot stored with the user's posts and comments (if it has changed)
+    if AuthorSnapshot.from_user(current_user) != snapshot:
+        fan_out_author_snapshot(current_user)
 
     # make sure we store the avatar url in session
     session['avatar_url'] = current_user.avatar_url
@@ -168,8 +185,9 @@ def update_password(current_user):
         return render_template('user/update_password.html', form=form), 400
 
     # update password
-    current_user.password = sha256_crypt.hash(form.new_password.data)
+    current_user.password = hash_password(form.new_password.data)
     current_user.save()
+    invalidate_user(current_user.id)
 
     # notify the user
     flash('Password successfully updated.', 'success')
@@ -188,7 +206,11 @@ def delete(current_user):
     if request.method == 'GET':
         return render_template('user/delete.html')
 
-    current_user.delete()
+    # hide the user straight away (their posts and comments are deleted in the background)
+    invalidate_user_responses(current_user.id)
+    delete_user(current_user)
+    invalidate_user(current_user.id)
+    expire_author_search_results(current_user.id)
 
     # make sure we clear the session
     session.clear()
@@ -209,12 +231,17 @@ def posts(user_id, selected_user):
     # get query parameters
     skip = request.args.get('skip', 0, type=int)
     limit = request.args.get('limit', 12, type=int)
+    cursor = request.args.get('cursor', None, type=str)
+
+    # a bad cursor isn't treated as the first page (the client would be sent results it already has)
+    if not is_valid_cursor(cursor):
+        return jsonify({'errors': ['Invalid cursor.'], 'success': False}), 400
+
+    # query for summaries of user's posts (joined with their authors in one aggregation)
+    results = get_post_summaries(user_id=user_id, skip=skip, limit=limit, cursor=cursor)
 
-    # query for user's posts (making sure to exclude the actual content)
-    results = get_posts(user_id=user_id,
-                        exclude=['content'],
-                        order_by=['-created'],
-                        skip=skip,
-                        limit=limit)
+    # include the next cursor if paging by cursor
+    if cursor is not None:
+        return conditional_jsonify(results, serialize_page)
 
-    return jsonify(serialize(results))
+    return conditional_jsonify(results, serialize)
@@ -0,0 +1,109 @@
+"""
+Exports a bounded in-process cache.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class LRUCache:
+    """
+    A thread safe cache that evicts the least recently used entries once it
+    holds more than max_size entries (or, if a size_of function is given, once
+    the total size of its values is more than max_size). If a ttl (in seconds)
+    is given, entries also expire that long after they were set. Hits and
+    misses are counted so the cache can be tuned.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, size_of=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __contains__(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            expires, _, _ = self.__entries[key]
+            return expires is None or expires > monotonic()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value for a key (marking it as recently used) or default
+        if there isn't one.
+        """
+
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return default
+
+            expires, value, size = self.__entries[key]
+            if expires is not None and expires <= monotonic():
+                del self.__entries[key]
+                self.size -= size
+                self.misses += 1
+                return default
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Sets the value for a key, evicting the least recently used entry if
+        the cache is full.
+        """
+
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        size = self.size_of(value)
+
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.__entries[key][2]
+            self.__entries[key] = (expires, value, size)
+            self.__entries.move_to_end(key)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.__entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def items(self):
+        """
+        Returns a list of the (key, value) pairs that haven't expired, without
+        marking them as recently used or counting them as hits.
+        """
+
+        now = monotonic()
+        with self.__lock:
+            return [(key, value) for key, (expires, value, _) in self.__entries.items()
+                    if expires is None or expires > now]
+
+    def delete(self, key):
+        """
+        Removes a key if it is present.
+        """
+
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.__entries.pop(key)[2]
+
+    def clear(self):
+        """
+        Removes every entry and resets the counters.
+        """
+
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
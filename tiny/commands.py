@@ -0,0 +1,323 @@
+"""
+Exports CLI commands to be registered with the Tiny app.
+"""
+
+import os
+from datetime import datetime
+
+import click
+from bson.objectid import ObjectId
+from bson.son import SON
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import UpdateOne
+
+from tiny.assets import built_pattern
+from tiny.compression import precompress_static_files
+from tiny.helpers import (encode_cursor,
+                          find_winning_plan,
+                          get_comments,
+                          get_post_summaries_pipeline,
+                          get_post_summaries_query,
+                          markdown_to_html,
+                          markdown_version)
+from tiny.deletions import finish_deletions
+from tiny.jobs import get_queue_stats, run_jobs, Worker
+from tiny.models import AuthorSnapshot, Comment, Deletion, Post, User
+from tiny.search_backends import MongoTextBackend
+from tiny.slow_queries import get_slow_query_stats
+from tiny.snapshots import update_author_snapshots
+
+#
+# Private helper functions.
+#
+
+def __helper_queries__():
+    # placeholder ids are fine here since query plans don't depend on matches (single
+    # document lookups aren't included as they always go through _id or unique indexes)
+    some_id = str(ObjectId())
+    some_cursor = encode_cursor({'created': datetime.now(), 'id': some_id})
+
+    # post summaries are aggregated so their pipelines are explained rather than query sets
+    return {
+        'get_post_summaries()': get_post_summaries_pipeline(*get_post_summaries_query()),
+        'get_post_summaries(cursor)': get_post_summaries_pipeline(*get_post_summaries_query(cursor=some_cursor)),
+        'get_post_summaries(user_id)': get_post_summaries_pipeline(*get_post_summaries_query(user_id=some_id)),
+        'get_post_summaries(user_id, cursor)':
+            get_post_summaries_pipeline(*get_post_summaries_query(user_id=some_id, cursor=some_cursor)),
+        'MongoTextBackend.search_post_summaries(search_text)':
+            get_post_summaries_pipeline(*MongoTextBackend.get_query('tiny')),
+        'get_comments(post_id)': get_comments(post_id=some_id, exclude=['post'], order_by=['created']),
+        'get_comments(post_id, cursor)':
+            get_comments(post_id=some_id, exclude=['post'], order_by=['created'], cursor=some_cursor)
+    }
+
+def __explain__(query):
+    if not isinstance(query, list):
+        return query.explain()
+
+    # explain with the planner only (i.e. without running the aggregation)
+    collection = Post._get_collection()  # pylint: disable=protected-access
+    command = SON([('aggregate', collection.name), ('pipeline', query), ('cursor', {})])
+    return collection.database.command('explain', command, verbosity='queryPlanner')
+
+def __plan_stages__(plan):
+    stages = [plan['stage']]
+    if 'inputStage' in plan:
+        stages.extend(__plan_stages__(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(__plan_stages__(input_stage))
+    return stages
+
+#
+# Command definitions.
+#
+
+@click.command('check-indexes')
+@with_appcontext
+def check_indexes():
+    """
+    Explains each helper query (or the aggregation pipeline it runs) and
+    reports any that scan the whole collection or sort in memory.
+    """
+
+    unindexed = 0
+
+    for name, query in __helper_queries__().items():
+        stages = __plan_stages__(find_winning_plan(__explain__(query)))
+        problems = {stage for stage in stages if stage in ('COLLSCAN', 'SORT')}
+
+        # text search results can only ever be sorted by score in memory
+        if 'TEXT' in stages:
+            problems.discard('SORT')
+
+        problems = sorted(problems)
+        if problems:
+            unindexed += 1
+            click.echo('{}: not index covered ({})'.format(name, ', '.join(problems)))
+        else:
+            click.echo('{}: ok'.format(name))
+
+    if unindexed:
+        raise click.ClickException('{} helper queries are not index covered'.format(unindexed))
+
+@click.command('recount-comments')
+@click.option('--batch-size', default=500, help='Number of posts to recount per batch.')
+@with_appcontext
+def recount_comments(batch_size):
+    """
+    Counts the comments on every post (a batch of posts per aggregation) and
+    fixes any comment counts that have drifted.
+    """
+
+    checked = 0
+    fixed = 0
+
+    # page by id so each batch picks up where the last one left off
+    last_id = None
+    while True:
+        query_set = Post.objects
+        if last_id:
+            query_set = query_set.filter(id__gt=last_id)
+        batch = list(query_set.only('comment_count').order_by('id').limit(batch_size).as_pymongo())
+        if not batch:
+            break
+
+        counts = {count['_id']: count['count'] for count in Comment.objects.aggregate(
+            {'$match': {'post': {'$in': [post['_id'] for post in batch]}, 'deleted': {'$ne': True}}},
+            {'$group': {'_id': '$post', 'count': {'$sum': 1}}}
+        )}
+
+        # only write the counts that are wrong
+        updates = [UpdateOne({'_id': post['_id']}, {'$set': {'comment_count': counts.get(post['_id'], 0)}})
+                   for post in batch if post.get('comment_count') != counts.get(post['_id'], 0)]
+        if updates:
+            Post._get_collection().bulk_write(updates, ordered=False)  # pylint: disable=protected-access
+
+        checked += len(batch)
+        fixed += len(updates)
+        last_id = batch[-1]['_id']
+        click.echo('Recounted {} posts'.format(checked))
+
+    click.echo('Finished recounting {} posts ({} fixed)'.format(checked, fixed))
+
+@click.command('resume-deletions')
+@click.option('--batch-size', default=500, help='Number of posts or comments to delete per batch.')
+@with_appcontext
+def resume_deletions(batch_size):
+    """
+    Reports the progress of any unfinished user or post deletions (e.g. ones
+    interrupted by a restart) and finishes them.
+    """
+
+    for deletion in Deletion.objects(finished=None).order_by('created'):
+        click.echo('Resuming deletion of {} {} ({} posts and {} comments deleted so far)'.format(
+            deletion.target_type,
+            deletion.target_id,
+            deletion.posts_deleted,
+            deletion.comments_deleted
+        ))
+
+    click.echo('Finished {} deletions'.format(finish_deletions(batch_size)))
+
+@click.command('render-posts')
+@click.option('--batch-size', default=500, help='Number of posts to render per batch.')
+@with_appcontext
+def render_posts(batch_size):
+    """
+    Renders and stores the content HTML of any posts that are missing it or
+    were rendered by a different version.
+    """
+
+    rendered = 0
+
+    # page by id so each batch picks up where the last one left off
+    last_id = None
+    while True:
+        query_set = Post.objects(content_html_version__ne=markdown_version)
+        if last_id:
+            query_set = query_set.filter(id__gt=last_id)
+        batch = list(query_set.only('content').order_by('id').limit(batch_size).as_pymongo())
+        if not batch:
+            break
+
+        Post._get_collection().bulk_write([  # pylint: disable=protected-access
+            UpdateOne({'_id': post['_id']}, {'$set': {
+                'content_html': markdown_to_html(post['content']),
+                'content_html_version': markdown_version
+            }}) for post in batch
+        ], ordered=False)
+
+        rendered += len(batch)
+        last_id = batch[-1]['_id']
+        click.echo('Rendered {} posts'.format(rendered))
+
+    click.echo('Finished rendering {} posts'.format(rendered))
+
+@click.command('job-stats')
+@click.option('--window', default=60, help='Number of minutes to report throughput and queue latency over.')
+@with_appcontext
+def job_stats(window):
+    """
+    Reports the number of jobs in each status, along with how many jobs were
+    done and how long they spent queued over a recent window.
+    """
+
+    stats = get_queue_stats(window * 60)
+
+    click.echo('Queued: {queued}, running: {running}, done: {done}, failed: {failed}'.format(**stats))
+    click.echo('Done in the last {} minutes: {} ({:.2f} per minute)'.format(window,
+                                                                           stats['recently_done'],
+                                                                           stats['recently_done'] / window))
+    if stats['mean_queue_seconds'] is not None:
+        click.echo('Mean queue latency: {:.2f} seconds'.format(stats['mean_queue_seconds']))
+
+@click.command('reconcile-authors')
+@click.option('--batch-size', default=500, help='Number of users (and their posts or comments) to update per batch.')
+@with_appcontext
+def reconcile_authors(batch_size):
+    """
+    Updates the author snapshots of any posts and comments that are missing
+    them or have drifted from their author's profile.
+    """
+
+    reconciled = 0
+
+    # page by id so each batch picks up where the last one left off
+    last_id = None
+    while True:
+        query_set = User.objects
+        if last_id:
+            query_set = query_set.filter(id__gt=last_id)
+        batch = list(query_set.only('display_name', 'avatar_url', 'bio', 'created').order_by('id').limit(batch_size))
+        if not batch:
+            break
+
+        for user in batch:
+            reconciled += update_author_snapshots(AuthorSnapshot.from_user(user), batch_size)
+
+        last_id = batch[-1].id
+        click.echo('Reconciled {} posts and comments'.format(reconciled))
+
+    click.echo('Finished reconciling {} posts and comments'.format(reconciled))
+
+@click.command('run-worker')
+@click.option('--threads', default=1, help='Number of threads to run jobs on.')
+@click.option('--burst', is_flag=True, help='Exit once there are no jobs ready to run.')
+@with_appcontext
+def run_worker(threads, burst):
+    """
+    Runs background jobs (as an alternative, or in addition, to running them
+    on threads in each web process).
+    """
+
+    if burst:
+        click.echo('Finished running {} jobs'.format(run_jobs()))
+        return
+
+    worker = Worker(current_app._get_current_object(), threads=threads)  # pylint: disable=protected-access
+    worker.start()
+    click.echo('Running jobs on {} threads (press CTRL+C to stop)'.format(threads))
+
+    try:
+        worker.join()
+    except KeyboardInterrupt:
+        click.echo('Stopping once running jobs finish')
+        worker.stop()
+
+@click.command('slow-queries')
+@click.option('--hours', default=24, help='Number of hours to report slow queries over.')
+@click.option('--limit', default=20, help='Number of query shapes to report.')
+@with_appcontext
+def slow_queries(hours, limit):
+    """
+    Reports the slow queries recorded over a recent window grouped by shape,
+    those that took the most time in total first.
+    """
+
+    stats = get_slow_query_stats(hours, limit)
+    if not stats:
+        click.echo('No slow queries in the last {} hours'.format(hours))
+        return
+
+    for shape in stats:
+        click.echo(shape['_id'])
+        click.echo('  {} times, {:.1f} ms mean, {:.1f} ms max, {:.1f} ms total'.format(shape['count'],
+                                                                                       shape['mean_duration'],
+                                                                                       shape['max_duration'],
+                                                                                       shape['total_duration']))
+        click.echo('  From: {}'.format(', '.join(sorted(shape['endpoints']))))
+        click.echo('  Plan: {}'.format(shape['plan'] or 'not explained'))
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets():
+    """
+    Builds the asset bundles with a hash of their contents in their filenames,
+    records them in the manifest and removes any stale bundles. Then writes
+    gzipped copies of the static files (including the bundles) to be sent to
+    clients that accept them.
+    """
+
+    environment = current_app.jinja_env.assets_environment
+
+    built = set()
+    for bundle in environment:
+        bundle.build(force=True)
+        path = os.path.relpath(bundle.resolve_output(), environment.directory)
+        built.add(path)
+        click.echo('Built {}'.format(path))
+
+    # remove bundles from earlier builds (as the manifest no longer refers to them)
+    build_directory = os.path.join(environment.directory, 'build')
+    for filename in sorted(os.listdir(build_directory)):
+        path = 'build/{}'.format(filename)
+        if built_pattern.match(path) and path not in built:
+            os.remove(os.path.join(build_directory, filename))
+            click.echo('Removed {}'.format(path))
+
+    written, removed = precompress_static_files(environment.directory)
+    for path in written:
+        click.echo('Compressed {}'.format(path))
+    for path in removed:
+        click.echo('Removed {}'.format(path))
@@ -0,0 +1,175 @@
+"""
+Exports functions to gzip responses for clients that accept it. Pages, JSON
+and other text responses of at least COMPRESSION_MIN_SIZE bytes are
+compressed as they are sent (streamed responses chunk by chunk), at
+COMPRESSION_LEVEL. Static files are instead compressed ahead of time (by the
+build-assets command) into .gz siblings that are sent in their place, as
+long as they are at least as new as the file they were compressed from.
+"""
+
+import mimetypes
+import os
+import zlib
+
+from flask import current_app, request, safe_join, send_from_directory
+from werkzeug.exceptions import NotFound
+
+# mimetypes worth compressing (anything else, e.g. images, is already compressed)
+compressible_mimetypes = ('application/javascript',
+                          'application/json',
+                          'application/manifest+json',
+                          'application/xml',
+                          'image/svg+xml',
+                          'image/vnd.microsoft.icon',
+                          'image/x-icon',
+                          'text/css',
+                          'text/html',
+                          'text/javascript',
+                          'text/plain',
+                          'text/xml')
+
+# static file extensions worth precompressing
+compressible_extensions = ('.css', '.ico', '.js', '.json', '.svg', '.txt', '.webmanifest', '.xml')
+
+#
+# Private helper functions.
+#
+
+def __gzip__(data, level):
+    # zlib (rather than gzip) leaves the timestamp out of the header so the same data always compresses the same
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def __gzip_stream__(chunks, level, close):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            # flush each chunk so it is sent as soon as it is ready
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if close:
+            close()
+
+def __accepts_gzip__():
+    return request.accept_encodings['gzip'] > 0
+
+def __is_precompressed__(filename):
+    # a copy older than its file is stale (e.g. the file was changed without running build-assets again)
+    try:
+        path = safe_join(current_app.static_folder, filename)
+        return os.path.getmtime('{}.gz'.format(path)) >= os.path.getmtime(path)
+    except (NotFound, OSError):
+        return False
+
+def __send_static_file__(filename):
+    # send the precompressed copy of a static file (if there is an up to date one)
+    if __accepts_gzip__() and __is_precompressed__(filename):
+        response = send_from_directory(current_app.static_folder,
+                                       '{}.gz'.format(filename),
+                                       mimetype=mimetypes.guess_type(filename)[0],
+                                       cache_timeout=current_app.get_send_file_max_age(filename))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    return current_app.send_static_file(filename)
+
+#
+# Compression functions.
+#
+
+def init_app(app):
+    """
+    Compresses an app's responses, and sends precompressed static files.
+    """
+
+    app.view_functions['static'] = __send_static_file__
+
+    @app.after_request
+    def compress_response(response):
+        level = app.config['COMPRESSION_LEVEL']
+        if (not level
+                or response.mimetype not in compressible_mimetypes
+                or response.status_code < 200
+                or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        # whether it is compressed or not depends on the request
+        response.vary.add('Accept-Encoding')
+        if not __accepts_gzip__():
+            return response
+
+        if response.is_streamed:
+            response.response = __gzip_stream__(response.iter_encoded(),
+                                                level,
+                                                getattr(response.response, 'close', None))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+                return response
+            response.set_data(__gzip__(data, level))
+
+        response.headers['Content-Encoding'] = 'gzip'
+
+        # a compressed response isn't byte for byte the same as the uncompressed one
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        return response
+
+def precompress_static_files(directory, level=9):
+    """
+    Writes a gzipped copy (with a .gz extension) of each compressible file in
+    a directory alongside it, and removes copies of files that no longer
+    exist. Returns the paths written and removed (relative to the directory).
+    """
+
+    written = []
+    removed = []
+
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            name, extension = os.path.splitext(path)
+
+            if extension == '.gz':
+                if not os.path.exists(name):
+                    os.remove(path)
+                    removed.append(os.path.relpath(path, directory))
+                continue
+
+            if extension not in compressible_extensions:
+                continue
+
+            with open(path, 'rb') as f:
+                data = f.read()
+            compressed = __gzip__(data, level)
+            gzip_path = '{}.gz'.format(path)
+
+            # only keep copies that are smaller
+            if len(compressed) >= len(data):
+                if os.path.exists(gzip_path):
+                    os.remove(gzip_path)
+                    removed.append(os.path.relpath(gzip_path, directory))
+                continue
+
+            # leave copies that are up to date alone, other than giving them their file's modified time (so
+            # they are sent in its place without their ETags changing)
+            modified = os.stat(path).st_mtime_ns
+            if os.path.exists(gzip_path):
+                with open(gzip_path, 'rb') as f:
+                    if f.read() == compressed:
+                        os.utime(gzip_path, ns=(modified, modified))
+                        continue
+
+            with open(gzip_path, 'wb') as f:
+                f.write(compressed)
+            os.utime(gzip_path, ns=(modified, modified))
+            written.append(os.path.relpath(gzip_path, directory))
+
+    return written, removed
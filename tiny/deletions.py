@@ -0,0 +1,115 @@
+"""
+Exports functions to delete users and posts. Deleting a user or post marks it
+(and anything that is shown elsewhere, like a user's comments) as deleted
+straight away, which hides it from every helper query. Everything that belongs
+to it is then deleted a batch at a time by a background job. Progress is
+recorded as it goes and every batch is safe to run again, so an interrupted
+deletion is simply retried (or can be resumed with the resume-deletions
+command).
+"""
+
+from datetime import datetime
+
+from flask import current_app
+
+from tiny.helpers import decrement_comment_counts
+from tiny.jobs import enqueue, task
+from tiny.models import Comment, Deletion, Post, User
+
+#
+# Private helper functions.
+#
+
+def __delete_in_batches__(query_set, batch_size, deletion):
+    # look up a batch of ids at a time so each delete is bounded
+    model = query_set._document  # pylint: disable=protected-access
+    name = '{}s'.format(model.__name__.lower())
+
+    while True:
+        ids = list(query_set.limit(batch_size).scalar('id'))
+        if not ids:
+            return
+
+        deleted = model.objects(id__in=ids).delete()
+        Deletion.objects(id=deletion.id).update_one(**{'inc__{}_deleted'.format(name): deleted})
+        current_app.logger.info('Deletion %s: deleted %s %s', deletion.id, deleted, name)
+
+def __purge_posts__(post_query_set, batch_size, deletion):
+    # delete the comments on each batch of posts before the posts themselves so none are orphaned
+    while True:
+        post_ids = list(post_query_set.limit(batch_size).scalar('id'))
+        if not post_ids:
+            return
+
+        __delete_in_batches__(Comment.objects(post__in=post_ids), batch_size, deletion)
+        __delete_in_batches__(Post.objects(id__in=post_ids), batch_size, deletion)
+
+#
+# Deletion functions.
+#
+
+def purge(deletion, batch_size=500):
+    """
+    Deletes a user or post that has been marked as deleted, along with
+    everything that belongs to it, a batch at a time.
+    """
+
+    if deletion.target_type == 'user':
+        __delete_in_batches__(Comment.objects(author=deletion.target_id), batch_size, deletion)
+        __purge_posts__(Post.objects(author=deletion.target_id), batch_size, deletion)
+        User.objects(id=deletion.target_id).delete()
+    else:
+        __purge_posts__(Post.objects(id=deletion.target_id), batch_size, deletion)
+
+    Deletion.objects(id=deletion.id).update_one(set__finished=datetime.now())
+    current_app.logger.info('Deletion %s: finished', deletion.id)
+
+@task
+def purge_deletion(deletion_id):
+    """
+    Purges a deletion, unless it has already finished.
+    """
+
+    deletion = Deletion.objects(id=deletion_id, finished=None).first()
+    if deletion:
+        purge(deletion, current_app.config['DELETION_BATCH_SIZE'])
+
+def delete_user(user):
+    """
+    Marks a user, their posts and their comments as deleted, then queues a
+    job to delete them. Returns the job.
+    """
+
+    deletion = Deletion(target_type='user', target_id=user.id).save()
+
+    User.objects(id=user.id).update_one(set__deleted=True)
+    Post.objects(author=user.id).update(set__deleted=True)
+
+    # comments on other authors' posts stop counting as soon as they are hidden
+    decrement_comment_counts(user.id)
+    Comment.objects(author=user.id).update(set__deleted=True)
+
+    return enqueue(purge_deletion, deletion_id=deletion.id)
+
+def delete_post(post):
+    """
+    Marks a post as deleted, then queues a job to delete it and its comments.
+    Returns the job.
+    """
+
+    deletion = Deletion(target_type='post', target_id=post.id).save()
+
+    Post.objects(id=post.id).update_one(set__deleted=True)
+
+    return enqueue(purge_deletion, deletion_id=deletion.id)
+
+def finish_deletions(batch_size=500):
+    """
+    Finishes any deletions that were interrupted (e.g. by a restart). Returns
+    the number of deletions finished.
+    """
+
+    deletions = list(Deletion.objects(finished=None).order_by('created'))
+    for deletion in deletions:
+        purge(deletion, batch_size)
+    return len(deletions)
@@ -3,11 +3,11 @@ Exports forms used in Tiny app.
 """
 
 from flask_wtf import FlaskForm
-from passlib.hash import sha256_crypt
 from wtforms import PasswordField, StringField, TextAreaField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, URL
 
 from tiny.helpers import get_user
+from tiny.passwords import verify_password
 
 class SignUpForm(FlaskForm):
     """
@@ -39,7 +39,8 @@ class SignUpForm(FlaskForm):
         if not super().validate_on_submit():
             return False
 
-        if get_user(email=self.email.data):
+        # accounts that are still being deleted hold on to their email until they are gone
+        if get_user(email=self.email.data, include_deleted=True):
             self.email.errors.append('There is already an account with this email.')
             return False
 
@@ -69,7 +70,7 @@ class SignInForm(FlaskForm):
 
         user = get_user(email=self.email.data)
 
-        if not user or not sha256_crypt.verify(self.password.data, user.password):
+        if not user or not verify_password(self.password.data, user.password):
             self.email.errors.append('Incorrect email.')
             self.password.errors.append('Incorrect password.')
             return False
@@ -125,7 +126,7 @@ class UpdatePasswordForm(FlaskForm):
         if not super().validate_on_submit():
             return False
 
-        if not sha256_crypt.verify(self.current_password.data, self.user.password):
+        if not verify_password(self.current_password.data, self.user.password):
             self.current_password.errors.append('Incorrect password.')
             return False
 
@@ -2,18 +2,37 @@
 Exports reusable helper functions.
 """
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime, timedelta
 from functools import wraps
+from hashlib import sha1
 
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from flask import flash, redirect, request, session, url_for
-from mistune import Markdown
+from bson.son import SON
+from flask import current_app, flash, jsonify, make_response, redirect, request, session, url_for
+from mistune import __version__ as mistune_version, Markdown
 from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
 
-from tiny.models import Comment, Post, User
+from tiny.cache import LRUCache
+from tiny.models import Comment, CommentSummary, Post, User, UserSummary
 
 markdown = Markdown(hard_wrap=True)
 
+# bump the revision whenever the markdown options change so stored HTML is re-rendered
+markdown_version = 'mistune-{}-hard-wrap-1'.format(mistune_version)
+
+epoch = datetime(1970, 1, 1)
+
+# signed in users keyed by id so authenticated requests don't need to look them up
+user_cache = LRUCache(max_size=10_000, ttl=60)
+
+# rendered pages for anonymous visitors keyed by endpoint and id (bounded by total bytes and
+# expired after a short time, as other workers' caches aren't invalidated)
+response_cache = LRUCache(max_size=32 * 1024 * 1024, ttl=60, size_of=lambda value: len(value[0]))
+
 def sign_in_required(func):
     """
     Redirects to home page if not signed in. The user is passed on
@@ -83,12 +102,71 @@ def author_required(func):
     def decorated_function(*args, **kwargs):
         selected_post = kwargs['selected_post']
         current_user = kwargs['current_user']
-        if selected_post.author.id != current_user.id:
+        if get_reference_id(selected_post, 'author') != current_user.id:
             flash('Oops - you are not the author of this post.', 'danger')
             return redirect(url_for('post.show', post_id=kwargs['post_id']))
         return func(*args, **kwargs)
     return decorated_function
 
+def anonymous_response_cached(id_name):
+    """
+    Caches the responses of a view for anonymous visitors, keyed by the
+    endpoint and the view argument id_name. Visitors with a session (i.e.
+    signed in or with flashed messages) always get a fresh response.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if session:
+                return func(*args, **kwargs)
+
+            key = (request.endpoint, kwargs[id_name])
+            cached = response_cache.get(key)
+            if cached:
+                data, mimetype, etag, last_modified, private = cached
+
+                def build_response():
+                    return current_app.response_class(data, mimetype=mimetype)
+
+                # pages without validators can't be revalidated so just send them
+                if not etag:
+                    return build_response()
+
+                return conditional_response(etag, last_modified, build_response, private)
+
+            response = make_response(func(*args, **kwargs))
+
+            # don't cache anything that isn't a plain page (or might be specific to this visitor)
+            if response.status_code == 200 and not session:
+                etag, _ = response.get_etag()
+                response_cache.set(key, (response.get_data(),
+                                         response.mimetype,
+                                         etag,
+                                         response.last_modified,
+                                         bool(response.cache_control.private)))
+
+            return response
+        return decorated_function
+    return decorator
+
+def invalidate_response(endpoint, object_id):
+    """
+    Removes a cached response so it is rendered again on the next request.
+    Should be called whenever anything shown on that page changes.
+    """
+
+    response_cache.delete((endpoint, str(object_id)))
+
+def invalidate_user_responses(user_id):
+    """
+    Removes the cached responses for a user's profile and their posts (which
+    show the user's profile too).
+    """
+
+    invalidate_response('user.show', user_id)
+    for post_id in Post.objects(author=to_ObjectId(user_id)).scalar('id'):
+        invalidate_response('post.show', post_id)
+
 def to_ObjectId(value):
     """
     Safely converts value to ObjectId.
@@ -99,105 +177,416 @@ def to_ObjectId(value):
     except InvalidId:
         return ObjectId(None)
 
-def get_user(user_id=None, email=None, exclude=[]):
+def get_user(user_id=None, email=None, exclude=[], include_deleted=False):
     """
-    Queries the database for a user.
+    Queries the database for a user. Users that are being deleted are only
+    returned if include_deleted is set.
     """
 
-    return User.objects(Q(id=to_ObjectId(user_id)) | Q(email=email)) \
-               .exclude(*exclude) \
-               .first()
+    query_set = User.objects(Q(id=to_ObjectId(user_id)) | Q(email=email))
+
+    if not include_deleted:
+        query_set = query_set.filter(deleted__ne=True)
+
+    return query_set.exclude(*exclude).first()
 
 def get_current_user():
     """
-    Returns the current user.
+    Returns the current user. Users are cached for a short time so they
+    don't need to be looked up on every request.
+    """
+
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+
+    current_user = user_cache.get(user_id)
+    if current_user is None:
+        current_user = get_user(user_id)
+        if current_user:
+            user_cache.set(user_id, current_user)
+    return current_user
+
+def invalidate_user(user_id):
+    """
+    Removes a user from the cache so they are looked up again on the next
+    request. Should be called whenever a user is updated or deleted.
     """
 
-    return get_user(session.get('user_id'))
+    user_cache.delete(str(user_id))
 
-def get_posts(user_id=None, exclude=[], order_by=[], skip=0, limit=12):
+def get_field(result, name):
     """
-    Queries the database for posts.
+    Returns a field of a result, whether it is a document or a plain dict.
     """
 
-    # cap number of posts to return
-    limit = 100 if limit > 100 else limit
+    return result.get(name) if isinstance(result, dict) else getattr(result, name, None)
+
+def encode_cursor(result):
+    """
+    Encodes the position of a result as an opaque cursor.
+    """
+
+    # mongo stores dates with millisecond precision so this is lossless
+    created = (get_field(result, 'created') - epoch) // timedelta(milliseconds=1)
+    return urlsafe_b64encode('{}:{}'.format(created, get_field(result, 'id')).encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Safely decodes a cursor into a (created, id) tuple. Returns None if the
+    cursor is empty or invalid.
+    """
+
+    try:
+        created, result_id = urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return epoch + timedelta(milliseconds=int(created)), ObjectId(result_id)
+    except (BinasciiError, InvalidId, UnicodeDecodeError, ValueError):
+        return None
+
+def is_valid_cursor(cursor):
+    """
+    Returns if a cursor can be paged from (an empty cursor meaning the first
+    page).
+    """
+
+    return not cursor or decode_cursor(cursor) is not None
+
+def after_cursor(query_set, order_by, cursor):
+    """
+    Restricts a query set (ordered by creation date) to the results after
+    a cursor. Ties on creation date are broken by id so every page is a
+    bounded range scan rather than a skip.
+    """
+
+    descending = order_by[0].startswith('-')
+    query_set = query_set.order_by('-created' if descending else 'created',
+                                   '-id' if descending else 'id')
+
+    position = decode_cursor(cursor or '')
+    if not position:
+        return query_set
+
+    created, result_id = position
+    if descending:
+        return query_set.filter(Q(created__lt=created) | Q(created=created, id__lt=result_id))
+    return query_set.filter(Q(created__gt=created) | Q(created=created, id__gt=result_id))
+
+def get_posts(user_id=None, exclude=[], order_by=[], skip=0, limit=12, cursor=None):
+    """
+    Queries the database for posts. If a cursor is given (an empty cursor
+    meaning the first page) results are paged by cursor instead of skip.
+    """
+
+    skip, limit = get_page_bounds(skip, limit)
 
     # get posts by specific author
     if user_id:
-        query_set = Post.objects(author=to_ObjectId(user_id))
+        query_set = Post.objects(author=to_ObjectId(user_id), deleted__ne=True)
     # get all posts
     else:
-        query_set = Post.objects
+        query_set = Post.objects(deleted__ne=True)
+
+    # page with cursor
+    if cursor is not None:
+        return after_cursor(query_set.exclude(*exclude), order_by, cursor).limit(limit)
 
     return query_set.exclude(*exclude) \
                     .order_by(*order_by) \
                     .skip(skip) \
                     .limit(limit)
 
-def search_posts(search_text=None, exclude=[], order_by=[], skip=0, limit=12):
+def get_page_bounds(skip, limit):
     """
-    Performs a text search on posts.
+    Returns skip and limit query parameters kept within range (at most 100
+    results to a page, as a limit of zero means no limit at all to Mongo).
     """
 
-    if not search_text:
-        return []
+    return max(skip, 0), min(max(limit, 1), 100)
 
-    # cap number of posts to return
-    limit = 100 if limit > 100 else limit
+def get_post_summaries_pipeline(match, sort, skip=0, limit=12):
+    """
+    Returns the aggregation pipeline for post summaries (posts without their
+    content) that match a query, in order.
+    """
 
-    query_set = Post.objects.search_text(search_text)
+    skip, limit = get_page_bounds(skip, limit)
 
-    # need to ensure we have search text when ordering otherwise this will throw an error
-    if search_text:
-        query_set = query_set.order_by(*order_by)
+    pipeline = [{'$match': dict(match, deleted={'$ne': True})}, {'$sort': sort}]
+    if skip:
+        pipeline.append({'$skip': skip})
+    pipeline.extend([
+        {'$limit': limit},
+        {'$project': {'author': 1,
+                      'author_snapshot': 1,
+                      'title': 1,
+                      'lead_paragraph': 1,
+                      'image_url': 1,
+                      'comment_count': 1,
+                      'created': 1,
+                      'last_updated': 1}}
+    ])
+    return pipeline
 
-    return query_set.exclude(*exclude) \
-                    .skip(skip) \
-                    .limit(limit)
+def aggregate_post_summaries(match, sort, skip=0, limit=12):
+    """
+    Queries the database for post summaries (posts without their content, along
+    with their author's snapshot) in a single aggregation. Results are returned
+    as plain dicts ready to be serialized.
+    """
+
+    sons = list(Post.objects.aggregate(*get_post_summaries_pipeline(match, sort, skip, limit)))
+    authors = get_author_summaries(sons)
+
+    summaries = []
+    for summary in sons:
+        author = authors.get(summary['author'])
+        if not author:
+            continue
+        summary.pop('author_snapshot', None)
+        summary.setdefault('comment_count', 0)
+        summary['id'] = str(summary.pop('_id'))
+        summary['author'] = author.serialize()
+        summaries.append(summary)
+    return summaries
+
+def get_post_summaries_query(user_id=None, cursor=None):
+    """
+    Returns the match and sort of the latest posts (or the latest posts by a
+    specific author), after a cursor if one is given.
+    """
+
+    match = {'author': to_ObjectId(user_id)} if user_id else {}
+    if cursor is None:
+        return match, {'created': -1}
+
+    position = decode_cursor(cursor)
+    if position:
+        created, result_id = position
+        match['$or'] = [{'created': {'$lt': created}}, {'created': created, '_id': {'$lt': result_id}}]
+    return match, SON([('created', -1), ('_id', -1)])
+
+def get_post_summaries(user_id=None, skip=0, limit=12, cursor=None):
+    """
+    Returns summaries of the latest posts (or the latest posts by a specific
+    author). If a cursor is given (an empty cursor meaning the first page)
+    results are paged by cursor instead of skip.
+    """
+
+    match, sort = get_post_summaries_query(user_id, cursor)
+    return aggregate_post_summaries(match, sort, skip=skip if cursor is None else 0, limit=limit)
 
 def get_post(post_id=None, exclude=[]):
     """
     Returns a post.
     """
 
-    return Post.objects(id=to_ObjectId(post_id)) \
+    return Post.objects(id=to_ObjectId(post_id), deleted__ne=True) \
                .exclude(*exclude) \
                .first()
 
-def get_comments(user_id=None, post_id=None, exclude=[], order_by=[], skip=0, limit=12):
+def get_comments(user_id=None, post_id=None, exclude=[], order_by=[], skip=0, limit=12, cursor=None):
     """
-    Returns comments on a post.
+    Returns comments on a post. If a cursor is given (an empty cursor
+    meaning the first page) results are paged by cursor instead of skip.
     """
 
-    # cap number of comments to return
-    limit = 100 if limit > 100 else limit
+    skip, limit = get_page_bounds(skip, limit)
 
-    return Comment.objects(Q(author=to_ObjectId(user_id)) | Q(post=to_ObjectId(post_id))) \
-                  .exclude(*exclude) \
-                  .order_by(*order_by) \
-                  .skip(skip) \
-                  .limit(limit)
+    query_set = Comment.objects(Q(author=to_ObjectId(user_id)) | Q(post=to_ObjectId(post_id)), deleted__ne=True)
+
+    # page with cursor
+    if cursor is not None:
+        return after_cursor(query_set.exclude(*exclude), order_by, cursor).limit(limit)
+
+    return query_set.exclude(*exclude) \
+                    .order_by(*order_by) \
+                    .skip(skip) \
+                    .limit(limit)
+
+def get_author_summaries(sons):
+    """
+    Returns summaries of the authors of a group of raw documents, keyed by id.
+    Authors are read from the documents' snapshots, and any documents without
+    one have their authors fetched in one query.
+    """
+
+    summaries = {}
+    for son in sons:
+        snapshot = son.get('author_snapshot')
+        if snapshot and son['author'] not in summaries:
+            summaries[son['author']] = UserSummary(dict(snapshot, _id=snapshot['id']))
+
+    author_ids = list({son['author'] for son in sons} - set(summaries))
+    if author_ids:
+        authors = User.objects(id__in=author_ids).only(*UserSummary.fields).as_pymongo()
+        summaries.update({son['_id']: UserSummary(son) for son in authors})
+
+    return summaries
+
+def get_comment_summaries(post_id=None, skip=0, limit=12, cursor=None):
+    """
+    Returns read only summaries of the comments on a post (oldest first), built
+    straight from the raw documents.
+    """
+
+    sons = list(get_comments(post_id=post_id, order_by=['created'], skip=skip, limit=limit, cursor=cursor)
+                .only(*CommentSummary.fields)
+                .as_pymongo())
+    authors = get_author_summaries(sons)
+    return [CommentSummary(son, authors.get(son['author'])) for son in sons]
+
+def increment_comment_count(post_id):
+    """
+    Atomically adds a comment to a post's comment count.
+    """
+
+    Post.objects(id=to_ObjectId(post_id)).update_one(inc__comment_count=1)
+
+def decrement_comment_counts(user_id):
+    """
+    Takes a user's comments off the comment counts of the posts they were made
+    on. Should be called before marking the user's comments as deleted.
+    """
+
+    counts = Comment.objects(author=to_ObjectId(user_id), deleted__ne=True).aggregate(
+        {'$group': {'_id': '$post', 'count': {'$sum': 1}}}
+    )
+    updates = [UpdateOne({'_id': count['_id']}, {'$inc': {'comment_count': -count['count']}}) for count in counts]
+    if updates:
+        Post._get_collection().bulk_write(updates, ordered=False)  # pylint: disable=protected-access
 
 def get_comment(comment_id=None, exclude=[]):
     """
     Returns a comment.
     """
 
-    return Comment.objects(id=to_ObjectId(comment_id)) \
+    return Comment.objects(id=to_ObjectId(comment_id), deleted__ne=True) \
                   .exclude(*exclude) \
                   .first()
 
+def get_reference_id(document, field_name):
+    """
+    Returns the id a reference field points to without dereferencing it.
+    """
+
+    # pylint: disable=protected-access
+    value = document._data.get(field_name) if field_name in document._fields else None
+    return getattr(value, 'id', value)
+
 def serialize(results):
     """
-    Serializes a group of results.
+    Serializes a group of results (documents, summaries or plain dicts, which
+    are already serialized).
     """
 
     serialized = []
     for result in results:
-        serialized.append(result.serialize())
+        serialized.append(result if isinstance(result, dict) else result.serialize())
     return serialized
 
+def serialize_page(results):
+    """
+    Serializes a page of results along with the cursor of the last result
+    (None if the page is empty).
+    """
+
+    results = list(results)
+    return {'results': serialize(results), 'cursor': encode_cursor(results[-1]) if results else None}
+
+def find_winning_plan(explained):
+    """
+    Returns the winning plan of an explained query, wherever it is nested (e.g.
+    aggregations explain the plan of their first stage's cursor).
+    """
+
+    if isinstance(explained, dict):
+        if 'winningPlan' in explained:
+            return explained['winningPlan']
+        values = explained.values()
+    elif isinstance(explained, list):
+        values = explained
+    else:
+        return None
+
+    for value in values:
+        plan = find_winning_plan(value)
+        if plan:
+            return plan
+    return None
+
+def get_etag(*parts):
+    """
+    Returns an ETag for a response built from the given parts (and the
+    request's query string, as that changes the response too).
+    """
+
+    parts = parts + (request.query_string,)
+    return sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+def is_not_modified(etag, last_modified):
+    """
+    Returns if the client already has the current version of a response
+    according to its If-None-Match/If-Modified-Since headers.
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+
+    return False
+
+def conditional_response(etag, last_modified, build_response, private=False):
+    """
+    Returns a 304 response if the client already has the current version of
+    a response, otherwise calls build_response to build it. Either way the
+    response carries the validators so the client can ask again later, and
+    must ask again before reusing it. Responses that depend on the session
+    should be private so shared caches don't keep them.
+    """
+
+    if is_not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(build_response())
+
+    # weak as the same version can be serialized/rendered slightly differently
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+
+    # otherwise browsers may reuse the response (e.g. a stale feed) without revalidating it
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+        response.vary.add('Cookie')
+
+    return response
+
+def conditional_jsonify(results, serializer):
+    """
+    Returns a JSON response of serialized results (or 304 if the client
+    already has them). Results are only serialized if needed. The response
+    has no Last-Modified date, as the newest date in a list doesn't change
+    when results are removed or slide in from the next page.
+    """
+
+    results = list(results)
+
+    # comment counts and author snapshots change without the results being updated
+    parts = []
+    for result in results:
+        author = get_field(result, 'author')
+        if author is not None and not isinstance(author, dict):
+            author = author.serialize()
+        parts.append((get_field(result, 'id'),
+                      get_field(result, 'last_updated') or get_field(result, 'created'),
+                      get_field(result, 'comment_count'),
+                      *[(author or {}).get(name) for name in ('id', 'display_name', 'avatar_url', 'bio')]))
+
+    return conditional_response(get_etag(*parts), None, lambda: jsonify(serializer(results)))
+
 def request_wants_json():
     """
     Returns if a request wants JSON.
@@ -213,3 +602,22 @@ def markdown_to_html(value):
     """
 
     return markdown(value)
+
+def render_content(post):
+    """
+    Renders a post's content to HTML so it can be stored alongside the content.
+    """
+
+    post.content_html = markdown_to_html(post.content)
+    post.content_html_version = markdown_version
+    return post
+
+def content_to_html(post):
+    """
+    Returns a post's stored content HTML, falling back to rendering the content
+    if the HTML is missing or was rendered by a different version.
+    """
+
+    if post.content_html is not None and post.content_html_version == markdown_version:
+        return post.content_html
+    return markdown_to_html(post.content)
@@ -0,0 +1,270 @@
+"""
+Exports a durable background job queue backed by the jobs collection. Jobs
+are leased atomically (with find_one_and_update) so only one worker runs a job
+at a time. A lease hides the job from other workers until it times out, so
+jobs held by a worker that crashed are picked up again, and failed jobs are
+retried with exponential backoff. Workers run as threads inside each web
+process or as a standalone process (see the run-worker command).
+"""
+
+import os
+import traceback
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo import ReturnDocument
+
+from tiny.models import Job
+
+# registered job functions keyed by name
+tasks = {}
+
+def task(func):
+    """
+    Registers a function so it can be run as a job.
+    """
+
+    tasks[__task_name__(func)] = func
+    return func
+
+#
+# Private helper functions.
+#
+
+__stats__ = {
+    'leased': 0,
+    'completed': 0,
+    'retried': 0,
+    'failed': 0,
+    'queue_seconds': 0.0,
+    'run_seconds': 0.0
+}
+
+__stats_lock__ = Lock()
+
+__worker__ = {'pid': None, 'worker': None}
+
+__worker_lock__ = Lock()
+
+def __task_name__(func):
+    return '{}.{}'.format(func.__module__, func.__name__)
+
+def __update_stats__(**changes):
+    with __stats_lock__:
+        for name, change in changes.items():
+            __stats__[name] += change
+
+def __finish__(job, **updates):
+    # only the current lease holder can finish a job (its lease may have expired and been taken over)
+    return Job.objects(id=job.id, lease=job.lease).update_one(unset__lease=True,
+                                                               set__finished=datetime.now(),
+                                                               **updates)
+
+def __fail__(job, error):
+    if job.attempts >= job.max_attempts:
+        __update_stats__(failed=1)
+        return __finish__(job, set__status='failed', set__error=error)
+
+    # back off exponentially (up to an hour) between attempts
+    delay = timedelta(seconds=min(current_app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1), 60 * 60))
+    __update_stats__(retried=1)
+    return Job.objects(id=job.id, lease=job.lease).update_one(unset__lease=True,
+                                                               set__status='queued',
+                                                               set__error=error,
+                                                               set__run_after=datetime.now() + delay)
+
+#
+# Job functions.
+#
+
+def enqueue(func, **kwargs):
+    """
+    Queues a registered function to be run in the background with the given
+    keyword arguments (which must be storable in Mongo). Returns the job.
+    """
+
+    name = __task_name__(func)
+    if name not in tasks:
+        raise ValueError('{} is not a registered task'.format(name))
+
+    return Job(name=name, args=kwargs, max_attempts=current_app.config['JOB_MAX_ATTEMPTS']).save()
+
+def lease_job():
+    """
+    Leases the next job that is ready to run (i.e. queued, or running with an
+    expired lease). Returns None if there isn't one.
+    """
+
+    now = datetime.now()
+    son = Job._get_collection().find_one_and_update(  # pylint: disable=protected-access
+        {'status': {'$in': ['queued', 'running']}, 'run_after': {'$lte': now}},
+        {
+            '$set': {
+                'status': 'running',
+                'lease': str(ObjectId()),
+                'run_after': now + timedelta(seconds=current_app.config['JOB_LEASE_TIMEOUT'])
+            },
+            '$min': {'started': now},
+            '$inc': {'attempts': 1}
+        },
+        sort=[('run_after', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if not son:
+        return None
+
+    job = Job._from_son(son)  # pylint: disable=protected-access
+    __update_stats__(leased=1, queue_seconds=(now - job.created).total_seconds() if job.attempts == 1 else 0)
+    return job
+
+def run_job(job):
+    """
+    Runs a leased job, then marks it as done or (if it raised an exception)
+    schedules a retry or marks it as failed. Returns if the job succeeded.
+    """
+
+    # jobs that keep taking down their worker are given up on once they run out of attempts
+    if job.attempts > job.max_attempts:
+        __fail__(job, job.error or 'Lease expired')
+        return False
+
+    start = perf_counter()
+    try:
+        func = tasks.get(job.name)
+        if func is None:
+            raise LookupError('{} is not a registered task'.format(job.name))
+        func(**job.args)
+    except Exception:  # pylint: disable=broad-except
+        current_app.logger.exception('Job %s (%s) failed', job.id, job.name)
+        __fail__(job, traceback.format_exc()[-2000:])
+        return False
+
+    __update_stats__(completed=1, run_seconds=perf_counter() - start)
+    __finish__(job, set__status='done')
+    return True
+
+def run_jobs(limit=None):
+    """
+    Runs jobs on the current thread until none are ready (or limit jobs have
+    been run). Returns the number of jobs run.
+    """
+
+    count = 0
+    while limit is None or count < limit:
+        job = lease_job()
+        if not job:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+def get_stats():
+    """
+    Returns the job counters (cumulative for this process) so job throughput
+    and queue latency can be measured.
+    """
+
+    with __stats_lock__:
+        return dict(__stats__)
+
+def get_queue_stats(window=60 * 60):
+    """
+    Returns the number of jobs in each status, along with the number of jobs
+    finished and their mean queue latency (seconds from being queued to first
+    being run) over the last window seconds, across all workers.
+    """
+
+    stats = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    for count in Job.objects.aggregate({'$group': {'_id': '$status', 'count': {'$sum': 1}}}):
+        stats[count['_id']] = count['count']
+
+    recent = Job.objects(status='done', finished__gte=datetime.now() - timedelta(seconds=window)).aggregate(
+        {'$group': {
+            '_id': None,
+            'count': {'$sum': 1},
+            'queue_milliseconds': {'$avg': {'$subtract': ['$started', '$created']}}
+        }}
+    )
+    recent = next(recent, None) or {'count': 0, 'queue_milliseconds': None}
+    stats['recently_done'] = recent['count']
+    stats['mean_queue_seconds'] = None
+    if recent['queue_milliseconds'] is not None:
+        stats['mean_queue_seconds'] = recent['queue_milliseconds'] / 1000
+
+    return stats
+
+#
+# Worker definitions.
+#
+
+class Worker:
+    """
+    Runs jobs on a pool of threads, each polling for the next job that is
+    ready whenever it runs out of work.
+    """
+
+    def __init__(self, app, threads=1, poll_interval=1):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.__stopping = Event()
+        self.__threads = []
+
+    def start(self):
+        """
+        Starts the worker's threads.
+        """
+
+        for i in range(self.threads):
+            thread = Thread(target=self.__run, name='tiny-worker-{}'.format(i), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def join(self):
+        """
+        Waits for the worker to stop.
+        """
+
+        for thread in self.__threads:
+            # wake up periodically so the main thread can still handle signals
+            while thread.is_alive():
+                thread.join(1)
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker, waiting for any jobs that are running to finish.
+        """
+
+        self.__stopping.set()
+        for thread in self.__threads:
+            thread.join(timeout)
+
+    def __run(self):
+        with self.app.app_context():
+            while not self.__stopping.is_set():
+                try:
+                    ran = run_jobs(limit=1)
+                except Exception:  # pylint: disable=broad-except
+                    # e.g. lost connection to the database so try again later
+                    current_app.logger.exception('Worker failed to lease a job')
+                    ran = 0
+
+                if not ran:
+                    self.__stopping.wait(self.poll_interval)
+
+def start_worker(app):
+    """
+    Starts a worker for the current process, unless it already has one. Each
+    process needs its own as threads don't survive a fork (e.g. by gunicorn
+    workers).
+    """
+
+    with __worker_lock__:
+        if __worker__['pid'] != os.getpid():
+            __worker__['pid'] = os.getpid()
+            __worker__['worker'] = Worker(app, threads=app.config['JOB_THREADS'])
+            __worker__['worker'].start()
+        return __worker__['worker']
@@ -0,0 +1,331 @@
+"""
+Exports functions to record metrics for each request (latency, responses and
+the Mongo commands it ran) and to render them, along with the job, password
+pool and cache counters, in the Prometheus text format. Metrics are
+kept per process. If METRICS_DIR is set each process also writes its metrics
+to a file in that directory (at most every METRICS_INTERVAL seconds) so
+the metrics of every worker (e.g. of gunicorn) can be added up by whichever
+worker serves /metrics. Counters of workers that have exited are folded into
+one file (so totals never go backwards) and gauges are reported per worker.
+"""
+
+import fcntl
+import json
+import os
+import re
+from threading import Lock
+from time import monotonic, perf_counter, time
+
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+from tiny import jobs, passwords
+from tiny.helpers import response_cache, user_cache
+from tiny.search_backends import get_cache_stats
+
+# upper bounds (in seconds) of the request latency histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# metric names, types and descriptions
+descriptions = {
+    'tiny_request_duration_seconds': ('histogram', 'Time taken to respond to requests.'),
+    'tiny_responses_total': ('counter', 'Responses sent.'),
+    'tiny_mongo_commands_total': ('counter', 'Mongo commands run.'),
+    'tiny_mongo_command_duration_seconds_total': ('counter', 'Time spent running Mongo commands.'),
+    'tiny_mongo_command_failures_total': ('counter', 'Mongo commands that failed.'),
+    'tiny_jobs_total': ('counter', 'Background jobs leased, completed, retried or failed.'),
+    'tiny_password_requests_total': ('counter', 'Passwords submitted, rejected, timed out or completed.'),
+    'tiny_search_cache_requests_total': ('counter', 'Search cache hits and misses.'),
+    'tiny_search_cache_entries': ('gauge', 'Searches cached.'),
+    'tiny_user_cache_requests_total': ('counter', 'User cache hits and misses.'),
+    'tiny_user_cache_entries': ('gauge', 'Users cached.'),
+    'tiny_response_cache_requests_total': ('counter', 'Response cache hits and misses.'),
+    'tiny_response_cache_entries': ('gauge', 'Responses cached.')
+}
+
+# files each process writes its metrics to (named after its pid and when it first wrote them)
+process_file_pattern = re.compile(r'^metrics-(\d+)-\d+\.json$')
+
+# file the counters of exited processes are added up in
+exited_filename = 'metrics-exited.json'
+
+#
+# Private helper functions.
+#
+
+__metrics__ = {}
+
+__metrics_lock__ = Lock()
+
+__state__ = {'listening': False, 'flushed': None, 'pid': None, 'started': None}
+
+__flush_lock__ = Lock()
+
+def __key__(name, **labels):
+    return (name, tuple(sorted(labels.items())))
+
+def __increment__(name, amount=1, **labels):
+    key = __key__(name, **labels)
+    with __metrics_lock__:
+        __metrics__[key] = __metrics__.get(key, 0) + amount
+
+def __observe__(name, value, **labels):
+    key = __key__(name, **labels)
+    with __metrics_lock__:
+        counts = __metrics__.setdefault(key, [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+def __snapshot__():
+    # this process's metrics along with the counters kept by other modules (as json friendly rows)
+    with __metrics_lock__:
+        rows = [[name, list(labels), value] for (name, labels), value in __metrics__.items()]
+
+    for status in ('leased', 'completed', 'retried', 'failed'):
+        rows.append(['tiny_jobs_total', [['status', status]], jobs.get_stats()[status]])
+    for status in ('submitted', 'rejected', 'timed_out', 'completed'):
+        rows.append(['tiny_password_requests_total', [['status', status]], passwords.get_stats()[status]])
+
+    cache_stats = get_cache_stats()
+    rows.append(['tiny_search_cache_requests_total', [['result', 'hit']], cache_stats['hits']])
+    rows.append(['tiny_search_cache_requests_total', [['result', 'miss']], cache_stats['misses']])
+    rows.append(['tiny_search_cache_entries', [], cache_stats['entries']])
+
+    for name, cache in (('user', user_cache), ('response', response_cache)):
+        rows.append(['tiny_{}_cache_requests_total'.format(name), [['result', 'hit']], cache.hits])
+        rows.append(['tiny_{}_cache_requests_total'.format(name), [['result', 'miss']], cache.misses])
+        rows.append(['tiny_{}_cache_entries'.format(name), [], len(cache)])
+
+    return rows
+
+def __is_gauge__(name):
+    return descriptions.get(name, ('counter',))[0] == 'gauge'
+
+def __merge__(totals, rows, pid=None):
+    for name, labels, value in rows:
+        key = (name, tuple(tuple(label) for label in labels))
+
+        # gauges are a reading of one process, so are reported per process rather than added up
+        if __is_gauge__(name):
+            if pid is not None:
+                key = (name, tuple(sorted(key[1] + (('pid', pid),))))
+            totals[key] = value
+        elif isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            for i, part in enumerate(value):
+                total[i] += part
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def __read_rows__(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # e.g. removed while being read
+        return []
+
+def __write_rows__(path, rows):
+    temporary_path = '{}.tmp'.format(path)
+    with open(temporary_path, 'w') as f:
+        json.dump(rows, f)
+
+    # replace the file in one go so it is never read half written
+    os.replace(temporary_path, path)
+
+def __is_running__(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, but as another user
+        return True
+    return True
+
+def __collect_exited__(directory, filenames):
+    # fold the counters of processes that have exited into one file (their gauges no longer mean anything)
+    exited = [filename for filename in filenames
+              if not __is_running__(int(process_file_pattern.match(filename).group(1)))]
+    if not exited:
+        return
+
+    exited_path = os.path.join(directory, exited_filename)
+    totals = {}
+    __merge__(totals, __read_rows__(exited_path))
+    for filename in exited:
+        __merge__(totals, [row for row in __read_rows__(os.path.join(directory, filename)) if not __is_gauge__(row[0])])
+
+    __write_rows__(exited_path, [[name, [list(label) for label in labels], value]
+                                 for (name, labels), value in totals.items()])
+    for filename in exited:
+        os.remove(os.path.join(directory, filename))
+
+def __add_up__(directory):
+    totals = {}
+
+    # one process at a time so exited processes' counters are added exactly once
+    with open(os.path.join(directory, 'metrics.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        __collect_exited__(directory, [filename for filename in os.listdir(directory)
+                                       if process_file_pattern.match(filename)])
+
+        for filename in sorted(os.listdir(directory)):
+            match = process_file_pattern.match(filename)
+            if match or filename == exited_filename:
+                __merge__(totals, __read_rows__(os.path.join(directory, filename)), match and match.group(1))
+
+    return totals
+
+def __format_labels__(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(labels, escaped)) + '}'
+
+def __format_number__(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#
+# Listener definitions.
+#
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Counts and times the Mongo commands run, by the endpoint that ran them
+    (or 'background' if they weren't run by a request).
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.__record(event, failed=False)
+
+    def failed(self, event):
+        self.__record(event, failed=True)
+
+    def __record(self, event, failed):
+        endpoint = get_endpoint()
+        seconds = event.duration_micros / 1_000_000
+
+        __increment__('tiny_mongo_commands_total', endpoint=endpoint, command=event.command_name)
+        __increment__('tiny_mongo_command_duration_seconds_total',
+                      seconds,
+                      endpoint=endpoint,
+                      command=event.command_name)
+        if failed:
+            __increment__('tiny_mongo_command_failures_total', endpoint=endpoint, command=event.command_name)
+
+#
+# Metrics functions.
+#
+
+def get_endpoint():
+    """
+    Returns the endpoint of the current request ('none' if no route matched,
+    or 'background' if there isn't a request).
+    """
+
+    if not has_request_context():
+        return 'background'
+    return request.endpoint or 'none'
+
+def init_app(app):
+    """
+    Records metrics for an app's requests and (for every app in this process)
+    Mongo commands. Must be called before connecting to Mongo for the Mongo
+    commands to be recorded.
+    """
+
+    # listeners are registered globally so only register ours once
+    with __metrics_lock__:
+        if not __state__['listening']:
+            monitoring.register(CommandMetrics())
+            __state__['listening'] = True
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_start' in g:
+            endpoint = get_endpoint()
+            __observe__('tiny_request_duration_seconds', perf_counter() - g.metrics_start, endpoint=endpoint)
+            __increment__('tiny_responses_total',
+                          endpoint=endpoint,
+                          method=request.method,
+                          status=str(response.status_code))
+
+        if app.config['METRICS_DIR']:
+            now = monotonic()
+            if __state__['flushed'] is None or now - __state__['flushed'] >= app.config['METRICS_INTERVAL']:
+                flush_metrics(app.config['METRICS_DIR'])
+
+        return response
+
+def flush_metrics(directory):
+    """
+    Writes this process's metrics to a file in a directory shared by every
+    process.
+    """
+
+    with __flush_lock__:
+        # a forked process (or a new one reusing a pid) gets a file of its own
+        if __state__['pid'] != os.getpid():
+            __state__['pid'] = os.getpid()
+            __state__['started'] = int(time() * 1000)
+
+        __state__['flushed'] = monotonic()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'metrics-{}-{}.json'.format(__state__['pid'], __state__['started']))
+        __write_rows__(path, __snapshot__())
+
+def render_metrics(directory=None):
+    """
+    Returns the metrics in the Prometheus text format. If a directory is
+    given the metrics written there by every process are added up, otherwise
+    only this process's metrics are returned.
+    """
+
+    if directory:
+        flush_metrics(directory)
+        totals = __add_up__(directory)
+    else:
+        totals = {}
+        __merge__(totals, __snapshot__())
+
+    lines = []
+    for name, (metric_type, description) in descriptions.items():
+        keys = sorted(key for key in totals if key[0] == name)
+        if not keys:
+            continue
+
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for _, labels in keys:
+            value = totals[(name, labels)]
+            if metric_type != 'histogram':
+                lines.append('{}{} {}'.format(name, __format_labels__(labels), __format_number__(value)))
+                continue
+
+            for bound, count in zip(buckets, value):
+                lines.append('{}_bucket{} {}'.format(name, __format_labels__(labels, le=str(bound)), count))
+            lines.append('{}_bucket{} {}'.format(name, __format_labels__(labels, le='+Inf'), value[-1]))
+            lines.append('{}_sum{} {}'.format(name, __format_labels__(labels), __format_number__(value[-2])))
+            lines.append('{}_count{} {}'.format(name, __format_labels__(labels), value[-1]))
+
+    return '\n'.join(lines) + '\n'
+
+def reset_metrics():
+    """
+    Removes the metrics recorded by this process.
+    """
+
+    with __metrics_lock__:
+        __metrics__.clear()
@@ -5,10 +5,16 @@ Exports Tiny app data models.
 from datetime import datetime
 
 from flask import url_for
-from mongoengine import (CASCADE,
+from mongoengine import (BooleanField,
                          DateTimeField,
+                         DictField,
                          Document,
                          EmailField,
+                         EmbeddedDocument,
+                         EmbeddedDocumentField,
+                         FloatField,
+                         IntField,
+                         ObjectIdField,
                          ReferenceField,
                          StringField,
                          URLField)
@@ -35,6 +41,9 @@ def __default_post_image_path__():
 # Model definitions.
 #
 
+# how much a search match in each post field counts for
+search_weights = {'title': 10, 'lead_paragraph': 5, 'content': 2}
+
 class User(Document):
     """
     Represents users.
@@ -45,6 +54,7 @@ class User(Document):
     display_name = StringField(required=True, min_length=1, max_length=50)
     bio = StringField(max_length=160)
     avatar_url = URLField(required=True, default=__default_avatar_image_path__)
+    deleted = BooleanField(default=False)
     created = DateTimeField(required=True, default=datetime.now)
 
     def serialize(self):
@@ -61,42 +71,108 @@ class User(Document):
             'created': self.created
         })
 
+class AuthorSnapshot(EmbeddedDocument):
+    """
+    Represents a copy of the public profile fields of a post's or comment's
+    author, stored with the post or comment so it can be shown without looking
+    up the author.
+    """
+
+    id = ObjectIdField(required=True)
+    display_name = StringField(required=True)
+    avatar_url = StringField(required=True)
+    bio = StringField()
+    created = DateTimeField()
+
+    @classmethod
+    def from_user(cls, user):
+        """
+        Takes a snapshot of a user.
+        """
+
+        # mongo stores dates with millisecond precision so snapshots of saved and unsaved users compare equal
+        created = user.created.replace(microsecond=user.created.microsecond // 1000 * 1000)
+        return cls(id=user.id,
+                   display_name=user.display_name,
+                   avatar_url=user.avatar_url,
+                   bio=user.bio,
+                   created=created)
+
+    def serialize(self):
+        """
+        Serialize author snapshot to JSON (the same as the user it was taken of).
+        """
+
+        return __delete_none__({
+            'id': str(self.id),
+            'display_name': self.display_name,
+            'bio': self.bio,
+            'avatar_url': self.avatar_url,
+            'created': self.created
+        })
+
 class Post(Document):
     """
     Represents posts.
     """
 
-    author = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
+    author = ReferenceField(User, required=True)
+    author_snapshot = EmbeddedDocumentField(AuthorSnapshot)
     title = StringField(required=True, min_length=1, max_length=160)
     lead_paragraph = StringField(max_length=500)
     image_url = StringField(required=True, default=__default_post_image_path__)
     content = StringField(required=True, min_length=1, max_length=10_000)
+    content_html = StringField()
+    content_html_version = StringField()
+    comment_count = IntField(default=0)
+    deleted = BooleanField(default=False)
     created = DateTimeField(required=True, default=datetime.now)
     last_updated = DateTimeField()
 
-    # for text search
     meta = {
         'indexes': [
+            # for text search
             {
                 'default_language': 'english',
-                'fields': ['$title', '$lead_paragraph', '$content'],
-                'weights': {'title': 10, 'lead_paragraph': 5, 'content': 2}
-            }
+                'fields': ['$' + field for field in search_weights],
+                'weights': search_weights
+            },
+            # for latest posts and author's posts (id breaks ties when paging by cursor)
+            ('-created', '-id'),
+            ('author', '-created', '-id')
         ]
     }
 
+    def clean(self):
+        """
+        Takes a snapshot of the author when the post is first saved.
+        """
+
+        if self.author_snapshot is None and self.author:
+            self.author_snapshot = AuthorSnapshot.from_user(self.author)
+
+    def get_author(self):
+        """
+        Returns the author's snapshot, falling back to the author themselves
+        for posts saved before snapshots were taken.
+        """
+
+        return self.author_snapshot or self.author
+
     def serialize(self):
         """
         Serialize post to JSON.
         """
 
+        author = self.get_author()
         return __delete_none__({
             'id': str(self.id),
-            'author': self.author.serialize() if self.author else None,
+            'author': author.serialize() if author else None,
             'title': self.title,
             'lead_paragraph': self.lead_paragraph,
             'image_url': self.image_url,
             'content': self.content,
+            'comment_count': self.comment_count,
             'created': self.created,
             'last_updated': self.last_updated
         })
@@ -106,20 +182,179 @@ class Comment(Document):
     Represents comments.
     """
 
-    author = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
-    post = ReferenceField(Post, required=True, reverse_delete_rule=CASCADE)
+    author = ReferenceField(User, required=True)
+    author_snapshot = EmbeddedDocumentField(AuthorSnapshot)
+    post = ReferenceField(Post, required=True)
     text = StringField(required=True, min_length=1, max_length=500)
+    deleted = BooleanField(default=False)
     created = DateTimeField(required=True, default=datetime.now)
 
+    meta = {
+        'indexes': [
+            # for post's comments and author's comments (id breaks ties when paging by cursor)
+            ('post', 'created', 'id'),
+            ('author', 'created', 'id')
+        ]
+    }
+
+    def clean(self):
+        """
+        Takes a snapshot of the author when the comment is first saved.
+        """
+
+        if self.author_snapshot is None and self.author:
+            self.author_snapshot = AuthorSnapshot.from_user(self.author)
+
+    def get_author(self):
+        """
+        Returns the author's snapshot, falling back to the author themselves
+        for comments saved before snapshots were taken.
+        """
+
+        return self.author_snapshot or self.author
+
     def serialize(self):
         """
         Serialize comment to JSON.
         """
 
+        author = self.get_author()
         return __delete_none__({
             'id': str(self.id),
-            'author': self.author.serialize() if self.author else None,
+            'author': author.serialize() if author else None,
             'post': self.post.serialize() if self.post else None,
             'text': self.text,
             'created': self.created
         })
+
+class Deletion(Document):
+    """
+    Represents the progress of deleting a user or post (along with everything
+    that belongs to them) in the background.
+    """
+
+    target_type = StringField(required=True, choices=('user', 'post'))
+    target_id = ObjectIdField(required=True)
+    posts_deleted = IntField(default=0)
+    comments_deleted = IntField(default=0)
+    created = DateTimeField(required=True, default=datetime.now)
+    finished = DateTimeField()
+
+    meta = {
+        'indexes': [
+            # for finding unfinished deletions to resume
+            'finished'
+        ]
+    }
+
+class Job(Document):
+    """
+    Represents a unit of background work. Workers lease queued jobs (hiding
+    them from other workers until the lease's visibility timeout) and failed
+    jobs are retried with backoff.
+    """
+
+    name = StringField(required=True)
+    args = DictField()
+    status = StringField(required=True, default='queued', choices=('queued', 'running', 'done', 'failed'))
+    attempts = IntField(default=0)
+    max_attempts = IntField(default=5)
+    run_after = DateTimeField(required=True, default=datetime.now)
+    lease = StringField()
+    error = StringField()
+    created = DateTimeField(required=True, default=datetime.now)
+    started = DateTimeField()
+    finished = DateTimeField()
+
+    meta = {
+        'indexes': [
+            # for leasing the next job that is ready to run
+            ('status', 'run_after'),
+            # for clearing out finished jobs after a week
+            {'fields': ['finished'], 'expireAfterSeconds': 7 * 24 * 60 * 60}
+        ]
+    }
+
+class SlowQuery(Document):
+    """
+    Represents a Mongo command that took longer than SLOW_QUERY_THRESHOLD,
+    recorded by its shape (the command with any literal values redacted) so
+    slow queries can be grouped. Some include a summary of the query plan.
+    """
+
+    shape = StringField(required=True)
+    command_name = StringField(required=True)
+    collection = StringField()
+    endpoint = StringField(required=True)
+    duration = FloatField(required=True)
+    plan = StringField()
+    created = DateTimeField(required=True, default=datetime.now)
+
+    meta = {
+        'indexes': [
+            # for clearing out slow queries after a week
+            {'fields': ['created'], 'expireAfterSeconds': 7 * 24 * 60 * 60}
+        ]
+    }
+
+#
+# Read model definitions.
+#
+
+class UserSummary:
+    """
+    Read only summary of a user's public profile, built from a raw user
+    document (i.e. without the overhead of a full User document).
+    """
+
+    __slots__ = ('id', 'display_name', 'bio', 'avatar_url', 'created')
+
+    fields = ('display_name', 'bio', 'avatar_url', 'created')
+
+    def __init__(self, son):
+        self.id = son['_id']
+        self.display_name = son.get('display_name')
+        self.bio = son.get('bio')
+        self.avatar_url = son.get('avatar_url')
+        self.created = son.get('created')
+
+    def serialize(self):
+        """
+        Serialize user summary to JSON.
+        """
+
+        return __delete_none__({
+            'id': str(self.id),
+            'display_name': self.display_name,
+            'bio': self.bio,
+            'avatar_url': self.avatar_url,
+            'created': self.created
+        })
+
+class CommentSummary:
+    """
+    Read only summary of a comment (without its post), built from a raw
+    comment document and its author's summary.
+    """
+
+    __slots__ = ('id', 'author', 'text', 'created')
+
+    fields = ('author', 'author_snapshot', 'text', 'created')
+
+    def __init__(self, son, author):
+        self.id = son['_id']
+        self.author = author
+        self.text = son.get('text')
+        self.created = son.get('created')
+
+    def serialize(self):
+        """
+        Serialize comment summary to JSON.
+        """
+
+        return __delete_none__({
+            'id': str(self.id),
+            'author': self.author.serialize() if self.author else None,
+            'text': self.text,
+            'created': self.created
+        })
@@ -0,0 +1,130 @@
+"""
+Exports functions to hash and verify passwords with a limit on how many are
+hashed at once by every worker process on a host, so a burst of sign ins
+can't tie up every web worker (and CPU) hashing passwords. The limit is kept
+with lock files in PASSWORD_LOCK_DIR: PASSWORD_POOL_SIZE slots for hashing
+and PASSWORD_QUEUE_SIZE more for waiting. Once every slot is taken, new
+requests are rejected straight away rather than waiting. Hashing and waiting
+both hold the request's worker, so the slots and queue together must be
+fewer than the web workers on a host (leaving some free for other pages).
+Locks are released by the operating system if a worker dies holding them.
+"""
+
+import fcntl
+import os
+import tempfile
+from threading import Lock
+from time import perf_counter, sleep
+
+from flask import current_app
+from passlib.hash import sha256_crypt
+
+# seconds between checks for a free hashing slot
+poll_interval = 0.01
+
+class PasswordPoolSaturated(Exception):
+    """
+    Raised when the password pool is too busy to take on more work.
+    """
+
+#
+# Private helper functions.
+#
+
+__stats__ = {
+    'submitted': 0,
+    'rejected': 0,
+    'timed_out': 0,
+    'completed': 0,
+    'in_flight': 0,
+    'max_in_flight': 0,
+    'queue_seconds': 0.0,
+    'run_seconds': 0.0
+}
+
+__stats_lock__ = Lock()
+
+def __get_lock_dir__():
+    directory = current_app.config['PASSWORD_LOCK_DIR'] or os.path.join(tempfile.gettempdir(), 'tiny-passwords')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def __try_lock__(directory, kind, count):
+    # each open file holds its own lock (even within a process) so threads and processes alike are limited
+    for i in range(count):
+        lock_file = open(os.path.join(directory, '{}-{}.lock'.format(kind, i)), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            lock_file.close()
+    return None
+
+def __update_stats__(**changes):
+    with __stats_lock__:
+        for name, change in changes.items():
+            __stats__[name] += change
+        __stats__['max_in_flight'] = max(__stats__['max_in_flight'], __stats__['in_flight'])
+
+def __submit__(operation, *args):
+    directory = __get_lock_dir__()
+    size = current_app.config['PASSWORD_POOL_SIZE']
+
+    # reject straight away if every slot is busy and the queue is full
+    ticket = __try_lock__(directory, 'ticket', size + current_app.config['PASSWORD_QUEUE_SIZE'])
+    if not ticket:
+        __update_stats__(rejected=1)
+        raise PasswordPoolSaturated()
+
+    __update_stats__(submitted=1, in_flight=1)
+    start = perf_counter()
+    try:
+        slot = __try_lock__(directory, 'slot', size)
+        while not slot:
+            if perf_counter() - start >= current_app.config['PASSWORD_TIMEOUT']:
+                __update_stats__(timed_out=1)
+                raise PasswordPoolSaturated()
+            sleep(poll_interval)
+            slot = __try_lock__(directory, 'slot', size)
+
+        # closing the file releases the lock
+        with slot:
+            run_start = perf_counter()
+            if operation == 'hash':
+                result = sha256_crypt.hash(*args)
+            else:
+                result = sha256_crypt.verify(*args)
+            run_seconds = perf_counter() - run_start
+    finally:
+        ticket.close()
+        __update_stats__(in_flight=-1)
+
+    __update_stats__(completed=1, run_seconds=run_seconds, queue_seconds=run_start - start)
+    return result
+
+#
+# Password functions.
+#
+
+def hash_password(password):
+    """
+    Hashes a password.
+    """
+
+    return __submit__('hash', password)
+
+def verify_password(password, password_hash):
+    """
+    Returns if a password matches a hash.
+    """
+
+    return __submit__('verify', password, password_hash)
+
+def get_stats():
+    """
+    Returns the pool's counters (cumulative for this process) so it can be
+    sized.
+    """
+
+    with __stats_lock__:
+        return dict(__stats__)
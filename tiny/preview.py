@@ -0,0 +1,133 @@
+"""
+Exports an incremental Markdown renderer for post previews. Content is split
+into blocks and the HTML of each block is cached, so when an author toggles
+preview only the blocks they changed are rendered again.
+"""
+
+import re
+from hashlib import sha1
+from time import monotonic
+
+from tiny.cache import LRUCache
+from tiny.helpers import markdown_to_html
+
+fence_pattern = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+list_item_pattern = re.compile(r'^ {0,3}([*+-]|\d+[.)])\s')
+definition_pattern = re.compile(r'^ {0,3}\[\^?[^\]]+\]:', re.MULTILINE)
+html_pattern = re.compile(r'^ {0,3}<', re.MULTILINE)
+
+# rendered blocks keyed by a hash of their Markdown (bounded by total bytes of HTML)
+block_cache = LRUCache(max_size=4 * 1024 * 1024, size_of=lambda html: len(html.encode()))
+
+def split_blocks(content):
+    """
+    Splits content into Markdown blocks that render the same on their own as
+    they do as part of the whole content.
+    """
+
+    # link and footnote definitions affect other blocks, and raw HTML blocks (and comments) can
+    # span blank lines, so render everything together
+    if definition_pattern.search(content) or html_pattern.search(content):
+        return [content]
+
+    blocks = []
+    lines = []
+    fence = None
+
+    for line in content.replace('\r\n', '\n').split('\n'):
+        # blank lines inside fenced code don't end a block
+        if fence:
+            lines.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+            continue
+
+        if not line.strip():
+            if lines:
+                blocks.append('\n'.join(lines))
+                lines = []
+            continue
+
+        # indented lines, loose list items and blockquotes continue the previous block
+        if not lines and blocks and (line[0].isspace() or
+                                     (list_item_pattern.match(line) and list_item_pattern.match(blocks[-1])) or
+                                     (line.lstrip().startswith('>') and blocks[-1].lstrip().startswith('>'))):
+            lines = [blocks.pop(), '']
+
+        match = fence_pattern.match(line)
+        if match:
+            fence = match.group(1)
+
+        lines.append(line)
+
+    if lines:
+        blocks.append('\n'.join(lines))
+
+    return blocks
+
+def get_block_key(block):
+    """
+    Returns the cache key for a block.
+    """
+
+    return sha1(block.encode()).hexdigest()
+
+def get_render_cost(blocks):
+    """
+    Returns the number of characters that would need rendering (i.e. that
+    aren't already cached) to render a group of blocks.
+    """
+
+    return sum(len(block) for block in blocks if get_block_key(block) not in block_cache)
+
+def render_blocks(blocks):
+    """
+    Renders a group of blocks to HTML, only rendering blocks that aren't
+    already cached.
+    """
+
+    html = []
+    for block in blocks:
+        key = get_block_key(block)
+        block_html = block_cache.get(key)
+        if block_html is None:
+            block_html = markdown_to_html(block)
+            block_cache.set(key, block_html)
+        html.append(block_html)
+    return ''.join(html)
+
+class ClientBudget:
+    """
+    Limits how much each client can spend within a window of time. Only the
+    most recently seen clients are tracked so memory stays bounded.
+    """
+
+    def __init__(self, window=60, max_clients=10_000):
+        self.window = window
+        self.__spent = LRUCache(max_size=max_clients)
+
+    def spend(self, client, amount, limit):
+        """
+        Spends from a client's budget. Returns False (without spending) if
+        doing so would take the client over the limit for the current window.
+        """
+
+        now = monotonic()
+        window_start, spent = self.__spent.get(client, (now, 0))
+
+        # start a new window if the current one has passed
+        if now - window_start >= self.window:
+            window_start, spent = now, 0
+
+        if spent + amount > limit:
+            return False
+
+        self.__spent.set(client, (window_start, spent + amount))
+        return True
+
+    def clear(self):
+        """
+        Forgets what every client has spent.
+        """
+
+        self.__spent.clear()
@@ -0,0 +1,386 @@
+"""
+Exports pluggable backends for searching posts. The Mongo backend (the
+default) uses the posts text index. The BM25 backend keeps an inverted index
+of posts in each process, scoring matches with BM25 and weighting each field
+the same way as the text index. Set SEARCH_BACKEND to pick one.
+
+Search results are cached for a short time, keyed by the normalized query (so
+e.g. "Python posts" and "the post python" share an entry). Creating, updating
+or deleting a post expires the cached searches it could change.
+"""
+
+import re
+from math import log
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+
+from tiny.cache import LRUCache
+from tiny.helpers import aggregate_post_summaries, get_page_bounds
+from tiny.models import Post, search_weights
+
+token_pattern = re.compile(r'\w+')
+
+query_pattern = re.compile(r'"[^"]*"|-?[^\s"]+')
+
+stop_words = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is',
+                        'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there',
+                        'these', 'they', 'this', 'to', 'was', 'will', 'with'))
+
+# backends for this process keyed by name
+backends = {}
+
+# search results keyed by backend, normalized query, skip and limit (expired after a short time, as other
+# processes' caches aren't expired when they change posts)
+search_cache = LRUCache(max_size=10_000, ttl=60)
+
+def tokenize(text):
+    """
+    Splits text into lowercase search terms, dropping stop words and folding
+    simple plurals (e.g. so "posts" matches "post").
+    """
+
+    terms = []
+    for token in token_pattern.findall((text or '').lower()):
+        if token in stop_words:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+def normalize_query(search_text):
+    """
+    Returns a normalized search query: its terms tokenized (see tokenize),
+    deduplicated and sorted. Negated terms and quoted phrases are kept as
+    they change what the text index matches.
+    """
+
+    terms = set()
+    for token in query_pattern.findall(search_text.lower()):
+        if token.startswith('"'):
+            terms.add(token)
+        elif token.startswith('-'):
+            terms.update('-' + term for term in tokenize(token))
+        else:
+            terms.update(tokenize(token))
+    return tuple(sorted(terms))
+
+def get_search_terms(post):
+    """
+    Returns the set of terms a post can be found by.
+    """
+
+    return {term for field in search_weights for term in tokenize(getattr(post, field, None))}
+
+#
+# Private helper functions.
+#
+
+def __expire__(matches):
+    # expire every page of a search if any page matches, as a change to one page can shift the rest
+    entries = search_cache.items()
+    searches = {key[:2] for key, results in entries if matches(key[1], results)}
+    for key, _ in entries:
+        if key[:2] in searches:
+            search_cache.delete(key)
+
+#
+# Backend definitions.
+#
+
+class SearchBackend:
+    """
+    Base class for search backends. Backends that keep their own index are
+    told whenever a post is created, updated or deleted.
+    """
+
+    def search_post_summaries(self, search_text, skip=0, limit=12):
+        """
+        Returns summaries of the posts that best match the search text, best
+        matches first.
+        """
+
+        raise NotImplementedError()
+
+    def index_post(self, post):
+        """
+        Adds a post to the index (or updates it if it is already there).
+        """
+
+    def remove_post(self, post_id):
+        """
+        Removes a post from the index.
+        """
+
+class MongoTextBackend(SearchBackend):
+    """
+    Searches posts with the posts text index.
+    """
+
+    @staticmethod
+    def get_query(search_text):
+        """
+        Returns the match and sort of a search, best matches first.
+        """
+
+        return {'$text': {'$search': search_text}}, {'score': {'$meta': 'textScore'}}
+
+    def search_post_summaries(self, search_text, skip=0, limit=12):
+        match, sort = self.get_query(search_text)
+        return aggregate_post_summaries(match, sort, skip=skip, limit=limit)
+
+class BM25Backend(SearchBackend):
+    """
+    Searches posts with an in-process inverted index, scored with BM25 (each
+    field's term frequencies and length weighted by its search weight). The
+    index is built on the first search. Once it is older than ttl seconds it
+    is rebuilt on a background thread (to pick up changes made by other
+    processes), with the old index served until the new one is ready.
+    """
+
+    def __init__(self, ttl=300, k1=1.2, b=0.75):
+        self.ttl = ttl
+        self.k1 = k1
+        self.b = b
+        self.__postings = {}
+        self.__terms = {}
+        self.__lengths = {}
+        self.__total_length = 0
+        self.__built = None
+        self.__rebuilding = False
+        self.__changes = None
+        self.__lock = Lock()
+        self.__build_lock = Lock()
+
+    def __analyze(self, post):
+        frequencies = {}
+        length = 0
+        for field, weight in search_weights.items():
+            value = post.get(field) if isinstance(post, dict) else getattr(post, field, None)
+            for term in tokenize(value):
+                frequencies[term] = frequencies.get(term, 0) + weight
+                length += weight
+        return frequencies, length
+
+    def __add(self, post_id, post):
+        frequencies, length = self.__analyze(post)
+        for term, frequency in frequencies.items():
+            self.__postings.setdefault(term, {})[post_id] = frequency
+        self.__terms[post_id] = list(frequencies)
+        self.__lengths[post_id] = length
+        self.__total_length += length
+
+    def __remove(self, post_id):
+        length = self.__lengths.pop(post_id, None)
+        if length is None:
+            return
+
+        # only touch the postings of the post's own terms (rather than the whole vocabulary)
+        self.__total_length -= length
+        for term in self.__terms.pop(post_id):
+            postings = self.__postings[term]
+            del postings[post_id]
+            if not postings:
+                del self.__postings[term]
+
+    def __record(self, post_id, post=None):
+        # changes made while the index is being rebuilt are replayed on the new index
+        if self.__changes is not None:
+            self.__changes.append((post_id, post))
+
+    def __ensure_built(self):
+        # nothing can be searched until the index is first built
+        if self.__built is None:
+            self.build()
+            return
+
+        with self.__lock:
+            if self.__rebuilding or monotonic() - self.__built <= self.ttl:
+                return
+            self.__rebuilding = True
+
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        Thread(target=self.__rebuild, args=(app,), name='tiny-search-index', daemon=True).start()
+
+    def __rebuild(self, app):
+        with app.app_context():
+            try:
+                self.build()
+            except Exception:  # pylint: disable=broad-except
+                # e.g. lost connection to the database so keep the old index and try again later
+                current_app.logger.exception('Failed to rebuild search index')
+
+    def build(self):
+        """
+        Builds the index from every post, then swaps it in for the current one.
+        """
+
+        # only one build at a time so each has its own record of changes
+        with self.__build_lock:
+            with self.__lock:
+                self.__changes = []
+
+            try:
+                # read every post before touching the index (searches carry on with the current one meanwhile)
+                index = BM25Backend(self.ttl, self.k1, self.b)
+                for post in list(Post.objects(deleted__ne=True).only(*search_weights).as_pymongo()):
+                    index.__add(post['_id'], post)
+
+                with self.__lock:
+                    for post_id, post in self.__changes:
+                        index.__remove(post_id)
+                        if post is not None:
+                            index.__add(post_id, post)
+
+                    self.__postings = index.__postings
+                    self.__terms = index.__terms
+                    self.__lengths = index.__lengths
+                    self.__total_length = index.__total_length
+                    self.__built = monotonic()
+            finally:
+                with self.__lock:
+                    self.__rebuilding = False
+                    self.__changes = None
+
+    def index_post(self, post):
+        self.__ensure_built()
+        with self.__lock:
+            self.__remove(post.id)
+            self.__add(post.id, post)
+            self.__record(post.id, post)
+
+    def remove_post(self, post_id):
+        self.__ensure_built()
+        with self.__lock:
+            self.__remove(post_id)
+            self.__record(post_id)
+
+    def rank(self, search_text):
+        """
+        Returns the ids of the posts that match the search text, best matches
+        first.
+        """
+
+        self.__ensure_built()
+
+        scores = {}
+        with self.__lock:
+            count = len(self.__lengths)
+            average_length = self.__total_length / count if count else 0
+
+            for term in set(tokenize(search_text)):
+                postings = self.__postings.get(term, {})
+                idf = log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for post_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.__lengths[post_id] / average_length)
+                    scores[post_id] = scores.get(post_id, 0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        # break ties by id so the order (and so paging) is stable
+        return [post_id for post_id, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))]
+
+    def search_post_summaries(self, search_text, skip=0, limit=12):
+        skip, limit = get_page_bounds(skip, limit)
+
+        post_ids = self.rank(search_text)[skip:skip + limit]
+        if not post_ids:
+            return []
+
+        summaries = {summary['id']: summary
+                     for summary in aggregate_post_summaries({'_id': {'$in': post_ids}}, {'_id': 1}, limit=limit)}
+
+        # posts deleted by other processes won't be found, so drop them from the index too
+        for post_id in post_ids:
+            if str(post_id) not in summaries:
+                self.remove_post(post_id)
+
+        return [summaries[str(post_id)] for post_id in post_ids if str(post_id) in summaries]
+
+def get_search_backend():
+    """
+    Returns the configured search backend for this process.
+    """
+
+    name = current_app.config['SEARCH_BACKEND']
+    if name not in backends:
+        if name == 'bm25':
+            backends[name] = BM25Backend(ttl=current_app.config['SEARCH_INDEX_TTL'])
+        elif name == 'mongo':
+            backends[name] = MongoTextBackend()
+        else:
+            raise ValueError('Unknown search backend {}'.format(name))
+    return backends[name]
+
+#
+# Search functions.
+#
+
+def search_post_summaries(search_text=None, skip=0, limit=12):
+    """
+    Performs a text search for post summaries, best matches first. Results
+    are served from the search cache when possible.
+    """
+
+    if not search_text:
+        return []
+
+    key = (current_app.config['SEARCH_BACKEND'], normalize_query(search_text), skip, limit)
+    results = search_cache.get(key)
+    if results is None:
+        results = get_search_backend().search_post_summaries(search_text, skip=skip, limit=limit)
+        search_cache.set(key, results)
+    return results
+
+def index_post(post, previous_terms=()):
+    """
+    Adds a post to the search backend (or updates it) and expires the cached
+    searches it could change. When updating a post, previous_terms should be
+    its search terms from before the update.
+    """
+
+    get_search_backend().index_post(post)
+    expire_search_results(post.id, get_search_terms(post) | set(previous_terms))
+
+def remove_post(post):
+    """
+    Removes a post from the search backend and expires the cached searches
+    that could find it.
+    """
+
+    get_search_backend().remove_post(post.id)
+    expire_search_results(post.id, get_search_terms(post))
+
+def expire_search_results(post_id, terms):
+    """
+    Expires the cached searches that found a post or search for any of the
+    given terms.
+    """
+
+    post_id = str(post_id)
+    terms = set(terms)
+    __expire__(lambda query, results: terms & set(tokenize(' '.join(query)))
+               or any(result['id'] == post_id for result in results))
+
+def expire_author_search_results(author_id):
+    """
+    Expires the cached searches that found any of an author's posts (e.g. as
+    they were deleted or their profile changed).
+    """
+
+    author_id = str(author_id)
+    __expire__(lambda query, results: any(result['author']['id'] == author_id for result in results))
+
+def get_cache_stats():
+    """
+    Returns the search cache's counters (cumulative for this process) so it
+    can be tuned.
+    """
+
+    hits, misses = search_cache.hits, search_cache.misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+        'entries': len(search_cache)
+    }
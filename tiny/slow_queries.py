@@ -0,0 +1,249 @@
+"""
+Exports a recorder of slow Mongo queries. Queries that take longer than
+SLOW_QUERY_THRESHOLD milliseconds are logged and stored (see SlowQuery) by
+their shape, i.e. the command with its literal values redacted, along with
+how long they took and the route that ran them. The first time a process sees
+a shape (and then at most every EXPLAIN_INTERVAL seconds) the query is
+explained and a summary of its plan stored with it. Queries are explained
+and stored by a thread in each process rather than by the request that ran
+them. Slow queries can be browsed with the slow-queries command.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+from queue import Full, Queue
+from threading import local, Lock, Thread
+from time import monotonic
+
+from bson.son import SON
+from flask import current_app, has_app_context
+from pymongo import monitoring
+
+from tiny.helpers import find_winning_plan
+from tiny.metrics import get_endpoint
+from tiny.models import SlowQuery
+
+# commands that query a collection (and so can be explained)
+query_commands = ('aggregate', 'count', 'delete', 'distinct', 'find', 'findAndModify', 'update')
+
+# command fields that belong to the session or connection rather than the query
+session_fields = ('$clusterTime', '$db', '$readPreference', 'lsid', 'txnNumber')
+
+# command fields that don't change how a query runs
+ignored_fields = session_fields + ('batchSize', 'comment', 'cursor', 'maxTimeMS', 'readConcern', 'writeConcern')
+
+# fields whose values describe the shape of a query rather than what it matches
+structural_fields = ('$limit', '$lookup', '$project', '$skip', '$sort', 'fields', 'hint', 'limit', 'multi', 'new',
+                     'projection', 'skip', 'sort', 'upsert')
+
+# the most slow queries that can wait to be recorded (any more are dropped)
+max_queued = 1000
+
+#
+# Private helper functions.
+#
+
+__pending__ = {}
+
+__pending_lock__ = Lock()
+
+__explained__ = {}
+
+__state__ = {'listening': False, 'pid': None}
+
+__recording__ = local()
+
+__queue__ = Queue(maxsize=max_queued)
+
+def __redact__(value):
+    if isinstance(value, dict):
+        return {key: item if key in structural_fields else __redact__(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if all(not isinstance(item, (dict, list, tuple)) for item in value):
+            return ['?'] if value else []
+        return [__redact__(item) for item in value]
+    # strings starting with $ refer to fields (e.g. in an aggregation) so aren't literals
+    if isinstance(value, str) and value.startswith('$'):
+        return value
+    return '?'
+
+def __summarize_plan__(plan):
+    stage = plan['stage']
+    if 'indexName' in plan:
+        stage = '{} ({})'.format(stage, plan['indexName'])
+
+    inputs = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    if not inputs:
+        return stage
+    if len(inputs) == 1:
+        return '{} > {}'.format(stage, __summarize_plan__(inputs[0]))
+    return '{} > [{}]'.format(stage, ', '.join(__summarize_plan__(input_stage) for input_stage in inputs))
+
+def __explain__(database_name, command):
+    # explain with the planner only (i.e. without running the query again)
+    database = SlowQuery._get_db().client[database_name]  # pylint: disable=protected-access
+    command = SON((key, value) for key, value in command.items() if key not in session_fields)
+    plan = find_winning_plan(database.command('explain', command, verbosity='queryPlanner'))
+    return __summarize_plan__(plan) if plan else None
+
+def __explain_due__(shape):
+    now = monotonic()
+    with __pending_lock__:
+        explained = __explained__.get(shape)
+        if explained is not None and now - explained < current_app.config['EXPLAIN_INTERVAL']:
+            return False
+        __explained__[shape] = now
+        return True
+
+def __record__(query, duration):
+    shape = get_shape(query['command_name'], query['command'])
+    current_app.logger.warning('Slow query (%.1f ms) from %s: %s', duration, query['endpoint'], shape)
+
+    plan = None
+    if __explain_due__(shape):
+        try:
+            plan = __explain__(query['database'], query['command'])
+        except Exception:  # pylint: disable=broad-except
+            current_app.logger.exception('Failed to explain slow query: %s', shape)
+
+    SlowQuery(shape=shape,
+              command_name=query['command_name'],
+              collection=query['collection'],
+              endpoint=query['endpoint'],
+              duration=duration,
+              plan=plan).save()
+
+def __start_recording__():
+    # each process needs its own thread as threads don't survive a fork (e.g. by gunicorn workers)
+    with __pending_lock__:
+        if __state__['pid'] != os.getpid():
+            __state__['pid'] = os.getpid()
+            Thread(target=__run__, name='tiny-slow-queries', daemon=True).start()
+
+def __run__():
+    # the recorder's own queries (explaining and saving) shouldn't be recorded
+    __recording__.active = True
+
+    while True:
+        app, query, duration = __queue__.get()
+        try:
+            with app.app_context():
+                try:
+                    __record__(query, duration)
+                except Exception:  # pylint: disable=broad-except
+                    current_app.logger.exception('Failed to record slow query')
+        finally:
+            __queue__.task_done()
+
+#
+# Listener definitions.
+#
+
+class SlowQueryRecorder(monitoring.CommandListener):
+    """
+    Records the queries that take longer than the current app's
+    SLOW_QUERY_THRESHOLD (ignoring its own queries).
+    """
+
+    def started(self, event):
+        if event.command_name not in query_commands or getattr(__recording__, 'active', False):
+            return
+        if not has_app_context() or current_app.config['SLOW_QUERY_THRESHOLD'] <= 0:
+            return
+
+        collection = event.command.get(event.command_name)
+        if collection == SlowQuery._get_collection_name():  # pylint: disable=protected-access
+            return
+
+        with __pending_lock__:
+            __pending__[event.request_id] = {
+                'command_name': event.command_name,
+                'command': event.command,
+                'collection': collection,
+                'database': event.database_name,
+                'endpoint': get_endpoint()
+            }
+
+    def succeeded(self, event):
+        with __pending_lock__:
+            query = __pending__.pop(event.request_id, None)
+
+        duration = event.duration_micros / 1000
+        if query is None or duration < current_app.config['SLOW_QUERY_THRESHOLD']:
+            return
+
+        # record it on the recording thread so the request isn't held up explaining and saving it
+        __start_recording__()
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        try:
+            __queue__.put_nowait((app, query, duration))
+        except Full:
+            current_app.logger.warning('Slow query (%.1f ms) dropped as too many are waiting to be recorded', duration)
+
+    def failed(self, event):
+        with __pending_lock__:
+            __pending__.pop(event.request_id, None)
+
+#
+# Slow query functions.
+#
+
+def get_shape(command_name, command):
+    """
+    Returns the shape of a command: its collection, name and fields with any
+    literal values (i.e. what it matches) redacted.
+    """
+
+    fields = {key: value for key, value in command.items() if key != command_name and key not in ignored_fields}
+    return '{}.{} {}'.format(command.get(command_name), command_name, json.dumps(__redact__(fields), default=str))
+
+def init_slow_queries():
+    """
+    Starts recording slow queries. Must be called before connecting to Mongo.
+    """
+
+    # listeners are registered globally so only register ours once
+    with __pending_lock__:
+        if not __state__['listening']:
+            monitoring.register(SlowQueryRecorder())
+            __state__['listening'] = True
+
+def get_slow_query_stats(hours=24, limit=20):
+    """
+    Returns the slow queries recorded over the last number of hours grouped
+    by shape, those that took the most time in total first.
+    """
+
+    since = datetime.now() - timedelta(hours=hours)
+    return list(SlowQuery.objects(created__gte=since).aggregate(
+        {'$group': {
+            '_id': '$shape',
+            'count': {'$sum': 1},
+            'total_duration': {'$sum': '$duration'},
+            'mean_duration': {'$avg': '$duration'},
+            'max_duration': {'$max': '$duration'},
+            'endpoints': {'$addToSet': '$endpoint'},
+            # most aren't explained (so have no plan)
+            'plan': {'$max': {'$ifNull': ['$plan', None]}},
+            'last_seen': {'$max': '$created'}
+        }},
+        {'$sort': {'total_duration': -1}},
+        {'$limit': limit}
+    ))
+
+def wait_for_slow_queries():
+    """
+    Waits for the slow queries queued so far to be recorded.
+    """
+
+    __queue__.join()
+
+def reset_slow_queries():
+    """
+    Forgets the queries in progress and when each shape was last explained.
+    """
+
+    with __pending_lock__:
+        __pending__.clear()
+        __explained__.clear()
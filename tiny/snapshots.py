@@ -0,0 +1,62 @@
+"""
+Exports functions to keep the author snapshots stored with posts and comments
+up to date. When an author changes their profile the new snapshot is fanned
+out to their posts and comments in batches by a background job.
+"""
+
+from flask import current_app
+
+from tiny.helpers import get_user, invalidate_user_responses
+from tiny.jobs import enqueue, task
+from tiny.models import AuthorSnapshot, Comment, Post
+from tiny.search_backends import expire_author_search_results
+
+def update_author_snapshots(snapshot, batch_size=500):
+    """
+    Sets an author's snapshot on any of their posts and comments where it is
+    missing or out of date, a batch at a time. Returns the number of posts and
+    comments updated.
+    """
+
+    updated = 0
+
+    for model in (Post, Comment):
+        # page by id so each batch picks up where the last one left off
+        last_id = None
+        while True:
+            query_set = model.objects(author=snapshot.id, author_snapshot__ne=snapshot)
+            if last_id:
+                query_set = query_set.filter(id__gt=last_id)
+            ids = list(query_set.order_by('id').limit(batch_size).scalar('id'))
+            if not ids:
+                break
+
+            updated += model.objects(id__in=ids).update(set__author_snapshot=snapshot)
+            last_id = ids[-1]
+
+    return updated
+
+@task
+def refresh_author_snapshots(user_id):
+    """
+    Updates the snapshots of a user across their posts and comments to match
+    their current profile.
+    """
+
+    user = get_user(user_id=user_id, exclude=['email', 'password'])
+    if not user:
+        return
+
+    update_author_snapshots(AuthorSnapshot.from_user(user), current_app.config['SNAPSHOT_BATCH_SIZE'])
+
+    # pages (and searches) may have been cached with the old snapshot while the snapshots were being updated
+    invalidate_user_responses(user.id)
+    expire_author_search_results(user.id)
+
+def fan_out_author_snapshot(user):
+    """
+    Queues a job to update the snapshots of a user across their posts and
+    comments. Returns the job.
+    """
+
+    return enqueue(refresh_author_snapshots, user_id=user.id)
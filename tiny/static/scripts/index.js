@@ -41,6 +41,8 @@ function PostLoader(options) {
   this.urlParameters = options.urlParameters || '';
   this.limit = options.limit || 12;
   this.skip = options.skip || 0;
+  this.useCursor = options.useCursor || false;
+  this.cursor = '';
   this.postCardCols = options.postCardCols || 12;
   this.postsContainer = options.postsContainer || $('.posts');
   this.loadMoreBtn = options.loadMoreBtn || $('.load-more');
@@ -55,20 +57,31 @@ PostLoader.prototype.loadPosts = function() {
   // should hide button when we trigger another request
   this.loadMoreBtn.addClass('hidden');
 
-  // build the request url
-  var url = this.baseUrl + '?limit=' + this.limit + '&skip=' + this.skip;
+  // build the request url (following the cursor if we have one)
+  var url = this.baseUrl + '?limit=' + this.limit;
+  if (this.useCursor) {
+    url += '&cursor=' + encodeURIComponent(this.cursor);
+  } else {
+    url += '&skip=' + this.skip;
+  }
   if (this.urlParameters) {
     url += '&' + this.urlParameters;
   }
 
-  $.get(url, function(results) {
+  $.get(url, function(response) {
+    var results = this.useCursor ? response.results : response;
+
     // append the results to the page
     results.forEach(function(result) {
       this.postsContainer.append(createPostCard(result, this.postCardCols));
     }.bind(this));
 
-    // make sure we increase skip so we can page through results
-    this.skip += results.length;
+    // make sure we move the cursor/increase skip so we can page through results
+    if (this.useCursor) {
+      this.cursor = response.cursor || this.cursor;
+    } else {
+      this.skip += results.length;
+    }
 
     // show button if there are, potentially, more results
     if (results.length === this.limit) {
@@ -106,6 +119,7 @@ function createPostCard(post, wrapperCols) {
             '<div class="wrapper">' +
               '<a class="author-name" href="/user/' + post.author.id + '/show">' + post.author.display_name + '</a>' +
               '<span class="created">' + formatDate(post.created) + '</span>' +
+              '<span class="comment-count">' + post.comment_count + (post.comment_count === 1 ? ' comment' : ' comments') + '</span>' +
             '</div>' +
           '</div>' +
         '</div>' +
@@ -123,7 +137,7 @@ function CommentLoader(options) {
   // get and normalise options
   this.postId = options.postId;
   this.limit = options.limit || 12;
-  this.skip = options.skip || 0;
+  this.cursor = '';
   this.commentsContainer = options.commentsContainer || $('.comments');
   this.loadMoreBtn = options.loadMoreBtn || $('.load-more-comments');
 
@@ -138,16 +152,18 @@ CommentLoader.prototype.loadComments = function() {
   this.loadMoreBtn.addClass('hidden');
 
   // build the request url
-  var url = '/post/' + this.postId + '/comments?limit=' + this.limit + '&skip=' + this.skip;
+  var url = '/post/' + this.postId + '/comments?limit=' + this.limit + '&cursor=' + encodeURIComponent(this.cursor);
 
-  $.get(url, function(results) {
+  $.get(url, function(response) {
     // append the comments to the page
-    results.forEach(function(result) {
+    response.results.forEach(function(result) {
       this.commentsContainer.append(createCommentCard(result));
     }.bind(this));
 
-    // make sure we increase skip so we can page through comments
-    this.skip += results.length;
+    // make sure we follow the cursor so we can page through comments
+    if (response.cursor) {
+      this.cursor = response.cursor;
+    }
 
     // show the button again
     this.loadMoreBtn.removeClass('hidden');
@@ -179,6 +195,48 @@ function createCommentCard(comment) {
   );
 }
 
+function SearchSuggester(options) {
+  // get and normalise options
+  this.inputs = options.inputs || $('.search-input');
+  this.suggestionsList = options.suggestionsList || $('#search-suggestions');
+  this.limit = options.limit || 8;
+  this.prefix = '';
+  this.request = null;
+
+  this.loadSuggestions = this.loadSuggestions.bind(this);
+
+  // make sure we debounce typing so we only ask for suggestions once the user pauses
+  this.inputs.on('input', _.debounce(this.loadSuggestions, 150));
+}
+
+SearchSuggester.prototype.loadSuggestions = function(e) {
+  var prefix = $(e.target).val().trim();
+  if (prefix === this.prefix) {
+    return;
+  }
+  this.prefix = prefix;
+
+  // cancel any request still in flight so its (now stale) suggestions aren't shown
+  if (this.request) {
+    this.request.abort();
+    this.request = null;
+  }
+
+  if (prefix.length < 2) {
+    this.suggestionsList.empty();
+    return;
+  }
+
+  var url = '/search/suggest?limit=' + this.limit + '&prefix=' + encodeURIComponent(prefix);
+
+  this.request = $.get(url, function(suggestions) {
+    this.request = null;
+    this.suggestionsList.empty().append(suggestions.map(function(suggestion) {
+      return $('<option>').attr('value', suggestion);
+    }));
+  }.bind(this), 'json');
+};
+
 $('form').validator().on('submit', function (e) {
   if (e.isDefaultPrevented()) {
     return;
@@ -211,6 +269,9 @@ $('.navbar-default .search-input').focusout(function(e) {
 
 $('.navbar-default .sign-out').click(handleSignOut);
 
+// suggest searches as the user types
+new SearchSuggester({});
+
 /*
  * Home page
  */
@@ -218,6 +279,7 @@ $('.navbar-default .sign-out').click(handleSignOut);
 if ($(document.body).hasClass('home')) {
   new PostLoader({
     baseUrl: '/post/latest',
+    useCursor: true,
     postCardCols: 6
   }).loadPosts();
 }
@@ -230,7 +292,8 @@ if ($(document.body).hasClass('user')) {
   // show page
   if ($(document.body).hasClass('show')) {
     new PostLoader({
-      baseUrl: '/user/' + window.location.pathname.split('/')[2] + '/posts'
+      baseUrl: '/user/' + window.location.pathname.split('/')[2] + '/posts',
+      useCursor: true
     }).loadPosts();
   }
 
@@ -290,6 +353,10 @@ if ($(document.body).hasClass('post')) {
           '<p class="lead">' + $('#lead_paragraph').val() + '</p>' +
           '<img class="post-img" src="' + $('#image_url').val() + '" alt="' + $('#title').val() + '">'
         ).append(e.html);
+      }).fail(function(response) {
+        $('#preview-tab').empty().append(
+          '<p class="text-danger">' + response.responseJSON.errors + '</p>'
+        );
       });
     });
   }
@@ -0,0 +1,210 @@
+"""
+Exports an in-process index of post titles and the terms used in them (and
+their lead paragraphs) for completing searches as they are typed. Entries are
+kept in a sorted array so the entries starting with a prefix can be found with
+a binary search, without touching the database. The index is built on first
+use and is updated as posts are created, updated and deleted. Once it is older
+than SEARCH_INDEX_TTL it is rebuilt on a background thread (to pick up changes
+made by other processes), with the old index served until the new one is
+ready.
+"""
+
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+
+from tiny.models import Post
+from tiny.search_backends import stop_words, token_pattern
+
+# the most entries to rank when completing a prefix (so short prefixes stay fast)
+max_candidates = 500
+
+def get_suggestion_keys(post):
+    """
+    Returns the suggestions a post adds to the index (its title and the terms
+    in its title and lead paragraph), keyed by their lowercase text.
+    """
+
+    title = post.get('title') if isinstance(post, dict) else post.title
+    lead_paragraph = post.get('lead_paragraph') if isinstance(post, dict) else post.lead_paragraph
+
+    keys = {}
+    if title:
+        title = ' '.join(title.split())
+        keys[title.lower()] = title
+
+    for term in token_pattern.findall('{} {}'.format(title or '', lead_paragraph or '').lower()):
+        if len(term) > 2 and term not in stop_words and not term.isdigit():
+            keys.setdefault(term, term)
+
+    return keys
+
+class SuggestionIndex:
+    """
+    A sorted array of suggestions, each counted by the number of posts they
+    come from (so the most common are suggested first).
+    """
+
+    def __init__(self):
+        self.__keys = []
+        self.__entries = {}
+        self.__posts = {}
+        self.__built = None
+        self.__rebuilding = False
+        self.__changes = None
+        self.__lock = Lock()
+        self.__build_lock = Lock()
+
+    def __add(self, post_id, post):
+        keys = get_suggestion_keys(post)
+        for key, text in keys.items():
+            entry = self.__entries.get(key)
+            if entry is None:
+                entry = self.__entries[key] = [text, 0]
+                insort(self.__keys, key)
+            entry[1] += 1
+        self.__posts[post_id] = list(keys)
+
+    def __remove(self, post_id):
+        for key in self.__posts.pop(post_id, []):
+            entry = self.__entries[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.__entries[key]
+                del self.__keys[bisect_left(self.__keys, key)]
+
+    def __record(self, post_id, post=None):
+        # changes made while the index is being rebuilt are replayed on the new index
+        if self.__changes is not None:
+            self.__changes.append((post_id, post))
+
+    def __ensure_built(self):
+        # nothing can be served until the index is first built
+        if self.__built is None:
+            self.build()
+            return
+
+        with self.__lock:
+            if self.__rebuilding or monotonic() - self.__built <= current_app.config['SEARCH_INDEX_TTL']:
+                return
+            self.__rebuilding = True
+
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        Thread(target=self.__rebuild, args=(app,), name='tiny-suggestions', daemon=True).start()
+
+    def __rebuild(self, app):
+        with app.app_context():
+            try:
+                self.build()
+            except Exception:  # pylint: disable=broad-except
+                # e.g. lost connection to the database so keep the old index and try again later
+                current_app.logger.exception('Failed to rebuild suggestion index')
+
+    def build(self):
+        """
+        Builds the index from every post, then swaps it in for the current one.
+        """
+
+        # only one build at a time so each has its own record of changes
+        with self.__build_lock:
+            with self.__lock:
+                self.__changes = []
+
+            try:
+                index = SuggestionIndex()
+                for post in Post.objects(deleted__ne=True).only('title', 'lead_paragraph').as_pymongo():
+                    index.__add(post['_id'], post)
+
+                with self.__lock:
+                    for post_id, post in self.__changes:
+                        index.__remove(post_id)
+                        if post is not None:
+                            index.__add(post_id, post)
+
+                    self.__keys = index.__keys
+                    self.__entries = index.__entries
+                    self.__posts = index.__posts
+                    self.__built = monotonic()
+            finally:
+                with self.__lock:
+                    self.__rebuilding = False
+                    self.__changes = None
+
+    def clear(self):
+        """
+        Empties the index so it is built again on next use.
+        """
+
+        with self.__lock:
+            self.__keys = []
+            self.__entries = {}
+            self.__posts = {}
+            self.__built = None
+
+    def index_post(self, post):
+        """
+        Adds a post's suggestions to the index (replacing any it added before).
+        """
+
+        self.__ensure_built()
+        with self.__lock:
+            self.__remove(post.id)
+            self.__add(post.id, post)
+            self.__record(post.id, post)
+
+    def remove_post(self, post_id):
+        """
+        Removes a post's suggestions from the index.
+        """
+
+        self.__ensure_built()
+        with self.__lock:
+            self.__remove(post_id)
+            self.__record(post_id)
+
+    def __complete(self, prefix, limit, terms_only=False):
+        start = bisect_left(self.__keys, prefix)
+        candidates = []
+        for key in self.__keys[start:start + max_candidates]:
+            if not key.startswith(prefix):
+                break
+            if not terms_only or ' ' not in key:
+                candidates.append(key)
+
+        # most common first, then shortest (i.e. the closest completion)
+        return nsmallest(limit, candidates, key=lambda key: (-self.__entries[key][1], len(key), key))
+
+    def suggest(self, prefix, limit=8):
+        """
+        Returns up to limit suggestions starting with a prefix. If there
+        aren't enough, the last word of the prefix is completed on its own too
+        (e.g. "learn pyt" suggests "learn python").
+        """
+
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return []
+
+        self.__ensure_built()
+
+        with self.__lock:
+            keys = self.__complete(prefix, limit)
+            suggestions = [self.__entries[key][0] for key in keys]
+
+            head, _, last = prefix.rpartition(' ')
+            if head and len(suggestions) < limit:
+                for term in self.__complete(last, limit, terms_only=True):
+                    key = '{} {}'.format(head, term)
+                    if key not in keys:
+                        keys.append(key)
+                        suggestions.append(key)
+                    if len(suggestions) == limit:
+                        break
+
+        return suggestions
+
+# suggestions for this process
+suggestion_index = SuggestionIndex()